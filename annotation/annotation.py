@@ -1,41 +1,95 @@
 import streamlit as st
 import json
-import os
-from PIL import Image, ImageDraw, ImageFont
 import zipfile
-import io
-import shutil
+from annotation.sources import ImageLibrary
+from annotation.render import OUTPUT_FORMATS, open_font, render_annotated
+from annotation.cache import RenderCache, fingerprint
+from annotation.preview import summarize, show_preview
+from annotation.store import AnnotationStore
+from annotation.archive import AnnotatedArchive, download_archive
+from converter.cnv import get_converter
+from workspace import QuotaExceeded, current_workspace
+from artifacts import ArtifactImageSource, artifact_panel, get_artifact_store, hold, publish_files, take_opened
+from profiling import section
+
+IMAGE_TYPES = ['jpg', 'jpeg', 'png', 'dcm', 'dicom']
+
+@st.cache_resource
+def load_font():
+    return open_font()
+
+@st.cache_resource
+def get_render_cache():
+    # Keys are content fingerprints, so sessions can share one process-wide cache
+    return RenderCache()
+
+def store_upload(library, workspace, uploaded_file):
+    """Save an upload into the workspace, charging it to the session quota first (reruns write nothing)."""
+    if not library.is_uploaded(uploaded_file):
+        workspace.reserve(uploaded_file.size, 'data')
+    library.store_upload(uploaded_file)
+
+def save_result(workspace, index, output_name, output_data):
+    """Write a rendered output to the workspace for publish_files, so results aren't all held in memory."""
+    workspace.reserve(len(output_data), 'annotated')
+    path = workspace.path('annotated', f'result-{index}')
+    with open(path, 'wb') as f:
+        f.write(output_data)
+    return output_name, path, 'annotated'
 
 def annotation_main():
-    # Set up directories
-    IMAGE_FOLDER = 'data'
-    OUTPUT_FOLDER = 'annotated_images'
-    EXTRACTED_JSON_FILE = 'extracted_data_with_labels.json'
-
-    # Create output folder if it doesn't exist
-    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-    
+    # Set up directories, in this session's own workspace
+    workspace = current_workspace()
+    IMAGE_FOLDER = workspace.path('data')
+    EXTRACTED_JSON_FILE = workspace.path('output', 'extracted_data_with_labels.json')
 
     # Font for annotation text
-    try:
-        font = ImageFont.truetype("arial.ttf", 60)
-    except IOError:
-        font = ImageFont.load_default()
+    font = load_font()
+
+    # Images are looked up lazily by the file names in the JSON
+    if 'image_library' not in st.session_state:
+        st.session_state['image_library'] = ImageLibrary(IMAGE_FOLDER, get_converter())
+    library = st.session_state['image_library']
+    render_cache = get_render_cache()
+
+    # Results opened from another page are annotated straight from the artifact store
+    if 'artifact_source' not in st.session_state:
+        st.session_state['artifact_source'] = ArtifactImageSource(get_artifact_store(), library.converter)
+    artifact_source = st.session_state['artifact_source']
+    library.add_source(artifact_source)
+    opened = take_opened('annotations')
+    if opened is not None:
+        hold('annotations', opened)
+        artifact_source.add(get_artifact_store().name(opened), opened)
 
     st.title('DICOM Image Annotation Tool')
+    if opened is not None:
+        st.info(f'{get_artifact_store().name(opened)} opened. Upload the annotations for it below.')
 
     # Upload JSON file
     st.subheader('Upload JSON file with annotations')
     uploaded_json = st.file_uploader('Choose a JSON file', type='json')
 
     if uploaded_json:
-        try:
-            data = json.load(uploaded_json)
+        # Parse and summarize once per upload rather than on every rerun
+        json_key = getattr(uploaded_json, 'file_id', None) or (uploaded_json.name, uploaded_json.size)
+        if st.session_state.get('json_key') != json_key:
+            try:
+                with section('annotation.parse_json'):
+                    data = json.load(uploaded_json)
+                    store = AnnotationStore.from_data(data)
+                    st.session_state['annotation_store'] = store
+                    st.session_state['json_is_coco'] = isinstance(data, dict)
+                    st.session_state['json_summary'] = summarize(store) if store is not None else None
+                st.session_state['json_key'] = json_key
+            except (ValueError, TypeError):
+                st.session_state.pop('json_key', None)
+                st.error("Invalid JSON file. Please upload a valid JSON file.")
+        if st.session_state.get('json_key') == json_key:
             st.write('JSON file loaded successfully.')
-            st.write('Data preview:', data)
-            st.session_state['json_data'] = data
-        except (json.JSONDecodeError, TypeError):
-            st.error("Invalid JSON file. Please upload a valid JSON file.")
+            if st.session_state['annotation_store'] is not None:
+                with st.expander('Data preview', expanded=True):
+                    show_preview(st.session_state['json_summary'], st.session_state['annotation_store'], library)
 
     # Upload images
     upload_option = st.selectbox(
@@ -44,64 +98,47 @@ def annotation_main():
     )
 
     if upload_option == 'Upload Single Image':
-        uploaded_image = st.file_uploader('Choose a single image file', type=['jpg', 'jpeg', 'png'])
+        uploaded_image = st.file_uploader('Choose a single image or DICOM file', type=IMAGE_TYPES)
         if uploaded_image:
-            os.makedirs(IMAGE_FOLDER, exist_ok=True)
-            image = Image.open(uploaded_image)
-            image_path = os.path.join(IMAGE_FOLDER, uploaded_image.name)
-            image.save(image_path)
-            st.write(f'Image saved to {image_path}')
+            try:
+                store_upload(library, workspace, uploaded_image)
+                st.write(f'Image saved to {library.folder.path(uploaded_image.name)}')
+            except QuotaExceeded as e:
+                st.error(str(e))
 
     elif upload_option == 'Upload Multiple Images':
-        uploaded_images = st.file_uploader('Choose multiple image files', type=['jpg', 'jpeg', 'png'], accept_multiple_files=True)
+        uploaded_images = st.file_uploader('Choose multiple image or DICOM files', type=IMAGE_TYPES, accept_multiple_files=True)
         if uploaded_images:
-            os.makedirs(IMAGE_FOLDER, exist_ok=True)
-            for image_file in uploaded_images:
-                image = Image.open(image_file)
-                image_path = os.path.join(IMAGE_FOLDER, image_file.name)
-                image.save(image_path)
-            st.write('Images uploaded and saved.')
+            try:
+                for image_file in uploaded_images:
+                    store_upload(library, workspace, image_file)
+                st.write('Images uploaded and saved.')
+            except QuotaExceeded as e:
+                st.error(str(e))
 
     elif upload_option == 'Upload Folder of Images (ZIP)':
-        uploaded_zip = st.file_uploader('Choose a ZIP file containing images', type='zip')
+        uploaded_zip = st.file_uploader('Choose a ZIP file containing images or DICOM files', type='zip')
         if uploaded_zip:
-            with zipfile.ZipFile(uploaded_zip, 'r') as zip_ref:
-                zip_ref.extractall(IMAGE_FOLDER)
-            st.write('Images extracted from ZIP file and saved.')
+            try:
+                library.set_archive(getattr(uploaded_zip, 'file_id', uploaded_zip.name), uploaded_zip)
+                st.write('ZIP file indexed. Images will be read from it as they are annotated.')
+            except zipfile.BadZipFile:
+                st.error("Invalid ZIP file. Please upload a valid ZIP file.")
 
     # Extract relevant JSON
     if st.button('Extract Relevant JSON'):
-        if 'json_data' in st.session_state:
-            data = st.session_state['json_data']
-            if 'categories' in data and 'annotations' in data:
-                category_mapping = {category['id']: category['name'] for category in data.get('categories', [])}
-
-                extracted_data = []
-                for image in data.get('images', []):
-                    image_id = image.get('id')
-                    file_name = image.get('file_name')
-
-                    annotations = []
-                    for ann in data.get('annotations', []):
-                        if ann.get('image_id') == image_id:
-                            category_id = ann.get('category_id')
-                            annotations.append({
-                                'bbox': ann.get('bbox'),
-                                'label': category_id,
-                                'category_name': category_mapping.get(category_id)
-                            })
-
-                    extracted_data.append({
-                        'image_id': image_id,
-                        'name': file_name,
-                        'annotations': annotations
-                    })
-
-                with open(EXTRACTED_JSON_FILE, 'w') as outfile:
-                    json.dump(extracted_data, outfile, indent=4)
-
-                st.write(f'Extracted data saved to {EXTRACTED_JSON_FILE}')
-                st.session_state['extracted_json'] = EXTRACTED_JSON_FILE
+        if 'annotation_store' in st.session_state:
+            store = st.session_state['annotation_store']
+            if store is not None and st.session_state['json_is_coco']:
+                extracted_json = json.dumps(store.to_extracted(), indent=4).encode()
+                try:
+                    workspace.reserve(len(extracted_json), 'output')
+                    with open(EXTRACTED_JSON_FILE, 'wb') as outfile:
+                        outfile.write(extracted_json)
+                    st.write(f'Extracted data saved to {EXTRACTED_JSON_FILE}')
+                    st.session_state['extracted_json'] = EXTRACTED_JSON_FILE
+                except QuotaExceeded as e:
+                    st.error(str(e))
             else:
                 st.error("The provided JSON file is not correctly structured for extraction. Please upload a valid JSON file.")
         else:
@@ -114,67 +151,90 @@ def annotation_main():
             st.download_button('Download Extracted JSON', file, file_name='extracted_data_with_labels.json')
 
     # Annotate images
+    output_format = st.selectbox('Annotated image format:', OUTPUT_FORMATS)
+    mask_alpha = st.slider('Segmentation mask opacity', min_value=0.0, max_value=1.0, value=0.4, step=0.1)
     if st.button('Annotate Images'):
-        if 'json_data' in st.session_state:
-            data = st.session_state['json_data']
-            if 'annotations' not in data[0]:
-                st.error("Please first extract the relevant JSON file using the button provided, then upload it for annotating the images.")
+        if 'annotation_store' in st.session_state:
+            store = st.session_state['annotation_store']
+            if store is None:
+                st.error("The provided JSON file is not correctly structured for annotating. Please upload a COCO or extracted JSON file.")
             else:
-                annotated_files = []
-                for item in data:
-                    image_id = item['image_id']
-                    image_name = item['name']
-                    annotations = item['annotations']
-
-                    image_path = os.path.join(IMAGE_FOLDER, image_name)
-                    if os.path.exists(image_path):
-                        image = Image.open(image_path)
-                        draw = ImageDraw.Draw(image)
-
-                        for ann in annotations:
-                            bbox = ann['bbox']
-                            category_name = ann['category_name']
-
-                            x1, y1, width, height = bbox
-                            x2 = x1 + width
-                            y2 = y1 + height
-
-                            draw.rectangle([x1, y1, x2, y2], outline="red", width=8)
-
-                            text_width, text_height = draw.textsize(category_name, font=font)
-                            text_x = x1
-                            text_y = y1 - text_height if y1 - text_height > 0 else y1 + 10
-
-                            draw.rectangle([text_x, text_y, text_x + text_width + 20, text_y + text_height + 10], fill="white")
-                            draw.text((text_x + 10, text_y + 5), category_name, fill="black", font=font)
-
-                        output_path = os.path.join(OUTPUT_FOLDER, image_name)
-                        image.save(output_path)
-                        annotated_files.append(output_path)
-
-                if len(annotated_files) == 1:
-                    with open(annotated_files[0], "rb") as file:
-                        a=st.download_button("Download Annotated Image", file, file_name=os.path.basename(annotated_files[0]))
-                        print(a,"hfghdgfhd")
-                        
-                else:
-                    zip_buffer = io.BytesIO()
-                    with zipfile.ZipFile(zip_buffer, "w") as zip_file:
-                        for file_path in annotated_files:
-                            zip_file.write(file_path, os.path.basename(file_path))
-                    zip_buffer.seek(0)
-                    st.download_button("Download Annotated Images (ZIP)", zip_buffer, file_name="annotated_images.zip")
-                  
+                # Only images whose source, annotations or style changed are re-rendered
+                font_path = getattr(font, 'path', None)
+                style = (output_format, mask_alpha, font_path if isinstance(font_path, str) else None,
+                         getattr(font, 'size', None))
+                items = {name: store.image_annotations(i) for i, name in enumerate(store.names)
+                         if name and library.find(name) is not None}
+                keys = {name: fingerprint(library.fingerprint(name), annotations, style)
+                        for name, annotations in items.items()}
+                archive_key = tuple(keys.values())
+                previous = st.session_state.get('annotated_archive')
+                if len(items) > 1 and previous is not None and previous[0] == archive_key:
+                    # Nothing changed since the last click: serve the same archive
+                    st.write(f'0 of {len(items)} images rendered, {len(items)} reused.')
+                    download_archive("Download Annotated Images (ZIP)", previous[1], "annotated_images.zip")
+                elif items:
+                    # Members go into a spooled ZIP as soon as they are available: cached
+                    # outputs first, then each image as its render completes.
+                    archive = AnnotatedArchive(dir=workspace.path('annotated'), workspace=workspace) if len(items) > 1 else None
+                    try:
+                        outputs = {}
+                        results = []
+                        stale = []
+                        for name in items:
+                            cached = render_cache.get(keys[name])
+                            if cached is None:
+                                stale.append(name)
+                            else:
+                                outputs[name] = cached
+                                results.append(save_result(workspace, len(results), *cached))
+                                if archive is not None:
+                                    archive.add(*cached)
+                        with section('annotation.render'):
+                            for image_name, image, dataset in library.iter_images(stale):
+                                output_name, output_data = render_annotated(
+                                    image_name, image, dataset, items[image_name], font, output_format,
+                                    library.converter, mask_alpha)
+                                render_cache.put(keys[image_name], output_name, output_data)
+                                results.append(save_result(workspace, len(results), output_name, output_data))
+                                if archive is not None:
+                                    archive.add(output_name, output_data)
+                                else:
+                                    outputs[image_name] = (output_name, output_data)
+                    except QuotaExceeded as e:
+                        # The archive's members are charged to the session quota as they are added
+                        if archive is not None:
+                            archive.discard()
+                        for _, path, kind in results:
+                            workspace.remove(path, kind)
+                        st.error(str(e))
+                    else:
+                        st.write(f'{len(stale)} of {len(items)} images rendered, {len(items) - len(stale)} reused.')
+                        publish_files('annotations', results)
+
+                        if archive is None:
+                            output_name, output_data = next(iter(outputs.values()))
+                            st.download_button("Download Annotated Image", output_data, file_name=output_name)
+                        else:
+                            archive.close()
+                            if previous is not None:
+                                previous[1].discard()
+                            st.session_state['annotated_archive'] = (archive_key, archive)
+                            download_archive("Download Annotated Images (ZIP)", archive, "annotated_images.zip")
 
                 st.write('All images have been annotated.')
         else:
             st.error('No JSON data to annotate images with. Please upload a JSON file.')
 
+    # Open an annotated image in the zoom viewer
+    artifact_panel('annotations', ['zooming'])
+
 def cleanup():
     """Delete the folders and their contents."""
     try:
-        shutil.rmtree('data')
-        shutil.rmtree('annotated_images')
+        current_workspace().clear()
+        if 'annotated_archive' in st.session_state:
+            st.session_state.pop('annotated_archive')[1].discard()
         st.success("All temporary files and folders have been cleaned up.")
     except Exception as e:
         st.error(f"An error occurred while cleaning up: {e}")
@@ -0,0 +1,71 @@
+import tempfile
+import zipfile
+
+# Encoded images gain nothing from deflate; DICOM pixel data usually does
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+SPOOL_MAX_BYTES = 32 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+class AnnotatedArchive:
+    """A ZIP of annotated outputs, written member by member as renders complete.
+
+    The archive lives in a SpooledTemporaryFile: small archives stay in memory,
+    anything past max_size is moved to a temporary file on disk. With a
+    workspace, every member is charged to its quota (under annotated/) before
+    it is written, and discard() gives the bytes back.
+    """
+
+    def __init__(self, max_size=SPOOL_MAX_BYTES, dir=None, workspace=None):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size, suffix='.zip', dir=dir)
+        self._zip = zipfile.ZipFile(self.file, 'w')
+        self.count = 0
+        self.workspace = workspace
+        self.charged = 0
+
+    def add(self, name, data):
+        if self.workspace is not None:
+            self.workspace.reserve(len(data), 'annotated')
+            self.charged += len(data)
+        compress_type = zipfile.ZIP_STORED if name.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+        self._zip.writestr(name, data, compress_type=compress_type)
+        self.count += 1
+
+    def close(self):
+        self._zip.close()
+
+    def discard(self):
+        # An archive abandoned half-written still has its ZIP open
+        if self._zip.fp is not None:
+            self._zip.close()
+        self.file.close()
+        if self.workspace is not None:
+            self.workspace.refund(self.charged, 'annotated')
+            self.charged = 0
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+
+def download_archive(label, archive, file_name):
+    """Offer the archive for download, reading it only when the button is clicked.
+
+    Streamlit versions without deferred downloads get the spooled file object instead.
+    Streamlit is imported here so the headless service can use the archive without it.
+    """
+    import streamlit as st
+    from streamlit.errors import StreamlitAPIException
+    try:
+        return st.download_button(label, archive.read, file_name=file_name, mime='application/zip')
+    except StreamlitAPIException:
+        archive.file.seek(0)
+        return st.download_button(label, archive.file, file_name=file_name, mime='application/zip')
@@ -0,0 +1,44 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+def fingerprint(*parts):
+    """Hash everything that goes into a rendered image into a short key."""
+    payload = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha1(payload).hexdigest()
+
+
+class RenderCache:
+    """Rendered outputs keyed by the fingerprint of their inputs.
+
+    Holds (output_name, encoded_bytes) pairs and evicts the least recently used
+    ones once more than max_bytes are held. Safe to share between sessions.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, output_name, data):
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key)[1])
+            self._entries[key] = (output_name, data)
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
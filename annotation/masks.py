@@ -0,0 +1,116 @@
+import colorsys
+import zlib
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def rle_counts_from_string(s):
+    """Decode the compressed counts string of a COCO RLE into a list of run lengths.
+
+    This is the same LEB128-style scheme pycocotools uses: 5 bits per character,
+    and every count from the fourth on is stored as a delta to the count two
+    places earlier.
+    """
+    counts = []
+    p = 0
+    while p < len(s):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = ord(s[p]) - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+
+def decode_rle(rle):
+    """Expand a COCO RLE ({'size': [h, w], 'counts': ...}) into a boolean (h, w) mask."""
+    height, width = rle['size']
+    counts = rle['counts']
+    if isinstance(counts, bytes):
+        counts = counts.decode('ascii')
+    if isinstance(counts, str):
+        counts = rle_counts_from_string(counts)
+    counts = np.asarray(counts, dtype=np.int64)
+    # Runs alternate between background and foreground, starting with background.
+    values = (np.arange(len(counts)) % 2).astype(bool)
+    flat = np.repeat(values, counts)
+    mask = np.zeros(height * width, dtype=bool)
+    mask[:min(len(flat), mask.size)] = flat[:mask.size]
+    # COCO masks are stored column-major.
+    return mask.reshape((width, height)).T
+
+
+def category_palette(category_ids):
+    """Map each category id to a distinct, stable RGB colour."""
+    palette = {}
+    for category_id in category_ids:
+        hue = (zlib.crc32(str(category_id).encode()) * 0.618033988749895) % 1.0
+        r, g, b = colorsys.hsv_to_rgb(hue, 0.85, 1.0)
+        palette[category_id] = (int(r * 255), int(g * 255), int(b * 255))
+    return palette
+
+
+def segmentation_labels(annotations, size):
+    """Rasterize every segmentation of an image into one label map.
+
+    Returns (labels, categories): labels is an int32 (h, w) array where 0 is
+    background and i > 0 means categories[i - 1]. Later annotations win where
+    masks overlap. Returns (None, []) if no annotation has a segmentation.
+    """
+    categories = []
+    label_image = None
+    for ann in annotations:
+        segmentation = ann.get('segmentation')
+        if not segmentation:
+            continue
+        category = ann.get('label')
+        if category not in categories:
+            categories.append(category)
+        index = categories.index(category) + 1
+        if label_image is None:
+            label_image = Image.new('I', size)
+            draw = ImageDraw.Draw(label_image)
+        if isinstance(segmentation, dict):
+            # RLE masks are pasted in turn with the polygons, so overlaps follow annotation order
+            mask = Image.fromarray(decode_rle(segmentation).astype(np.uint8) * 255)
+            if mask.size != label_image.size:
+                mask = mask.resize(size, Image.NEAREST)
+            label_image.paste(index, mask=mask)
+            continue
+        for polygon in segmentation:
+            if len(polygon) >= 6:
+                draw.polygon([float(v) for v in polygon], fill=index)
+
+    if label_image is None:
+        return None, []
+    labels = np.asarray(label_image, dtype=np.int32).copy()
+    return labels, categories
+
+
+def blend_masks(image, labels, categories, alpha=0.4):
+    """Alpha-blend category-coloured masks onto an RGB image in a single array operation."""
+    palette = category_palette(categories)
+    lut = np.zeros((len(categories) + 1, 3), dtype=np.float32)
+    for i, category in enumerate(categories, start=1):
+        lut[i] = palette[category]
+    pixels = np.asarray(image.convert('RGB'), dtype=np.float32)
+    weight = (labels > 0)[..., None] * np.float32(alpha)
+    blended = pixels * (1 - weight) + lut[labels] * weight
+    return Image.fromarray(blended.astype(np.uint8), 'RGB')
+
+
+def render_masks(image, annotations, alpha=0.4):
+    """Return the image with all segmentation masks blended in, or the image itself if there are none."""
+    labels, categories = segmentation_labels(annotations, image.size)
+    if labels is None:
+        return image
+    return blend_masks(image, labels, categories, alpha)
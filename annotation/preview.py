@@ -0,0 +1,98 @@
+import streamlit as st
+import numpy as np
+
+PAGE_SIZE = 25
+THUMBNAIL_SIZE = (160, 160)
+MAX_THUMBNAILS = 8
+MAX_CHART_CATEGORIES = 50
+
+
+def category_label(store, code):
+    category_id = store.category_id(code)
+    return str(store.categories.get(category_id, category_id))
+
+
+def summarize(store):
+    """Compute the preview statistics once per uploaded JSON, straight from the store's arrays."""
+    category_values, category_counts = np.unique(store.category_ids, return_counts=True)
+    order = np.argsort(-category_counts, kind='stable')
+    boxes_per_image = np.diff(store.offsets)
+    boxes_histogram = np.bincount(boxes_per_image) if len(boxes_per_image) else np.zeros(1, dtype=np.int64)
+
+    bboxes = store.bboxes[np.isfinite(store.bboxes).all(axis=1)]
+    sizes = np.sqrt(np.clip(bboxes[:, 2] * bboxes[:, 3], 0, None))
+    if len(sizes):
+        size_counts, size_edges = np.histogram(sizes, bins=20)
+    else:
+        size_counts, size_edges = np.zeros(0, dtype=np.int64), np.zeros(1)
+
+    return {
+        'images': len(store.names),
+        'annotations': len(store),
+        'category_counts': [(category_label(store, category_values[i]), int(category_counts[i])) for i in order],
+        'boxes_histogram': boxes_histogram.tolist(),
+        'size_counts': size_counts.tolist(),
+        'size_edges': size_edges.tolist(),
+    }
+
+
+def table_rows(store, start, stop):
+    """Per-image table rows for images start..stop only."""
+    rows = []
+    for i in range(start, min(stop, len(store.names))):
+        s = store.image_slice(i)
+        categories = {category_label(store, c) for c in np.unique(store.category_ids[s])}
+        rows.append({'image_id': store.image_id(i), 'name': store.names[i], 'boxes': s.stop - s.start,
+                     'categories': ', '.join(sorted(categories))})
+    return rows
+
+
+def thumbnail(library, name, cache):
+    """Small RGB preview of an image, cached by source fingerprint."""
+    key = library.fingerprint(name)
+    if key not in cache:
+        if len(cache) >= 256:
+            cache.clear()
+        image, _ = library.load(name)
+        image = image.convert('RGB')
+        image.thumbnail(THUMBNAIL_SIZE)
+        cache[key] = image
+    return cache[key]
+
+
+def show_preview(summary, store, library, key='annotation_preview'):
+    """Render the summary charts, one page of the table and a thumbnail grid for that page."""
+    col1, col2, col3 = st.columns(3)
+    col1.metric('Images', summary['images'])
+    col2.metric('Annotations', summary['annotations'])
+    col3.metric('Categories', len(summary['category_counts']))
+
+    if summary['category_counts']:
+        st.caption('Annotations per category')
+        top = summary['category_counts'][:MAX_CHART_CATEGORIES]
+        st.bar_chart({'category': [name for name, _ in top], 'count': [count for _, count in top]},
+                     x='category', y='count')
+
+        st.caption('Images by number of boxes')
+        histogram = summary['boxes_histogram']
+        st.bar_chart({'boxes': list(range(len(histogram))), 'images': histogram}, x='boxes', y='images')
+
+    if summary['size_counts']:
+        st.caption('Box size distribution (sqrt of area, px)')
+        edges = summary['size_edges']
+        st.bar_chart({'size': [f'{edges[i]:.0f}-{edges[i + 1]:.0f}' for i in range(len(edges) - 1)],
+                      'boxes': summary['size_counts']}, x='size', y='boxes')
+
+    if not summary['images']:
+        return
+    pages = max(1, -(-summary['images'] // PAGE_SIZE))
+    page = st.number_input(f'Page (of {pages})', min_value=1, max_value=pages, value=1, step=1, key=f'{key}_page')
+    rows = table_rows(store, (page - 1) * PAGE_SIZE, page * PAGE_SIZE)
+    st.dataframe(rows)
+
+    # Thumbnails for the images on this page that have been uploaded
+    cache = st.session_state.setdefault(f'{key}_thumbnails', {})
+    names = [row['name'] for row in rows if row['name'] and library.find(row['name']) is not None]
+    names = names[:MAX_THUMBNAILS]
+    if names:
+        st.image([thumbnail(library, name, cache) for name in names], caption=names)
@@ -0,0 +1,73 @@
+import io
+import os
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from annotation.masks import render_masks, segmentation_labels
+
+OUTPUT_FORMATS = ['Same as input (DICOM with overlay plane)', 'PNG', 'JPEG']
+
+def open_font():
+    try:
+        return ImageFont.truetype("arial.ttf", 60)
+    except IOError:
+        return ImageFont.load_default()
+
+def text_size(draw, text, font):
+    # ImageDraw.textsize was removed in Pillow 10.
+    if hasattr(draw, 'textbbox'):
+        left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+        return right - left, bottom - top
+    return draw.textsize(text, font=font)
+
+def draw_annotations(image, annotations, font):
+    """Draw the bbox and category label of every annotation onto the image in place."""
+    draw = ImageDraw.Draw(image)
+
+    for ann in annotations:
+        bbox = ann['bbox']
+        category_name = str(ann['category_name'])
+
+        x1, y1, width, height = bbox
+        x2 = x1 + width
+        y2 = y1 + height
+
+        draw.rectangle([x1, y1, x2, y2], outline="red", width=8)
+
+        text_width, text_height = text_size(draw, category_name, font)
+        text_x = x1
+        text_y = y1 - text_height if y1 - text_height > 0 else y1 + 10
+
+        draw.rectangle([text_x, text_y, text_x + text_width + 20, text_y + text_height + 10], fill="white")
+        draw.text((text_x + 10, text_y + 5), category_name, fill="black", font=font)
+
+    return image
+
+def render_annotated(image_name, image, dataset, annotations, font, output_format, converter, mask_alpha=0.4):
+    """Draw the masks and annotations and encode the result; returns (output_name, data).
+
+    DICOM inputs kept as DICOM get the annotations as an overlay plane, so their
+    pixel data is written back exactly as it was read.
+    """
+    base_name, ext = os.path.splitext(os.path.basename(image_name))
+    buffer = io.BytesIO()
+    if dataset is not None and output_format == OUTPUT_FORMATS[0]:
+        mask = np.asarray(draw_annotations(Image.new('L', image.size), annotations, font)) > 0
+        if mask_alpha > 0:
+            labels, _ = segmentation_labels(annotations, image.size)
+            if labels is not None:
+                mask |= labels > 0
+        converter.add_overlay(dataset, mask)
+        dataset.save_as(buffer)
+        return base_name + '.dcm', buffer.getvalue()
+
+    if output_format == 'PNG':
+        ext = '.png'
+    elif output_format == 'JPEG':
+        ext = '.jpg'
+    if image.mode not in ('RGB', 'RGBA') or ext.lower() in ('.jpg', '.jpeg'):
+        image = image.convert('RGB')
+    if mask_alpha > 0:
+        image = render_masks(image, annotations, mask_alpha)
+    draw_annotations(image, annotations, font)
+    image.save(buffer, format=Image.registered_extensions()[ext.lower()])
+    return base_name + ext, buffer.getvalue()
@@ -0,0 +1,234 @@
+import os
+import io
+import hashlib
+import posixpath
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+DICOM_EXTENSIONS = ('.dcm', '.dicom')
+
+
+def is_dicom(name, data):
+    """DICOM files are recognised by extension or by the 'DICM' magic after the preamble."""
+    return name.lower().endswith(DICOM_EXTENSIONS) or data[128:132] == b'DICM'
+
+
+def normalize_member_name(name):
+    """Turn a JSON file name or archive member name into a safe relative POSIX path.
+
+    Returns None for names that are empty or would escape the image root
+    (absolute paths, drive letters, '..' components).
+    """
+    if not name:
+        return None
+    name = posixpath.normpath(str(name).replace('\\', '/'))
+    parts = name.split('/')
+    if name.startswith('/') or parts[0].endswith(':') or '..' in parts or name == '.':
+        return None
+    return name
+
+
+def decode_image(name, data, converter):
+    """Decode encoded image or DICOM bytes in a single pass.
+
+    Returns (image, dataset). For DICOM files the image is the converter's
+    8-bit rendering of the pixel data and dataset is the parsed DICOM
+    dataset; for other images dataset is None.
+    """
+    if is_dicom(name, data):
+        dataset = converter.read_dicom(io.BytesIO(data), force=True)
+        image = Image.fromarray(converter.render_pixel_array(dataset))
+        return image, dataset
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image, None
+
+
+class FolderImageSource:
+    """Images stored as files under a local folder."""
+
+    def __init__(self, root):
+        self.root = root
+        self._keys = {}
+        self._hashes = {}
+
+    def path(self, name):
+        name = normalize_member_name(name)
+        if name is None:
+            return None
+        return os.path.join(self.root, *name.split('/'))
+
+    def has(self, name):
+        path = self.path(name)
+        return path is not None and os.path.isfile(path)
+
+    def is_stored(self, name, key):
+        """Whether store(name, key, ...) would be a no-op."""
+        path = self.path(name)
+        return path is not None and self._keys.get(path) == key and os.path.isfile(path)
+
+    def store(self, name, key, data):
+        """Persist the original encoded bytes of an upload without decoding them.
+
+        Storing the same key under the same name again (a Streamlit rerun) is a
+        no-op. Returns True if the file was written.
+        """
+        path = self.path(name)
+        if path is None:
+            raise ValueError(f"Invalid image file name: {name}")
+        if self.is_stored(name, key):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self._keys[path] = key
+        self._hashes[path] = hashlib.sha1(data).hexdigest()
+        return True
+
+    def fingerprint(self, name):
+        """Identify the file content: the upload hash if we stored it, else size and mtime."""
+        path = self.path(name)
+        if path in self._hashes:
+            return self._hashes[path]
+        stat = os.stat(path)
+        return f'{path}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    def read_bytes(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+
+class ZipImageSource:
+    """Random-access images inside an uploaded ZIP archive.
+
+    Only the central directory is read up front; member data is read and decoded
+    when an image is requested, so unreferenced members are never touched.
+    """
+
+    def __init__(self, fileobj):
+        self._zip = zipfile.ZipFile(fileobj)
+        self._members = {}
+        self._by_basename = {}
+        self._hashes = {}
+        for info in self._zip.infolist():
+            if info.is_dir():
+                continue
+            name = normalize_member_name(info.filename)
+            if name is None:
+                continue
+            self._members[name] = info
+            self._by_basename.setdefault(posixpath.basename(name), []).append(info)
+
+    def lookup(self, name):
+        """Return the ZipInfo for a JSON file name, or None if the archive doesn't have it."""
+        key = normalize_member_name(name)
+        if key is None:
+            return None
+        info = self._members.get(key)
+        if info is None:
+            # Archives usually wrap the images in a top-level folder; fall back to
+            # the base name when it is unambiguous.
+            candidates = self._by_basename.get(posixpath.basename(key), [])
+            if len(candidates) == 1:
+                info = candidates[0]
+        return info
+
+    def has(self, name):
+        return self.lookup(name) is not None
+
+    def read_bytes(self, name):
+        return self._zip.read(self.lookup(name))
+
+    def fingerprint(self, name):
+        """Identify the member content by its hash.
+
+        Not the CRC from the central directory: rendered outputs are shared across
+        sessions by this key, and a CRC collision is easy to craft.
+        """
+        info = self.lookup(name)
+        if info.filename not in self._hashes:
+            digest = hashlib.sha1()
+            with self._zip.open(info) as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            self._hashes[info.filename] = digest.hexdigest()
+        return self._hashes[info.filename]
+
+
+class ImageLibrary:
+    """Every place annotation_main can find an image by its JSON file name."""
+
+    def __init__(self, folder, converter):
+        self.folder = FolderImageSource(folder)
+        self.converter = converter
+        self.archive = None
+        self.archive_key = None
+        self.sources = []
+
+    def add_source(self, source):
+        """Look images up in another source (anything with has/read_bytes/fingerprint) after the uploads."""
+        if source not in self.sources:
+            self.sources.append(source)
+
+    def is_uploaded(self, uploaded_file):
+        """Whether this very upload has been saved already (so saving it again writes nothing)."""
+        return self.folder.is_stored(uploaded_file.name, _upload_key(uploaded_file))
+
+    def store_upload(self, uploaded_file):
+        """Save a Streamlit upload as-is, keyed by its uploader file id."""
+        return self.folder.store(uploaded_file.name, _upload_key(uploaded_file), uploaded_file.getbuffer())
+
+    def set_archive(self, key, fileobj):
+        # Indexing the central directory is cheap, but there's no point redoing it
+        # on every Streamlit rerun for the same upload.
+        if key != self.archive_key:
+            self.archive = ZipImageSource(fileobj)
+            self.archive_key = key
+
+    def find(self, name):
+        """Return the source holding the image, or None. What the user uploaded wins over added sources."""
+        if self.archive is not None and self.archive.has(name):
+            return self.archive
+        if self.folder.has(name):
+            return self.folder
+        for source in self.sources:
+            if source.has(name):
+                return source
+        return None
+
+    def fingerprint(self, name):
+        return self.find(name).fingerprint(name)
+
+    def load(self, name):
+        """Read and decode an image; returns (image, dataset) as decode_image does.
+
+        Sources that keep images decoded already (they have a load method) hand them over directly.
+        """
+        source = self.find(name)
+        if hasattr(source, 'load'):
+            return source.load(name)
+        return decode_image(name, source.read_bytes(name), self.converter)
+
+    def iter_images(self, names, max_workers=4):
+        """Decode the named images on a small thread pool and yield (name, image, dataset) in order.
+
+        Names that no source holds are skipped. At most 2 * max_workers decoded
+        images are held at any time.
+        """
+        names = [name for name in names if self.find(name) is not None]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending = deque()
+            for name in names:
+                pending.append((name, pool.submit(self.load, name)))
+                if len(pending) >= 2 * max_workers:
+                    done_name, future = pending.popleft()
+                    yield (done_name, *future.result())
+            while pending:
+                done_name, future = pending.popleft()
+                yield (done_name, *future.result())
+
+
+def _upload_key(uploaded_file):
+    return getattr(uploaded_file, 'file_id', None) or (uploaded_file.name, uploaded_file.size)
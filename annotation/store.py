@@ -0,0 +1,226 @@
+import json
+import numpy as np
+
+GRID_CELL = 256
+# Boxes (and query regions) spanning more grid cells than this skip the grid
+MAX_GRID_CELLS = 64
+
+
+class AnnotationStore:
+    """Columnar, in-memory annotations built from a COCO file or an extracted annotation list.
+
+    Images are rows of `image_ids`/`names`. Annotations are sorted by image and
+    held as parallel arrays (`ann_image`, `category_ids`, `bboxes`), so the boxes
+    of image i are the slice offsets[i]:offsets[i + 1]. Category ids can be any
+    JSON value, so `category_ids` holds dense codes into `category_keys`, the
+    original ids in order of first appearance. A category index and a coarse
+    per-image spatial grid make class and region queries O(result); the few
+    boxes too large for the grid are kept apart and checked on every query.
+    """
+
+    def __init__(self, image_ids, names, ann_image, category_ids, bboxes, categories, segmentations=None):
+        order = np.argsort(ann_image, kind='stable')
+        # A plain list: ids can be any JSON value, and an array would turn mixed ones into strings
+        self.image_ids = list(image_ids)
+        self.names = list(names)
+        self.ann_image = np.asarray(ann_image, dtype=np.int32)[order]
+        codes = {}
+        self.category_ids = np.fromiter((codes.setdefault(c, len(codes)) for c in category_ids),
+                                        dtype=np.int64, count=len(category_ids))[order]
+        self.category_keys = list(codes)
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)[order]
+        self.categories = dict(categories)
+        # Segmentations are rare and ragged, so they're kept sparse: annotation index -> segmentation
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        self.segmentations = {int(inverse[i]): seg for i, seg in (segmentations or {}).items()}
+
+        counts = np.bincount(self.ann_image, minlength=len(self.names))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self._index_of = {name: i for i, name in enumerate(self.names)}
+        self._build_category_index()
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.category_ids)
+
+    @classmethod
+    def from_coco(cls, data):
+        images = data.get('images', [])
+        image_ids = [image.get('id') for image in images]
+        names = [image.get('file_name') for image in images]
+        position = {image_id: i for i, image_id in enumerate(image_ids)}
+        categories = {_category(category['id']): category['name'] for category in data.get('categories', [])}
+
+        ann_image, category_ids, bboxes, segmentations = [], [], [], {}
+        for ann in data.get('annotations', []):
+            index = position.get(ann.get('image_id'))
+            if index is None:
+                continue
+            if ann.get('segmentation'):
+                segmentations[len(ann_image)] = ann['segmentation']
+            ann_image.append(index)
+            category_ids.append(_category(ann.get('category_id')))
+            bboxes.append(ann.get('bbox') or [np.nan] * 4)
+        return cls(image_ids, names, ann_image, category_ids, bboxes, categories, segmentations)
+
+    @classmethod
+    def from_extracted(cls, data):
+        image_ids, names, categories = [], [], {}
+        ann_image, category_ids, bboxes, segmentations = [], [], [], {}
+        for index, item in enumerate(data):
+            image_ids.append(item.get('image_id'))
+            names.append(item.get('name'))
+            for ann in item.get('annotations', []):
+                categories.setdefault(_category(ann.get('label')), ann.get('category_name'))
+                if ann.get('segmentation'):
+                    segmentations[len(ann_image)] = ann['segmentation']
+                ann_image.append(index)
+                category_ids.append(_category(ann.get('label')))
+                bboxes.append(ann.get('bbox') or [np.nan] * 4)
+        return cls(image_ids, names, ann_image, category_ids, bboxes, categories, segmentations)
+
+    @classmethod
+    def from_data(cls, data):
+        """Build from either format; returns None if data is neither."""
+        if isinstance(data, dict) and 'categories' in data and 'annotations' in data:
+            return cls.from_coco(data)
+        if isinstance(data, list) and all(isinstance(item, dict) and 'annotations' in item for item in data):
+            return cls.from_extracted(data)
+        return None
+
+    # Indexes
+
+    def _build_category_index(self):
+        self._category_order = np.argsort(self.category_ids, kind='stable')
+        self._category_values, starts = np.unique(self.category_ids[self._category_order], return_index=True)
+        self._category_offsets = np.append(starts, len(self.category_ids))
+
+    def _build_grid(self):
+        # Every box is registered in each GRID_CELL x GRID_CELL cell of its own image it
+        # overlaps. Keys pack (image, cell x, cell y) into one int64 and are kept sorted.
+        # Boxes over more than MAX_GRID_CELLS cells go in _large_boxes (sorted, so by image) instead.
+        valid = np.flatnonzero(np.isfinite(self.bboxes).all(axis=1))
+        x0, y0, w, h = np.clip(self.bboxes[valid], -2.0 ** 40, 2.0 ** 40).T.astype(np.int64)
+        cx0, cy0 = np.clip(x0 // GRID_CELL, 0, 0xffff), np.clip(y0 // GRID_CELL, 0, 0xffff)
+        cx1 = np.clip((x0 + np.maximum(w, 0)) // GRID_CELL, cx0, 0xffff)
+        cy1 = np.clip((y0 + np.maximum(h, 0)) // GRID_CELL, cy0, 0xffff)
+        nx, ny = cx1 - cx0 + 1, cy1 - cy0 + 1
+        per_box = nx * ny
+        large = per_box > MAX_GRID_CELLS
+        self._large_boxes = valid[large]
+        valid, cx0, cy0, nx, ny, per_box = (a[~large] for a in (valid, cx0, cy0, nx, ny, per_box))
+        box = np.repeat(np.arange(len(valid)), per_box)
+        step = np.arange(per_box.sum()) - np.repeat(np.cumsum(per_box) - per_box, per_box)
+        cell_x = cx0[box] + step // ny[box]
+        cell_y = cy0[box] + step % ny[box]
+        keys = (self.ann_image[valid][box].astype(np.int64) << 32) | (cell_x << 16) | cell_y
+        order = np.argsort(keys, kind='stable')
+        self._grid_keys = keys[order]
+        self._grid_boxes = valid[box][order]
+
+    # Queries
+
+    def index_of(self, name):
+        return self._index_of.get(name)
+
+    def image_id(self, index):
+        return self.image_ids[index]
+
+    def image_slice(self, index):
+        return slice(int(self.offsets[index]), int(self.offsets[index + 1]))
+
+    def category_id(self, code):
+        """The original category id behind a code in `category_ids`."""
+        return self.category_keys[int(code)]
+
+    def boxes_of_category(self, category_id):
+        """Annotation indices of every box of one category."""
+        try:
+            category_id = self.category_keys.index(_category(category_id))
+        except ValueError:
+            return np.zeros(0, dtype=np.int64)
+        i = np.searchsorted(self._category_values, category_id)
+        if i == len(self._category_values) or self._category_values[i] != category_id:
+            return np.zeros(0, dtype=np.int64)
+        return self._category_order[self._category_offsets[i]:self._category_offsets[i + 1]]
+
+    def boxes_in_region(self, index, region):
+        """Annotation indices of the boxes of image `index` that intersect region (x, y, width, height)."""
+        rx, ry, rw, rh = region
+        s = self.image_slice(index)
+        cells_x = np.arange(max(int(rx) // GRID_CELL, 0), min(int(rx + rw) // GRID_CELL, 0xffff) + 1, dtype=np.int64)
+        cells_y = np.arange(max(int(ry) // GRID_CELL, 0), min(int(ry + rh) // GRID_CELL, 0xffff) + 1, dtype=np.int64)
+        if len(cells_x) * len(cells_y) > MAX_GRID_CELLS:
+            # A region this large is cheaper to test against every box of the image
+            candidates = np.arange(s.start, s.stop, dtype=np.int64)
+        else:
+            keys = ((np.int64(index) << 32) | (cells_x[:, None] << 16) | cells_y[None, :]).ravel()
+            starts = np.searchsorted(self._grid_keys, keys, side='left')
+            ends = np.searchsorted(self._grid_keys, keys, side='right')
+            lo, hi = np.searchsorted(self._large_boxes, [s.start, s.stop])
+            candidates = np.unique(np.concatenate([self._grid_boxes[a:b] for a, b in zip(starts, ends)]
+                                                  + [self._large_boxes[lo:hi]])).astype(np.int64)
+        x, y, w, h = self.bboxes[candidates].T
+        hit = (x <= rx + rw) & (x + w >= rx) & (y <= ry + rh) & (y + h >= ry)
+        return candidates[hit]
+
+    def annotations(self, indices):
+        """The given annotations as dicts, in the extracted JSON layout the renderer draws from."""
+        result = []
+        for i in np.asarray(indices, dtype=np.int64).tolist():
+            category_id = self.category_id(self.category_ids[i])
+            bbox = self.bboxes[i]
+            ann = {
+                'bbox': [int(v) if v.is_integer() else v for v in bbox.tolist()] if np.isfinite(bbox).all() else None,
+                'label': category_id,
+                'category_name': self.categories.get(category_id)
+            }
+            if i in self.segmentations:
+                ann['segmentation'] = self.segmentations[i]
+            result.append(ann)
+        return result
+
+    def image_annotations(self, index):
+        s = self.image_slice(index)
+        return self.annotations(range(s.start, s.stop))
+
+    # Export
+
+    def to_extracted(self):
+        """The extracted_data_with_labels.json layout."""
+        return [{
+            'image_id': self.image_id(i),
+            'name': self.names[i],
+            'annotations': self.image_annotations(i)
+        } for i in range(len(self.names))]
+
+    def save(self, path):
+        # Ragged and mixed-type fields go in as JSON so the file loads without pickle
+        np.savez_compressed(
+            path, ann_image=self.ann_image, category_ids=self.category_ids, bboxes=self.bboxes,
+            image_ids=np.array(json.dumps(self.image_ids)),
+            names=np.array(json.dumps(self.names)),
+            category_keys=np.array(json.dumps(self.category_keys)),
+            categories=np.array(json.dumps(list(self.categories.items()))),
+            segmentations=np.array(json.dumps(list(self.segmentations.items()))))
+
+    @classmethod
+    def load(cls, path):
+        # The arrays are stored sorted by image already, so the stable sort in __init__ keeps them as they are
+        with np.load(path) as f:
+            keys = [_category(key) for key in json.loads(f['category_keys'].item())]
+            return cls(json.loads(f['image_ids'].item()), json.loads(f['names'].item()), f['ann_image'],
+                       [keys[code] for code in f['category_ids'].tolist()], f['bboxes'],
+                       [(_category(key), name) for key, name in json.loads(f['categories'].item())],
+                       dict(json.loads(f['segmentations'].item())))
+
+
+def _category(value):
+    # Missing category ids are stored as -1; ids that can't be dict keys (lists, objects) as their JSON
+    if value is None:
+        return -1
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, sort_keys=True)
+    return value
+
@@ -1,7 +1,31 @@
+import importlib
+import sys
+import time
 import streamlit as st
-from converter.cnv import main as cnv_main
-from annotation.annotation import annotation_main  # Import the annotation function
-from image_zoom.app import main as zoom_main
+import profiling
+
+# Each page's module and entry point. Pages are imported the first time they are opened, so the
+# home page never pulls in cv2, pydicom or the image libraries.
+PAGES = {
+    'converter': ('converter.cnv', 'main'),
+    'annotations': ('annotation.annotation', 'annotation_main'),
+    'zooming': ('image_zoom.app', 'main'),
+}
+
+@st.cache_resource
+def import_report():
+    # Process-wide: page -> (seconds, modules imported) of its first import
+    return {}
+
+@st.cache_resource
+def load_page(page):
+    """Import a page's module once per process and return its entry point."""
+    module_name, function_name = PAGES[page]
+    modules_before = len(sys.modules)
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    import_report()[page] = (time.perf_counter() - start, len(sys.modules) - modules_before)
+    return getattr(module, function_name)
 
 # Set page configuration
 st.set_page_config(page_title="DiCom Pixel", layout="centered")
@@ -81,12 +105,20 @@ with col4:
     if st.button('Zooming'):
         st.session_state.page = 'zooming'
 
-# Navigation logic
-if st.session_state.page == 'converter':
-    cnv_main()
-elif st.session_state.page == 'annotations':
-    annotation_main()
-elif st.session_state.page == 'metadata':
-    st.write("Metadata Page")
-elif st.session_state.page == 'zooming':
-    zoom_main()
+# Navigation logic, timed per rerun when DICOM_PIXEL_PROFILE is set
+with profiling.rerun():
+    if st.session_state.page in PAGES:
+        load_page(st.session_state.page)()
+    elif st.session_state.page == 'metadata':
+        st.write("Metadata Page")
+
+# Import cost of the pages loaded so far in this process
+report = import_report()
+if report:
+    with st.expander('Page import times'):
+        for page, (seconds, modules) in report.items():
+            st.write(f'{page}: {seconds * 1000:.0f} ms, {modules} modules')
+
+# Hidden admin view with the profiling aggregates
+if profiling.ENABLED and st.query_params.get('admin') == '1':
+    profiling.admin_view()
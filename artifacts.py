@@ -0,0 +1,341 @@
+import copy
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import streamlit as st
+from annotation.sources import decode_image
+from workspace import QuotaExceeded, current_workspace
+
+# Bytes an artifact store keeps in memory before spilling to the session workspace
+MAX_MEMORY_BYTES = int(os.environ.get('DICOM_PIXEL_ARTIFACT_MEMORY', 256 * 1024 * 1024))
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+PAGE_LABELS = {'converter': 'Converter', 'annotations': 'Annotate', 'zooming': 'Zoom'}
+
+
+def value_nbytes(value):
+    """Rough in-memory size of a decoded value: arrays, PIL images, DICOM datasets and tuples of them."""
+    if value is None:
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sum(value_nbytes(v) for v in value)
+    if hasattr(value, 'getbands'):
+        return value.size[0] * value.size[1] * len(value.getbands())
+    pixel_data = getattr(value, 'PixelData', None) if hasattr(value, 'dir') else None
+    return len(pixel_data) if pixel_data is not None else 0
+
+
+class Artifact:
+    def __init__(self, key, name, data=None, path=None):
+        self.key = key
+        self.name = name
+        self.data = data
+        self.size = len(data) if data is not None else os.path.getsize(path)
+        self.path = path
+        self.decoded = {}
+        self.decoded_bytes = 0
+        self.refs = 1
+
+    def memory(self):
+        return (self.size if self.data is not None else 0) + self.decoded_bytes
+
+
+class ArtifactStore:
+    """Files one page produced, kept for the other pages of the same session.
+
+    Each artifact holds its encoded bytes plus decoded forms, one per kind of
+    consumer, so opening it elsewhere reads and decodes nothing again.
+    Outputs that are files in the workspace already are taken over with
+    put_file() and stay on disk from the start.
+    Artifacts are reference counted: put(), put_file() and acquire() take a reference,
+    release() drops one, and an artifact goes away with its last reference.
+    The bytes held in memory are counted as they come and go. Past max_bytes,
+    the least recently used artifacts are spilled to the artifacts/ directory
+    of the session workspace (within its quota): their bytes are written out
+    and their decoded values are dropped, to be decoded again on next use.
+    When the quota is full too, only decoded values are dropped, and what
+    still doesn't fit is refused: put() raises QuotaExceeded and decoded()
+    hands its value over without keeping it.
+    """
+
+    def __init__(self, workspace, max_bytes=MAX_MEMORY_BYTES):
+        self.workspace = workspace
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # Least recently used first
+        self._artifacts = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        artifact = self._artifacts.get(key)
+        return artifact is not None and (artifact.data is not None or os.path.exists(artifact.path))
+
+    def put(self, name, data):
+        """Add encoded bytes under a content key and take a reference to them."""
+        data = bytes(data)
+        key = hashlib.sha1(data).hexdigest()[:16]
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            if artifact is not None and key in self:
+                artifact.refs += 1
+                artifact.name = name
+                self._artifacts.move_to_end(key)
+                return key
+            if artifact is not None:
+                # Its spilled file went with a workspace cleanup
+                self._remove(artifact)
+            artifact = Artifact(key, name, data)
+            self._artifacts[key] = artifact
+            self.nbytes += artifact.size
+            if not self._fit():
+                self._remove(artifact)
+                raise QuotaExceeded(f'There is no room left to keep {name} for the other pages. '
+                                    'Clean up earlier files and try again.')
+        return key
+
+    def put_file(self, name, path, kind):
+        """Take over a file written under kind in the workspace, and a reference to it.
+
+        The file is moved into artifacts/ (its quota charge with it) and never read into memory.
+        """
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+                digest.update(chunk)
+        key = digest.hexdigest()[:16]
+        size = os.path.getsize(path)
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            if artifact is not None and key in self:
+                artifact.refs += 1
+                artifact.name = name
+                self._artifacts.move_to_end(key)
+                self.workspace.remove(path, kind)
+                return key
+            if artifact is not None:
+                self._remove(artifact)
+            target = self.workspace.path('artifacts', key)
+            os.replace(path, target)
+            self.workspace.transfer(size, kind, 'artifacts')
+            self._artifacts[key] = Artifact(key, name, path=target)
+        return key
+
+    def acquire(self, key):
+        with self._lock:
+            self._artifacts[key].refs += 1
+
+    def release(self, key):
+        with self._lock:
+            artifact = self._artifacts.get(key)
+            if artifact is None:
+                return
+            artifact.refs -= 1
+            if artifact.refs <= 0:
+                self._remove(artifact)
+
+    def name(self, key):
+        return self._artifacts[key].name
+
+    def read_bytes(self, key):
+        with self._lock:
+            artifact = self._touch(key)
+            if artifact.data is not None:
+                return artifact.data
+            with open(artifact.path, 'rb') as f:
+                return f.read()
+
+    def decoded(self, key, kind, decode):
+        """The decoded form of an artifact for one kind of consumer, decoding it on first use only."""
+        with self._lock:
+            artifact = self._touch(key)
+            if kind in artifact.decoded:
+                return artifact.decoded[kind]
+        value = decode(self.read_bytes(key))
+        with self._lock:
+            if self._artifacts.get(key) is not artifact or kind in artifact.decoded:
+                return artifact.decoded.get(kind, value)
+            nbytes = value_nbytes(value)
+            artifact.decoded[kind] = value
+            artifact.decoded_bytes += nbytes
+            self.nbytes += nbytes
+            if not self._fit() and kind in artifact.decoded:
+                self._drop_decoded(artifact)
+        return value
+
+    def memory(self):
+        return self.nbytes
+
+    def clear(self):
+        with self._lock:
+            for artifact in list(self._artifacts.values()):
+                self._remove(artifact)
+
+    def _touch(self, key):
+        artifact = self._artifacts.get(key)
+        if artifact is None or key not in self:
+            raise KeyError(key)
+        self._artifacts.move_to_end(key)
+        return artifact
+
+    def _fit(self):
+        """Spill least recently used artifacts until the memory cap holds; False if it can't be made to."""
+        disk_full = False
+        for artifact in list(self._artifacts.values()):
+            if self.nbytes <= self.max_bytes:
+                break
+            if artifact.data is not None and not disk_full:
+                try:
+                    self._spill(artifact)
+                except QuotaExceeded:
+                    # Out of disk quota too: keep the bytes, drop what can be decoded again
+                    disk_full = True
+            self._drop_decoded(artifact)
+        return self.nbytes <= self.max_bytes
+
+    def _spill(self, artifact):
+        self.workspace.reserve(artifact.size, 'artifacts')
+        artifact.path = self.workspace.path('artifacts', artifact.key)
+        with open(artifact.path, 'wb') as f:
+            f.write(artifact.data)
+        artifact.data = None
+        self.nbytes -= artifact.size
+
+    def _drop_decoded(self, artifact):
+        artifact.decoded.clear()
+        self.nbytes -= artifact.decoded_bytes
+        artifact.decoded_bytes = 0
+
+    def _remove(self, artifact):
+        self._artifacts.pop(artifact.key, None)
+        self.nbytes -= artifact.memory()
+        if artifact.path is not None and os.path.exists(artifact.path):
+            os.remove(artifact.path)
+            self.workspace.refund(artifact.size, 'artifacts')
+
+
+class ArtifactImageSource:
+    """Artifacts as an ImageLibrary source, looked up by file name (or base name).
+
+    Names are forgotten once their artifact has been released from the store.
+    """
+
+    def __init__(self, store, converter):
+        self.store = store
+        self.converter = converter
+        self._keys = {}
+
+    def add(self, name, key):
+        self._keys[name] = key
+
+    def _key(self, name):
+        self._keys = {n: k for n, k in self._keys.items() if k in self.store}
+        key = self._keys.get(name)
+        if key is None:
+            matches = [k for n, k in self._keys.items() if os.path.basename(n) == os.path.basename(str(name))]
+            key = matches[0] if len(matches) == 1 else None
+        return key
+
+    def has(self, name):
+        return self._key(name) is not None
+
+    def read_bytes(self, name):
+        return self.store.read_bytes(self._key(name))
+
+    def fingerprint(self, name):
+        return f'artifact:{self._key(name)}'
+
+    def load(self, name):
+        # Rendering draws into the image and adds an overlay to the dataset, so it gets copies
+        image, dataset = self.store.decoded(self._key(name), 'annotate',
+                                            lambda data: decode_image(name, data, self.converter))
+        return image.copy(), copy.deepcopy(dataset) if dataset is not None else None
+
+
+def get_artifact_store():
+    """This session's artifact store."""
+    if 'artifact_store' not in st.session_state:
+        st.session_state['artifact_store'] = ArtifactStore(current_workspace())
+    return st.session_state['artifact_store']
+
+
+def publish(owner, outputs):
+    """Replace the artifacts a page published before with (name, data) outputs."""
+    store = get_artifact_store()
+    _replace_published(owner, [(name, lambda name=name, data=data: store.put(name, data)) for name, data in outputs])
+
+
+def publish_files(owner, files):
+    """Replace the artifacts a page published before with (name, path, kind) files of the session workspace.
+
+    The files are moved into the artifact store, so they must not be needed where they are afterwards.
+    """
+    store = get_artifact_store()
+    _replace_published(owner, [(name, lambda name=name, path=path, kind=kind: store.put_file(name, path, kind))
+                               for name, path, kind in files])
+
+
+def _replace_published(owner, puts):
+    store = get_artifact_store()
+    # New references first, so outputs that didn't change keep what was decoded from them
+    keys, refused = [], []
+    for name, put in puts:
+        try:
+            keys.append(put())
+        except QuotaExceeded:
+            refused.append(name)
+    if refused:
+        st.warning(f'Out of space: {len(refused)} result(s) can\'t be opened on the other pages '
+                   f'({", ".join(refused[:3])}{", ..." if len(refused) > 3 else ""}).')
+    for key in st.session_state.get(f'artifacts_{owner}', []):
+        store.release(key)
+    st.session_state[f'artifacts_{owner}'] = keys
+
+
+def _open(key, page):
+    # The target page gets its own reference, handed over by take_opened
+    get_artifact_store().acquire(key)
+    previous = st.session_state.get('open_request')
+    if previous is not None:
+        get_artifact_store().release(previous[1])
+    st.session_state['open_request'] = (page, key)
+    st.session_state.page = page
+
+
+def take_opened(page):
+    """The key of an artifact just opened on this page, or None. The caller owns one reference to it."""
+    request = st.session_state.get('open_request')
+    if request is None or request[0] != page:
+        return None
+    del st.session_state['open_request']
+    return request[1]
+
+
+def hold(page, key):
+    """Make key the artifact a page shows, releasing the one it showed before."""
+    store = get_artifact_store()
+    previous = st.session_state.get(f'holding_{page}')
+    if previous is not None and previous != key:
+        store.release(previous)
+    elif previous == key:
+        store.release(key)
+    st.session_state[f'holding_{page}'] = key
+
+
+def artifact_panel(owner, pages):
+    """One-click buttons that open an artifact the page published on other pages."""
+    store = get_artifact_store()
+    keys = [key for key in st.session_state.get(f'artifacts_{owner}', []) if key in store]
+    if not keys:
+        return
+    key = keys[0]
+    if len(keys) > 1:
+        key = st.selectbox('Result to open', keys, format_func=store.name, key=f'artifact_panel_{owner}')
+    columns = st.columns(len(pages))
+    for column, page in zip(columns, pages):
+        column.button(f'Open {store.name(key)} in {PAGE_LABELS[page]}', key=f'open_{owner}_{page}',
+                      on_click=_open, args=(key, page))
@@ -3,46 +3,115 @@ import os
 import shutil
 import zipfile
 from converter.scriptt import DICOMConverter  # Assuming your DICOMConverter class is in DICOMConverter.py
+from converter.deid import DeidProfile, new_salt
+from workspace import QuotaExceeded, current_workspace
+from artifacts import artifact_panel, publish_files
+from profiling import section
+
+@st.cache_resource
+def get_converter():
+    """One DICOMConverter per process, shared by every session and page.
+
+    It has no output directory of its own: every conversion writes to the session's workspace.
+    """
+    return DICOMConverter(output_dir=None)
+
+def extract_members(workspace, zip_path):
+    """Unpack a ZIP into the workspace temp directory, one member at a time; returns (name, path, kind) files."""
+    files = []
+    with zipfile.ZipFile(zip_path) as zipf:
+        for index, info in enumerate(info for info in zipf.infolist() if not info.is_dir()):
+            workspace.reserve(info.file_size, "temp")
+            path = workspace.path("temp", f"member-{index}")
+            with zipf.open(info) as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            files.append((os.path.basename(info.filename), path, "temp"))
+    return files
 
 def main():
     # Initialize the converter
-    converter = DICOMConverter()
+    converter = get_converter()
 
     # Streamlit frontend
     st.title("DICOM Conversion Tool")
 
     # File upload option
     uploaded_files = st.file_uploader("Upload DICOM files or images", type=["dcm", "dicom", "jpg", "jpeg", "png"], accept_multiple_files=True)
-    conversion_type = st.selectbox("Choose Conversion Type", ("DICOM to PNG", "DICOM to JPEG", "PNG to DICOM", "JPEG to DICOM"))
+    conversion_type = st.selectbox("Choose Conversion Type", ("DICOM to PNG", "DICOM to JPEG", "PNG to DICOM", "JPEG to DICOM", "De-identify DICOM"))
+
+    # De-identification options: the salt keeps new UIDs the same across batches of one study.
+    # Each session starts with a random one, shown so it can be noted down and reused.
+    if conversion_type == "De-identify DICOM":
+        if "deid_salt" not in st.session_state:
+            st.session_state.deid_salt = new_salt()
+        salt = st.text_input("UID salt (keep it secret, reuse it for every part of a study)", st.session_state.deid_salt)
+        st.session_state.deid_salt = salt
+        remove_private = st.checkbox("Remove private tags", value=True)
+        profile_file = st.file_uploader("Profile overrides (JSON: keyword -> remove, keep, uid or [\"replace\", value])", type="json")
+
+    # One set of intensity bounds per series instead of stretching every slice on its own
+    consistent_scaling = conversion_type in ("DICOM to PNG", "DICOM to JPEG") and st.checkbox(
+        "Consistent brightness across each series (0.5-99.5 percentile)")
 
-    # Temporary directory to store uploaded files
-    temp_dir = "temp"
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
+    # This session's own scratch directories
+    workspace = current_workspace()
+    temp_dir = workspace.path("temp")
+    output_dir = workspace.path("output")
 
     if uploaded_files:
         st.write(f"{len(uploaded_files)} files uploaded.")
 
-        # Save uploaded files to temporary directory
-        file_paths = []
-        for uploaded_file in uploaded_files:
-            file_path = os.path.join(temp_dir, uploaded_file.name)
-            with open(file_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            file_paths.append(file_path)
-
         # Perform conversion
         if st.button("Convert"):
+            try:
+                # Uploads and their converted copies both count against the session quota
+                upload_size = sum(uploaded_file.size for uploaded_file in uploaded_files)
+                workspace.reserve(upload_size, "temp")
+                workspace.reserve(upload_size, "output")
+            except QuotaExceeded as e:
+                st.error(str(e))
+                return
+
+            # Save uploaded files to temporary directory
+            file_paths = []
+            with section("converter.save_uploads"):
+                for uploaded_file in uploaded_files:
+                    file_path = os.path.join(temp_dir, os.path.basename(uploaded_file.name))
+                    with open(file_path, "wb") as f:
+                        f.write(uploaded_file.getbuffer())
+                    file_paths.append(file_path)
+
             output_files = []
-            for file_path in file_paths:
-                if conversion_type == "DICOM to PNG":
-                    output_files.append(converter.dicom_to_png(file_path))
-                elif conversion_type == "DICOM to JPEG":
-                    output_files.append(converter.dicom_to_jpeg(file_path))
-                elif conversion_type == "PNG to DICOM":
-                    output_files.append(converter.png_to_dicom(file_path))
-                elif conversion_type == "JPEG to DICOM":
-                    output_files.append(converter.jpg_to_dicom(file_path))
+            with section("converter.convert"):
+                if conversion_type == "De-identify DICOM":
+                    # The whole upload at once, so the files are rewritten in parallel
+                    try:
+                        if profile_file is not None:
+                            profile = DeidProfile.from_json(profile_file.getvalue(), salt=salt, remove_private=remove_private)
+                        else:
+                            profile = DeidProfile(salt=salt, remove_private=remove_private)
+                        output_file, errors = converter.deidentify(temp_dir, output_dir, profile)
+                        output_files.append(output_file)
+                        if errors:
+                            # Don't let a partial set pass for a complete one
+                            st.warning(f"{len(errors)} file(s) could not be de-identified and are missing from the "
+                                       "result:\n\n" + "\n\n".join(error.replace(temp_dir + os.sep, "") for error in errors[:20]))
+                    except ValueError as e:
+                        st.error(str(e))
+                        workspace.clear("temp")
+                        return
+                else:
+                    # A streaming pass over all uploads first, so slices of a series share their bounds
+                    bounds = converter.intensity_bounds(file_paths) if consistent_scaling else None
+                    for file_path in file_paths:
+                        if conversion_type == "DICOM to PNG":
+                            output_files.append(converter.dicom_to_png(file_path, output_dir, bounds))
+                        elif conversion_type == "DICOM to JPEG":
+                            output_files.append(converter.dicom_to_jpeg(file_path, output_dir, bounds))
+                        elif conversion_type == "PNG to DICOM":
+                            output_files.append(converter.png_to_dicom(file_path, output_dir))
+                        elif conversion_type == "JPEG to DICOM":
+                            output_files.append(converter.jpg_to_dicom(file_path, output_dir))
 
             # If multiple files were converted, create a zip file
             if len(output_files) > 1:
@@ -59,15 +128,32 @@ def main():
                 with open(output_files[0], "rb") as f:
                     st.download_button(label="Download Result", data=f, file_name=os.path.basename(output_files[0]))
 
-            # Clean up temporary files
-            shutil.rmtree(temp_dir)
-            os.makedirs(temp_dir)  # Recreate the temp directory for the next use
+            # Hand the results to the other pages before the output directory goes away. They are
+            # moved into the artifact store as files, never read into memory.
+            results = []
+            try:
+                for output_file in output_files:
+                    if output_file.endswith(".zip"):
+                        # De-identifying several files returns them zipped (_create_zip_or_return_single)
+                        results.extend(extract_members(workspace, output_file))
+                    else:
+                        results.append((os.path.basename(output_file), output_file, "output"))
+            except QuotaExceeded as e:
+                st.warning(str(e))
+            publish_files("converter", results)
+
+            # Clean up temporary files. The download buttons hold the results already.
+            workspace.clear("temp")
+            workspace.clear("output")
+
+    # Open a result on another page, decoded once and without writing it anywhere
+    artifact_panel("converter", ["zooming", "annotations"])
 
     # Final cleanup when the app stops
     if st.button("Clean Up"):
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            st.write("Temporary files cleaned up.")
+        workspace.clear("temp")
+        workspace.clear("output")
+        st.write("Temporary files cleaned up.")
 
 # Call the main function when this script is run
 if __name__ == "__main__":
@@ -0,0 +1,297 @@
+import json
+import os
+import secrets
+import pydicom
+from pydicom.dataelem import RawDataElement
+from pydicom.filebase import DicomFileLike
+from pydicom.filereader import read_dataset
+from pydicom.filewriter import write_dataset
+from pydicom.uid import UID, UID_dictionary, DeflatedExplicitVRLittleEndian, generate_uid
+from converter.pool import shared_pool
+
+ACTIONS = ('remove', 'replace', 'keep', 'uid')
+
+# Keyword -> action. 'replace' takes the new value: ['replace', 'Anonymous']. Elements not listed are
+# kept, except that every instance UID is remapped (see DeidProfile.remap_uids).
+DEFAULT_PROFILE = {
+    'PatientName': ['replace', 'Anonymous'],
+    'PatientID': ['replace', 'ANON'],
+    'PatientBirthDate': ['replace', ''],
+    'PatientBirthTime': 'remove',
+    'PatientAddress': 'remove',
+    'PatientTelephoneNumbers': 'remove',
+    'PatientMotherBirthName': 'remove',
+    'OtherPatientIDs': 'remove',
+    'OtherPatientIDsSequence': 'remove',
+    'OtherPatientNames': 'remove',
+    'MilitaryRank': 'remove',
+    'EthnicGroup': 'remove',
+    'PatientComments': 'remove',
+    'AccessionNumber': ['replace', ''],
+    'StudyID': ['replace', ''],
+    'ReferringPhysicianName': ['replace', ''],
+    'PerformingPhysicianName': 'remove',
+    'OperatorsName': 'remove',
+    'PhysiciansOfRecord': 'remove',
+    'NameOfPhysiciansReadingStudy': 'remove',
+    'RequestingPhysician': 'remove',
+    'InstitutionName': 'remove',
+    'InstitutionAddress': 'remove',
+    'InstitutionalDepartmentName': 'remove',
+    'StationName': 'remove',
+    'DeviceSerialNumber': 'remove',
+    'RequestAttributesSequence': 'remove',
+    'StudyInstanceUID': 'uid',
+    'SeriesInstanceUID': 'uid',
+    'SOPInstanceUID': 'uid',
+    'FrameOfReferenceUID': 'uid',
+    # Signatures no longer match a rewritten file, and padding carries nothing
+    'DigitalSignaturesSequence': 'remove',
+    'DataSetTrailingPadding': 'remove',
+}
+
+# Tags the pixel data may be stored under; these elements are copied as is
+PIXEL_TAGS = (0x7FE00010, 0x7FE00008, 0x7FE00009)
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class DeidProfile:
+    """What to do with each header element when de-identifying.
+
+    actions maps keywords (or 'GGGGEEEE' hex tags) to 'remove', 'keep', 'uid'
+    or ['replace', value]. UIDs are remapped with generate_uid seeded by salt
+    and the original UID, so the same study gets the same new UIDs in every
+    file and every worker process. With remap_uids, every UI element that is
+    not a well-known DICOM UID (SOP classes, transfer syntaxes) is remapped,
+    which keeps references between files of a study consistent too.
+
+    Without a secret salt anyone could recompute the mapping from the original
+    UIDs, so an empty salt is refused and salt=None picks a random one.
+    """
+
+    def __init__(self, actions=None, salt=None, remove_private=True, remap_uids=True):
+        self.actions = {}
+        for name, action in (DEFAULT_PROFILE if actions is None else actions).items():
+            self.actions[self._tag(name)] = self._action(name, action)
+        if salt is None:
+            salt = new_salt()
+        if not salt:
+            raise ValueError('De-identification needs a non-empty UID salt')
+        self.salt = salt
+        self.remove_private = remove_private
+        self.remap_uids = remap_uids
+
+    @classmethod
+    def from_json(cls, text, **kwargs):
+        """A profile from JSON: the default profile updated with the given actions."""
+        actions = dict(DEFAULT_PROFILE)
+        actions.update(json.loads(text))
+        return cls(actions, **kwargs)
+
+    @staticmethod
+    def _tag(name):
+        tag = pydicom.datadict.tag_for_keyword(name)
+        if tag is None:
+            try:
+                tag = int(name.replace(',', '').strip('()'), 16)
+            except ValueError:
+                raise ValueError(f'Unknown DICOM keyword in de-identification profile: {name}')
+        return tag
+
+    @staticmethod
+    def _action(name, action):
+        if isinstance(action, str):
+            action = [action]
+        if not action or action[0] not in ACTIONS or (action[0] == 'replace') != (len(action) == 2):
+            raise ValueError(f'Invalid action for {name}: {action!r}')
+        return tuple(action)
+
+    def new_uid(self, uid):
+        return generate_uid(entropy_srcs=[self.salt, str(uid)])
+
+    def filter(self, dataset):
+        """Apply the element actions to a dataset in place, sequences included."""
+        dataset.walk(self._element_callback)
+        return dataset
+
+    def apply(self, dataset):
+        """De-identify a dataset (and its file meta) in place."""
+        self.filter(dataset)
+        file_meta = getattr(dataset, 'file_meta', None)
+        if file_meta is not None and 'MediaStorageSOPInstanceUID' in file_meta:
+            file_meta.MediaStorageSOPInstanceUID = dataset.get(
+                'SOPInstanceUID', self.new_uid(file_meta.MediaStorageSOPInstanceUID))
+        dataset.PatientIdentityRemoved = 'YES'
+        dataset.DeidentificationMethod = 'DiCom Pixel de-identification profile'
+        return dataset
+
+    def _element_callback(self, dataset, element):
+        if self.remove_private and element.tag.is_private:
+            del dataset[element.tag]
+            return
+        action = self.actions.get(element.tag)
+        if action is None:
+            action = ('uid',) if self.remap_uids and self._is_instance_uid(element) else ('keep',)
+        if action[0] == 'remove':
+            del dataset[element.tag]
+        elif action[0] == 'replace':
+            element.value = action[1]
+        elif action[0] == 'uid' and element.value:
+            if element.VM > 1:
+                element.value = [self.new_uid(uid) for uid in element.value]
+            else:
+                element.value = self.new_uid(element.value)
+
+    @staticmethod
+    def _is_instance_uid(element):
+        if element.VR != 'UI' or not element.value:
+            return False
+        values = element.value if element.VM > 1 else [element.value]
+        return not any(str(value) in UID_dictionary for value in values)
+
+
+def new_salt():
+    """A random UID salt."""
+    return secrets.token_hex(16)
+
+
+def _read_tag(fp, little_endian):
+    # The tag at the current position (which is left unchanged), or None at the end of the file
+    start = fp.tell()
+    raw = fp.read(4)
+    fp.seek(start)
+    if len(raw) < 4:
+        return None
+    order = 'little' if little_endian else 'big'
+    return int.from_bytes(raw[:2], order) << 16 | int.from_bytes(raw[2:], order)
+
+
+def _element_end(fp, implicit_vr, little_endian, size):
+    """Where the element at the current position ends, walking encapsulated fragments without reading them."""
+    order = 'little' if little_endian else 'big'
+    start = fp.tell()
+    if implicit_vr:
+        header = fp.read(8)
+        length = int.from_bytes(header[4:8], order)
+    else:
+        # Pixel data VRs (OB, OW, OF, OD, OL) have 2 reserved bytes and a 4 byte length
+        header = fp.read(12)
+        length = int.from_bytes(header[8:12], order)
+    end = fp.tell() + length
+    if length == 0xFFFFFFFF:
+        # Encapsulated: items up to the sequence delimiter (FFFE,E0DD)
+        while True:
+            item = fp.read(8)
+            if len(item) < 8:
+                raise ValueError('File ends inside its pixel data')
+            tag = int.from_bytes(item[:2], order) << 16 | int.from_bytes(item[2:4], order)
+            fp.seek(int.from_bytes(item[4:8], order), os.SEEK_CUR)
+            if tag == 0xFFFEE0DD:
+                end = fp.tell()
+                break
+    fp.seek(start)
+    if len(header) < (8 if implicit_vr else 12) or end > size:
+        raise ValueError('File ends inside its pixel data')
+    return end
+
+
+def _check_complete(dataset, size=None):
+    # pydicom reads a truncated file without complaint, leaving the last value short
+    # or, when the cut falls between elements, just stopping early
+    meta_length = getattr(dataset, 'file_meta', {}).get('FileMetaInformationGroupLength')
+    if size is not None and meta_length is not None and size < 132 + 12 + meta_length:
+        raise ValueError('File is truncated in its file meta information')
+    if size is not None and not len(dataset):
+        raise ValueError('File has no data set')
+    for tag in dataset.keys():
+        element = dataset.get_item(tag)
+        if isinstance(element, RawDataElement) and element.length != 0xFFFFFFFF and \
+                len(element.value or b'') < element.length:
+            raise ValueError(f'File is truncated at {tag}')
+
+
+def deidentify_file(src, dst, profile):
+    """Write a de-identified copy of one DICOM file.
+
+    Only the header is parsed and rewritten: the file is read up to the pixel
+    data, and the pixel data elements are copied byte for byte, so compressed
+    pixel data is never decoded. Elements after the pixel data (private groups,
+    signatures, padding) are parsed and go through the profile like the
+    header. Deflated files can't be split like that and are rewritten in full.
+    Truncated files raise ValueError. Returns dst.
+    """
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    size = os.path.getsize(src)
+    with open(src, 'rb') as fp:
+        dataset = pydicom.dcmread(fp, stop_before_pixels=True)
+        _check_complete(dataset, size)
+        transfer_syntax = dataset.file_meta.get('TransferSyntaxUID')
+        implicit_vr, little_endian = dataset.original_encoding if None not in dataset.original_encoding else (False, True)
+        tag = _read_tag(fp, little_endian)
+        if transfer_syntax == DeflatedExplicitVRLittleEndian or transfer_syntax is None or (
+                tag is not None and tag not in PIXEL_TAGS):
+            fp.seek(0)
+            dataset = pydicom.dcmread(fp)
+            _check_complete(dataset)
+            profile.apply(dataset)
+            pydicom.dcmwrite(dst, dataset, enforce_file_format=False)
+            return dst
+        sop_class = dataset.get('SOPClassUID') or dataset.file_meta.get('MediaStorageSOPClassUID', '')
+        if tag is None and ('Rows' in dataset or 'Image' in UID(sop_class).name):
+            raise ValueError('File ends before its pixel data')
+        pixel_start = fp.tell()
+        while tag in PIXEL_TAGS:
+            fp.seek(_element_end(fp, implicit_vr, little_endian, size))
+            tag = _read_tag(fp, little_endian)
+        pixel_end = fp.tell()
+        trailing = None
+        if tag is not None:
+            trailing = read_dataset(fp, implicit_vr, little_endian)
+            _check_complete(trailing)
+            profile.filter(trailing)
+
+        profile.apply(dataset)
+        with open(dst, 'wb') as out:
+            pydicom.dcmwrite(out, dataset, enforce_file_format=False)
+            fp.seek(pixel_start)
+            remaining = pixel_end - pixel_start
+            while remaining:
+                chunk = fp.read(min(COPY_BUFFER_SIZE, remaining))
+                out.write(chunk)
+                remaining -= len(chunk)
+            if trailing:
+                trailing_fp = DicomFileLike(out)
+                trailing_fp.is_implicit_VR, trailing_fp.is_little_endian = implicit_vr, little_endian
+                write_dataset(trailing_fp, trailing)
+    return dst
+
+
+def _deidentify_task(args):
+    src, dst, profile = args
+    try:
+        return deidentify_file(src, dst, profile), None
+    except Exception as e:
+        # Any failure is reported for its file, so one bad file doesn't abort the whole pool.map
+        return None, f'{src}: {e}'
+
+
+def deidentify_directory(src_dir, dst_dir, profile, pool=None):
+    """De-identify every DICOM file under src_dir into the same layout under dst_dir, in parallel.
+
+    The files are spread over pool, the shared process pool by default.
+
+    Returns (written paths, errors); files that aren't DICOM end up in errors.
+    """
+    tasks = []
+    for dirpath, _, filenames in os.walk(src_dir):
+        for filename in sorted(filenames):
+            src = os.path.join(dirpath, filename)
+            tasks.append((src, os.path.join(dst_dir, os.path.relpath(src, src_dir)), profile))
+    if len(tasks) <= 1:
+        results = [_deidentify_task(task) for task in tasks]
+    else:
+        pool = pool or shared_pool()
+        results = list(pool.map(_deidentify_task, tasks, chunksize=max(1, len(tasks) // 64)))
+    written = [path for path, _ in results if path is not None]
+    errors = [error for _, error in results if error is not None]
+    return written, errors
@@ -0,0 +1,97 @@
+import numpy as np
+import pydicom
+from converter.pool import PROCESS_WORKERS, shared_pool
+
+# One bin per stored value over the range of signed and unsigned 16-bit pixels
+HIST_MIN = -32768
+HIST_MAX = 65536
+LOW_PERCENTILE = 0.5
+HIGH_PERCENTILE = 99.5
+
+
+class IntensityHistogram:
+    """Counts of stored pixel values in fixed unit bins.
+
+    Histograms of different slices (or of different workers) are merged by
+    adding their counts, so a series is summarized one slice at a time and
+    never held in memory as a volume. Only integer values in [HIST_MIN,
+    HIST_MAX) fit the bins: float or out-of-range pixel data isn't counted
+    and marks the histogram inexact instead.
+    """
+
+    def __init__(self, counts=None, exact=True):
+        self.counts = np.zeros(HIST_MAX - HIST_MIN, dtype=np.int64) if counts is None else counts
+        self.exact = exact
+
+    def add(self, pixel_array):
+        values = np.asarray(pixel_array).ravel()
+        if values.dtype.kind not in 'biu' or (values.size and (values.min() < HIST_MIN or values.max() >= HIST_MAX)):
+            self.exact = False
+            return self
+        self.counts += np.bincount(values.astype(np.int64) - HIST_MIN, minlength=len(self.counts))
+        return self
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.exact = self.exact and other.exact
+        return self
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def percentile(self, q):
+        """The smallest value with at least q percent of the counts at or below it."""
+        cumulative = np.cumsum(self.counts)
+        index = int(np.searchsorted(cumulative, cumulative[-1] * q / 100.0))
+        return min(index, len(self.counts) - 1) + HIST_MIN
+
+    def bounds(self, low=LOW_PERCENTILE, high=HIGH_PERCENTILE):
+        """(low, high) intensity bounds; high is always above low."""
+        lower, upper = self.percentile(low), self.percentile(high)
+        return lower, max(upper, lower + 1)
+
+
+def series_key(dataset, path):
+    # Files without a SeriesInstanceUID are a series of their own
+    return str(dataset.get('SeriesInstanceUID') or path)
+
+
+def _collect_histograms(paths):
+    # Worker: one slice decoded at a time, merged into a histogram per series.
+    # Only the bins in use (and whether every slice fit them) are sent back to the parent process.
+    histograms = {}
+    for path in paths:
+        try:
+            dataset = pydicom.dcmread(path)
+            pixel_array = dataset.pixel_array
+        except Exception:
+            # Unreadable files are reported by the conversion itself
+            continue
+        histograms.setdefault(series_key(dataset, path), IntensityHistogram()).add(pixel_array)
+    return {key: (np.flatnonzero(h.counts), h.counts[h.counts > 0], h.exact) for key, h in histograms.items()}
+
+
+def series_histograms(paths, pool=None):
+    """Histograms of the given DICOM files, merged per series, collected on pool (the shared process pool by default)."""
+    paths = list(paths)
+    chunks = [paths[i::PROCESS_WORKERS * 4] for i in range(min(len(paths), PROCESS_WORKERS * 4))]
+    if len(chunks) <= 1:
+        results = [_collect_histograms(chunk) for chunk in chunks]
+    else:
+        results = list((pool or shared_pool()).map(_collect_histograms, chunks))
+    histograms = {}
+    for result in results:
+        for key, (bins, counts, exact) in result.items():
+            histogram = histograms.setdefault(key, IntensityHistogram())
+            histogram.counts[bins] += counts
+            histogram.exact = histogram.exact and exact
+    return histograms
+
+
+def series_bounds(paths, low=LOW_PERCENTILE, high=HIGH_PERCENTILE, pool=None):
+    """Robust (low, high) intensity bounds per SeriesInstanceUID, shared by every slice of a series.
+
+    Series with float or out-of-range pixel data are left out, so their slices keep per-image min-max scaling.
+    """
+    return {key: histogram.bounds(low, high)
+            for key, histogram in series_histograms(paths, pool).items() if histogram.exact and histogram.total()}
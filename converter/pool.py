@@ -0,0 +1,28 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Worker processes shared by every session (and the service) for header rewrites and histograms
+PROCESS_WORKERS = int(os.environ.get('DICOM_PIXEL_PROCESS_WORKERS', 0)) or os.cpu_count() or 1
+
+_pool = None
+_lock = threading.Lock()
+
+
+def shared_pool():
+    """The process pool of this process, started on first use.
+
+    Workers are started with forkserver (spawn where that's missing) rather than
+    fork: forking the threaded server would copy its locks mid-use into every
+    worker. Jobs from concurrent sessions queue up on the same PROCESS_WORKERS
+    processes instead of each starting a pool of their own.
+    """
+    global _pool
+    with _lock:
+        # A worker that died (killed for memory, say) breaks the pool for good; start a new one
+        if _pool is None or getattr(_pool, '_broken', False):
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS,
+                                        mp_context=multiprocessing.get_context(method))
+        return _pool
@@ -4,98 +4,163 @@ import cv2
 import os
 import datetime
 import zipfile
+from converter.deid import DeidProfile, deidentify_directory, deidentify_file
+from converter.intensity import series_bounds, series_key
 
 class DICOMConverter:
 
-    def __init__(self):
+    def __init__(self, output_dir='output'):
+        # Default output directory; every conversion can also be given its own.
+        # With None there is no default and every conversion must name one.
+        self.output_dir = output_dir
         # Create the output directory if it doesn't exist
-        if not os.path.exists('output'):
-            os.makedirs('output')
+        if output_dir is not None and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
 
-    def dicom_to_png(self, dicom_path):
+    def dicom_to_png(self, dicom_path, output_dir=None, bounds=None):
+        # bounds: intensity bounds per series (see intensity_bounds), else every image is scaled on its own
+        output_dir = self._output_dir(output_dir)
         output_files = []
         if os.path.isdir(dicom_path):
             for file_name in os.listdir(dicom_path):
                 file_path = os.path.join(dicom_path, file_name)
                 if os.path.isfile(file_path):
-                    output_file = self._convert_dicom_to_png(file_path)
+                    output_file = self._convert_dicom_to_png(file_path, output_dir, bounds)
                     output_files.append(output_file)
         else:
-            output_file = self._convert_dicom_to_png(dicom_path)
+            output_file = self._convert_dicom_to_png(dicom_path, output_dir, bounds)
             output_files.append(output_file)
 
-        return self._create_zip_or_return_single(output_files)
+        return self._create_zip_or_return_single(output_files, output_dir)
 
-    def dicom_to_jpeg(self, dicom_path):
+    def dicom_to_jpeg(self, dicom_path, output_dir=None, bounds=None):
+        output_dir = self._output_dir(output_dir)
         output_files = []
         if os.path.isdir(dicom_path):
             for file_name in os.listdir(dicom_path):
                 file_path = os.path.join(dicom_path, file_name)
                 if os.path.isfile(file_path):
-                    output_file = self._convert_dicom_to_jpeg(file_path)
+                    output_file = self._convert_dicom_to_jpeg(file_path, output_dir, bounds)
                     output_files.append(output_file)
         else:
-            output_file = self._convert_dicom_to_jpeg(dicom_path)
+            output_file = self._convert_dicom_to_jpeg(dicom_path, output_dir, bounds)
             output_files.append(output_file)
 
-        return self._create_zip_or_return_single(output_files)
+        return self._create_zip_or_return_single(output_files, output_dir)
 
-    def png_to_dicom(self, png_path):
+    def png_to_dicom(self, png_path, output_dir=None):
+        output_dir = self._output_dir(output_dir)
         output_files = []
         if os.path.isdir(png_path):
             for file_name in os.listdir(png_path):
                 file_path = os.path.join(png_path, file_name)
                 if os.path.isfile(file_path):
-                    output_file = self._convert_png_to_dicom(file_path)
+                    output_file = self._convert_png_to_dicom(file_path, output_dir)
                     output_files.append(output_file)
         else:
-            output_file = self._convert_png_to_dicom(png_path)
+            output_file = self._convert_png_to_dicom(png_path, output_dir)
             output_files.append(output_file)
 
-        return self._create_zip_or_return_single(output_files)
+        return self._create_zip_or_return_single(output_files, output_dir)
 
-    def jpg_to_dicom(self, image_path):
+    def jpg_to_dicom(self, image_path, output_dir=None):
+        output_dir = self._output_dir(output_dir)
         output_files = []
         if os.path.isdir(image_path):
             for file_name in os.listdir(image_path):
                 file_path = os.path.join(image_path, file_name)
                 if os.path.isfile(file_path):
-                    output_file = self._convert_jpg_to_dicom(file_path)
+                    output_file = self._convert_jpg_to_dicom(file_path, output_dir)
                     output_files.append(output_file)
         else:
-            output_file = self._convert_jpg_to_dicom(image_path)
+            output_file = self._convert_jpg_to_dicom(image_path, output_dir)
             output_files.append(output_file)
 
-        return self._create_zip_or_return_single(output_files)
+        return self._create_zip_or_return_single(output_files, output_dir)
 
-    def _convert_dicom_to_png(self, dicom_path):
-        dicom = self._load_dicom(dicom_path)
+    def deidentify(self, dicom_path, output_dir=None, profile=None, pool=None):
+        # Rewrites only the headers; pixel data is copied through without being decoded.
+        # Folders are processed in parallel; files in them that fail (not DICOM, truncated) are
+        # skipped. Returns (output path, errors), so a partial result is never mistaken for a full one.
+        output_dir = self._output_dir(output_dir)
+        profile = profile or DeidProfile()
+        if os.path.isdir(dicom_path):
+            output_files, errors = deidentify_directory(dicom_path, output_dir, profile, pool)
+            if not output_files:
+                raise ValueError("No DICOM files to de-identify. " + "; ".join(errors[:3]))
+        else:
+            output_files = [deidentify_file(dicom_path, os.path.join(output_dir, os.path.basename(dicom_path)), profile)]
+            errors = []
+
+        return self._create_zip_or_return_single(output_files, output_dir), errors
+
+    def intensity_bounds(self, dicom_path):
+        # Robust (0.5th-99.5th percentile) bounds per series, from one streaming pass over the
+        # files of a folder (or a list of files), so every slice of a series is scaled the same
+        if isinstance(dicom_path, (list, tuple)):
+            paths = dicom_path
+        elif os.path.isdir(dicom_path):
+            paths = [os.path.join(dicom_path, f) for f in os.listdir(dicom_path)
+                     if os.path.isfile(os.path.join(dicom_path, f))]
+        else:
+            paths = [dicom_path]
+        return series_bounds(paths)
+
+    def render_pixel_array(self, dicom, bounds=None):
+        # Window the stored pixel values to the full 8-bit display range, or map
+        # (low, high) bounds to it with values outside them saturating
         pixel_array = dicom.pixel_array
+        if bounds is not None:
+            low, high = bounds
+            pixel_array = (pixel_array.astype(np.float32) - low) * (255.0 / (high - low))
+            return np.uint8(np.clip(pixel_array, 0, 255))
         pixel_array = cv2.normalize(pixel_array, None, 0, 255, cv2.NORM_MINMAX)
-        pixel_array = np.uint8(pixel_array)
-        output_path = os.path.join('output', self._change_extension(dicom_path, '.png'))
+        return np.uint8(pixel_array)
+
+    def add_overlay(self, dicom, mask, description="Annotations", group=0x6000):
+        # Store a boolean mask (rows x columns) as a graphics overlay plane.
+        # The pixel data itself is left untouched.
+        mask = np.asarray(mask, dtype=bool)
+        packed = np.packbits(mask.ravel(), bitorder='little').tobytes()
+        if len(packed) % 2:
+            packed += b'\0'
+        dicom.add_new((group, 0x0010), 'US', mask.shape[0])
+        dicom.add_new((group, 0x0011), 'US', mask.shape[1])
+        dicom.add_new((group, 0x0022), 'LO', description)
+        dicom.add_new((group, 0x0040), 'CS', 'G')
+        dicom.add_new((group, 0x0050), 'SS', [1, 1])
+        dicom.add_new((group, 0x0100), 'US', 1)
+        dicom.add_new((group, 0x0102), 'US', 0)
+        dicom.add_new((group, 0x3000), 'OW', packed)
+        return dicom
+
+    def _series_bounds(self, dicom, dicom_path, bounds):
+        return bounds.get(series_key(dicom, dicom_path)) if bounds else None
+
+    def _convert_dicom_to_png(self, dicom_path, output_dir=None, bounds=None):
+        dicom = self._load_dicom(dicom_path)
+        pixel_array = self.render_pixel_array(dicom, self._series_bounds(dicom, dicom_path, bounds))
+        output_path = os.path.join(self._output_dir(output_dir), self._change_extension(dicom_path, '.png'))
         cv2.imwrite(output_path, pixel_array)
         return output_path
 
-    def _convert_dicom_to_jpeg(self, dicom_path):
+    def _convert_dicom_to_jpeg(self, dicom_path, output_dir=None, bounds=None):
         dicom = self._load_dicom(dicom_path)
-        pixel_array = dicom.pixel_array
-        pixel_array = cv2.normalize(pixel_array, None, 0, 255, cv2.NORM_MINMAX)
-        pixel_array = np.uint8(pixel_array)
-        output_path = os.path.join('output', self._change_extension(dicom_path, '.jpeg'))
+        pixel_array = self.render_pixel_array(dicom, self._series_bounds(dicom, dicom_path, bounds))
+        output_path = os.path.join(self._output_dir(output_dir), self._change_extension(dicom_path, '.jpeg'))
         cv2.imwrite(output_path, pixel_array, [int(cv2.IMWRITE_JPEG_QUALITY), 90])
         return output_path
 
-    def _convert_png_to_dicom(self, png_path):
+    def _convert_png_to_dicom(self, png_path, output_dir=None):
         image = cv2.imread(png_path, cv2.IMREAD_GRAYSCALE)
         image = np.uint16(image)
         dicom = self._create_minimal_dicom(image.shape)
         dicom.PixelData = image.tobytes()
-        output_path = os.path.join('output', self._change_extension(png_path, '.dicom'))
+        output_path = os.path.join(self._output_dir(output_dir), self._change_extension(png_path, '.dicom'))
         dicom.save_as(output_path)
         return output_path
 
-    def _convert_jpg_to_dicom(self, image_path):
+    def _convert_jpg_to_dicom(self, image_path, output_dir=None):
         _, ext = os.path.splitext(image_path)
         if ext.lower() not in ['.jpg', '.jpeg']:
             raise ValueError("Unsupported file extension. Please provide a .jpg or .jpeg file.")
@@ -104,20 +169,24 @@ class DICOMConverter:
         image = np.uint16(image)
         dicom = self._create_minimal_dicom(image.shape)
         dicom.PixelData = image.tobytes()
-        output_path = os.path.join('output', self._change_extension(image_path, '.dicom'))
+        output_path = os.path.join(self._output_dir(output_dir), self._change_extension(image_path, '.dicom'))
         dicom.save_as(output_path)
         return output_path
 
     def _load_dicom(self, dicom_path):
         _, ext = os.path.splitext(dicom_path)
         if ext.lower() in ['.dcm', '.dicom']:
-            dicom = pydicom.dcmread(dicom_path)
-            if not hasattr(dicom.file_meta, 'TransferSyntaxUID'):
-                dicom.file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
-            return dicom
+            return self.read_dicom(dicom_path)
         else:
             raise ValueError("Unsupported file extension. Please provide a file with .dcm or .dicom extension.")
 
+    def read_dicom(self, fp, force=False):
+        # fp can be a path or a file-like object
+        dicom = pydicom.dcmread(fp, force=force)
+        if not hasattr(dicom.file_meta, 'TransferSyntaxUID'):
+            dicom.file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
+        return dicom
+
     def _create_minimal_dicom(self, image_shape):
         dicom = pydicom.dataset.FileDataset(None, {}, file_meta=pydicom.dataset.FileMetaDataset(), preamble=b"\0" * 128)
         dicom.SOPClassUID = pydicom.uid.generate_uid()
@@ -146,12 +215,19 @@ class DICOMConverter:
 
         return dicom
 
+    def _output_dir(self, output_dir):
+        output_dir = output_dir or self.output_dir
+        if output_dir is None:
+            raise ValueError("No output directory given and the converter has no default")
+        os.makedirs(output_dir, exist_ok=True)
+        return output_dir
+
     def _change_extension(self, path, new_ext):
         return os.path.splitext(os.path.basename(path))[0] + new_ext
 
-    def _create_zip_or_return_single(self, output_files):
+    def _create_zip_or_return_single(self, output_files, output_dir=None):
         if len(output_files) > 1:
-            zip_file_path = 'output/output_files.zip'
+            zip_file_path = os.path.join(self._output_dir(output_dir), 'output_files.zip')
             with zipfile.ZipFile(zip_file_path, 'w') as zipf:
                 for file in output_files:
                     zipf.write(file, os.path.basename(file))
@@ -1,31 +1,77 @@
-import numpy as np
+import io
 import streamlit as st
 from PIL import Image
-from streamlit_image_zoom import image_zoom
+from streamlit_image_zoom import image_size, image_zoom
 import os  # Import os for handling file paths
 
+try:
+    # Results of the other DiCom Pixel pages and its profiling; not there when this app runs on its own
+    from artifacts import artifact_panel, get_artifact_store, hold, publish, take_opened
+    from profiling import section
+except ImportError:
+    from contextlib import nullcontext as section
+    get_artifact_store = None
+
 def init_variables():
     if "img_ref" not in st.session_state:
         # Get the absolute path to the image
-        img_path = os.path.join(os.path.dirname(__file__), "images/resizing.webp")
-        st.session_state.img_ref = np.array(Image.open(img_path))
+        st.session_state.img_ref = os.path.join(os.path.dirname(__file__), "images/resizing.webp")
     if "show_img" not in st.session_state:
         st.session_state.show_img = st.session_state.img_ref
     if "size_image" not in st.session_state:
         st.session_state.size_image = 1024
 
 def load_image(file):
-    # Function to read and convert to np.array.
-    image = np.array(Image.open(file).convert("RGB"))
-    return image
+    # Function to read the uploaded bytes, once per upload. Images are kept encoded: the viewer decodes
+    # them itself, in their own mode and (for JPEGs) straight at the display size.
+    file_id = getattr(file, "file_id", None) or (file.name, file.size)
+    if st.session_state.get("loaded_file_id") != file_id:
+        st.session_state.loaded_image = file.getvalue()
+        st.session_state.loaded_file_id = file_id
+    return st.session_state.loaded_image
 
-def plot_images(img):
-    st.session_state.show_img = img
-    if all(dim < 512 for dim in img.shape[:2]):
+def open_image(source):
+    # A fresh, not yet decoded PIL image from a path or encoded bytes. Opening only reads the header.
+    # DICOM files ("DICM" after the 128 byte preamble) are read with pydicom, imported only when needed.
+    if isinstance(source, bytes) and source[128:132] == b"DICM":
+        import pydicom
+        return pydicom.dcmread(io.BytesIO(source))
+    return Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+
+def fit_size(image):
+    if all(dim < 512 for dim in image_size(image)):
         st.session_state.size_image = 512
     else:
         st.session_state.size_image = 768
 
+def plot_images(img):
+    st.session_state.show_img = img
+    st.session_state.pop("show_artifact", None)
+    fit_size(open_image(img))
+
+def decode_artifact(data):
+    # Decoded once per artifact and shared by every rerun, so it must not be left to decode lazily
+    image = open_image(data)
+    if isinstance(image, Image.Image):
+        image.load()
+    return image
+
+def opened_artifact():
+    # The artifact opened from another page, decoded once by the artifact store, or None
+    if get_artifact_store is None:
+        return None
+    store = get_artifact_store()
+    opened = take_opened("zooming")
+    if opened is not None:
+        hold("zooming", opened)
+        st.session_state.show_artifact = opened
+        fit_size(store.decoded(opened, "zoom", decode_artifact))
+    key = st.session_state.get("show_artifact")
+    if key is None or key not in store:
+        return None
+    st.session_state.image_name = store.name(key)
+    return store.decoded(key, "zoom", decode_artifact)
+
 def main():
     # Cached parameters
     if "loaded" not in st.session_state:
@@ -45,7 +91,7 @@ def main():
     st.session_state.uploaded = st.sidebar.file_uploader(
         "Choose an image file",
         accept_multiple_files=False,
-        type=["png", "jpg", "jpeg", "tiff", "bmp"],
+        type=["png", "jpg", "jpeg", "tiff", "bmp", "dcm"],
         key="file_uploader1",
     )
     
@@ -53,6 +99,13 @@ def main():
         img = load_image(st.session_state.uploaded)
         st.session_state.image_name = st.session_state.uploaded.name
         st.sidebar.button("Process", on_click=plot_images, args=(img,))
+        if get_artifact_store is not None:
+            # Hand the upload to the annotation page as is
+            if st.session_state.get("published_file_id") != st.session_state.loaded_file_id:
+                publish("zooming", [(st.session_state.uploaded.name, img)])
+                st.session_state.published_file_id = st.session_state.loaded_file_id
+            with st.sidebar:
+                artifact_panel("zooming", ["annotations"])
     else:
         st.session_state.show_img = st.session_state.img_ref
         st.session_state.image_name = "no-image.jpg"
@@ -75,14 +128,18 @@ def main():
     # --- Main space ---
     # Header
     st.title("Streamlit Image Zoom")
-    image_zoom(
-        image=st.session_state.show_img,
-        mode=mode,
-        size=st.session_state.size_image,
-        zoom_factor=zoom_factor,
-        increment=increase_factor,
-        keep_resolution=keep_res,
-    )
+    image = opened_artifact()
+    if image is None:
+        image = open_image(st.session_state.show_img)
+    with section("zoom.image_zoom"):
+        image_zoom(
+            image=image,
+            mode=mode,
+            size=st.session_state.size_image,
+            zoom_factor=zoom_factor,
+            increment=increase_factor,
+            keep_resolution=keep_res,
+        )
 
 if __name__ == "__main__":
     try:
@@ -1,18 +1,53 @@
-import base64
+import hashlib
 import io
-from typing import Optional, Tuple, Union
+import math
+import os
+from typing import Optional, Sequence, Tuple, Union
 
 import numpy as np
+import streamlit as st
 import streamlit.components.v1 as components
 from PIL import Image
 
+from .cache import encode_cache, image_digest
+from .media import bytes_to_data_uri, register_media
+from .roi import roi_request
+from .pyramid import build_pyramid, pyramid_html, pyramid_sizes, pyramid_sources
+from .stack import sort_series, stack_html, stack_window
+from .windowing import (
+    dataset_array,
+    is_dicom_dataset,
+    is_windowable,
+    pack_pixels,
+    windowing_digest,
+    windowing_html,
+    windowing_pixels,
+)
+
 __version__ = "0.0.4"
 
+# Everything encode_image does that changes its output; part of every cache key.
+ENCODER_SETTINGS = ("JPEG", 100, 0)
+
+# The zoom viewer is a custom component served from frontend/, so it can report the viewport back.
+_component_func = components.declare_component(
+    "image_zoom", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "frontend")
+)
+
+# Milliseconds the view has to stay still before the viewer reports its viewport.
+REPORT_DELAY = 300
+
+# Modes that are encoded as they are. 8-bit images go out as JPEG, 16-bit grayscale as PNG.
+PASSTHROUGH_MODES = ("RGB", "L", "I;16")
+
 
 def check_image(image: Union[Image.Image, np.ndarray]) -> Image.Image:
     """
     Check and convert the input image to a PIL Image.
 
+    RGB, grayscale ("L") and 16-bit grayscale ("I;16") images are passed through without a copy; 32-bit integer
+    images become "I;16", two-level and grayscale-alpha images become "L" and everything else becomes RGB.
+
     Args:
         image (Union[Image.Image, np.ndarray]): The input image to be checked and converted.
 
@@ -26,14 +61,54 @@ def check_image(image: Union[Image.Image, np.ndarray]) -> Image.Image:
     Image.MAX_IMAGE_PIXELS = None
 
     if isinstance(image, Image.Image):
-        image_pil = image.convert("RGB")
+        image_pil = image
 
     elif isinstance(image, np.ndarray):
-        image_pil = Image.fromarray(image).convert("RGB")
+        image_pil = Image.fromarray(image)
     else:
         raise TypeError("Only supported format are Pillow Image and Numpy Array.")
 
-    return image_pil
+    if image_pil.mode in PASSTHROUGH_MODES:
+        return image_pil
+    if image_pil.mode in ("I", "I;16B", "I;16L"):
+        return image_pil.convert("I;16")
+    if image_pil.mode in ("1", "LA"):
+        return image_pil.convert("L")
+    return image_pil.convert("RGB")
+
+
+def image_mimetype(image: Image.Image) -> str:
+    """
+    Get the mime type encode_image produces for an image.
+
+    Args:
+        image (Image.Image): A PIL Image as returned by check_image.
+
+    Returns:
+        str: "image/png" for 16-bit images, "image/jpeg" otherwise.
+
+    """
+    return "image/png" if image.mode == "I;16" else "image/jpeg"
+
+
+def encode_image(image: Image.Image) -> bytes:
+    """
+    Encode a PIL Image as JPEG, or as PNG if it is 16-bit.
+
+    Args:
+        image (Image.Image): The PIL Image to be encoded.
+
+    Returns:
+        bytes: The encoded image.
+
+    """
+    in_mem_file = io.BytesIO()
+    if image.mode == "I;16":
+        image.save(in_mem_file, format="PNG")
+    else:
+        image_format, quality, subsampling = ENCODER_SETTINGS
+        image.save(in_mem_file, format=image_format, subsampling=subsampling, quality=quality)
+    return in_mem_file.getvalue()
 
 
 def pillow_to_base64(image: Image.Image) -> str:
@@ -47,34 +122,59 @@ def pillow_to_base64(image: Image.Image) -> str:
         str: A base64-encoded string representing the image.
 
     """
-    in_mem_file = io.BytesIO()
-    image.save(in_mem_file, format="JPEG", subsampling=0, quality=100)
-    image_str = base64.b64encode(in_mem_file.getvalue()).decode()
-    base64_src = f"data:image/jpeg;base64, {image_str}"
-    return base64_src
+    return bytes_to_data_uri(encode_image(image), image_mimetype(image))
 
 
-def prepare_image(image, size, keep_aspect_ratio):
+def pillow_to_url(image: Image.Image) -> str:
     """
-    Resize the image and convert it to a base64 string.
+    Encode a PIL Image and serve it as a cacheable media URL.
+
+    Args:
+        image (Image.Image): The PIL Image to be served.
+
+    Returns:
+        str: A content-hashed media URL, or a base64 data URI outside a Streamlit runtime.
+
+    """
+    return register_media(encode_image(image), image_mimetype(image))
+
+
+def image_size(image: Union[Image.Image, np.ndarray]) -> Tuple[int, int]:
+    """
+    Get the (width, height) of a PIL Image, NumPy array or DICOM dataset without converting it.
+
+    Args:
+        image (Union[Image.Image, np.ndarray]): The image.
+
+    Returns:
+        Tuple[int, int]: The width and height of the image.
+
+    """
+    if is_dicom_dataset(image):
+        return int(image.Columns), int(image.Rows)
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+
+def compute_size(image, size, keep_aspect_ratio):
+    """
+    Compute the display size of the image.
 
     Args:
         image: The image to be resized.
         size: The desired size of the image. It can be an integer or a tuple of integers (width, height).
         keep_aspect_ratio: Whether to maintain the aspect ratio of the image during resizing.
-            If True, the image will be resized while preserving its aspect ratio.
-            If False, the image will be resized to exactly match the provided size without preserving aspect ratio.
 
     Returns:
-        Tuple[str, Tuple[int, int]]: A tuple containing the base64 string representation of the resized image
-            and the new size of the image.
+        Tuple[int, int]: The new size (width, height) of the image.
 
     """
 
     # new_size=(width, height)
     if isinstance(size, int) and keep_aspect_ratio:
         if keep_aspect_ratio:
-            width, height = image.size
+            width, height = image_size(image)
             # Calculate the aspect ratio. Width / Height
             aspect_ratio = width / height
             if aspect_ratio > 1:  # Fixed Width
@@ -88,8 +188,78 @@ def prepare_image(image, size, keep_aspect_ratio):
     else:
         new_size = size
 
-    # Convert images to base64 strings.
-    return pillow_to_base64(image.resize(new_size)), new_size
+    return tuple(new_size)
+
+
+def prepare_image(image, size, keep_aspect_ratio):
+    """
+    Resize the image and serve it as a media URL.
+
+    Args:
+        image: The image to be resized.
+        size: The desired size of the image. It can be an integer or a tuple of integers (width, height).
+        keep_aspect_ratio: Whether to maintain the aspect ratio of the image during resizing.
+            If True, the image will be resized while preserving its aspect ratio.
+            If False, the image will be resized to exactly match the provided size without preserving aspect ratio.
+
+    Returns:
+        Tuple[str, Tuple[int, int]]: A tuple containing the URL of the resized image (a base64 data URI outside a
+            Streamlit runtime) and the new size of the image.
+
+    """
+    new_size = compute_size(image, size, keep_aspect_ratio)
+
+    # Serve images by URL so reruns only re-send the HTML.
+    return pillow_to_url(image.resize(new_size, reducing_gap=3.0)), new_size
+
+
+def encode_resized(image: Image.Image, new_size: Tuple[int, int]) -> Tuple[bytes, str, str]:
+    """
+    Resize and encode a PIL Image.
+
+    Args:
+        image (Image.Image): A PIL Image as returned by check_image.
+        new_size (Tuple[int, int]): The (width, height) to encode the image at.
+
+    Returns:
+        Tuple[bytes, str, str]: The encoded image, its digest and its mime type.
+
+    """
+    if image.size != new_size:
+        image = image.resize(new_size, reducing_gap=3.0)
+    data = encode_image(image)
+    return data, hashlib.blake2b(data, digest_size=16).hexdigest(), image_mimetype(image)
+
+
+def encode_tile(image: Image.Image) -> Tuple[bytes, str]:
+    """
+    Encode a pyramid tile along with its digest, so serving it again never rehashes it.
+
+    Args:
+        image (Image.Image): The tile.
+
+    Returns:
+        Tuple[bytes, str]: The encoded tile and its digest.
+
+    """
+    data = encode_image(image)
+    return data, hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def encode_windowing(image) -> Tuple[bytes, str, dict]:
+    """
+    Pack the stored pixels of a window/level image for the browser.
+
+    Args:
+        image: A grayscale DICOM dataset or a 16-bit image.
+
+    Returns:
+        Tuple[bytes, str, dict]: The packed PNG, its digest and the display parameters.
+
+    """
+    pixels, params = windowing_pixels(image)
+    data = pack_pixels(pixels)
+    return data, hashlib.blake2b(data, digest_size=16).hexdigest(), params
 
 
 def image_zoom(
@@ -100,12 +270,29 @@ def image_zoom(
     keep_resolution: Optional[bool] = False,
     zoom_factor: Optional[Union[float, int]] = 2.0,
     increment: Optional[float] = 0.2,
-) -> components.html:
+    pyramid: Optional[bool] = False,
+    tile_size: Optional[int] = 256,
+    window: Optional[Tuple[float, float]] = None,
+    invert: Optional[bool] = None,
+    key: Optional[str] = None,
+) -> Optional[dict]:
     """
     Display an image with interactive zoom functionality.
 
+    Once the view has been still for a moment, the viewer reports the visible part of the image and the zoom
+    level. On the rerun that follows, just that region is cropped from the source at the resolution it is shown
+    at (up to the native resolution), encoded and overlaid on the zoomed image. Bytes sent per zoom depend on the
+    viewer size, not on the size of the source image.
+
     Args:
-        image (Union[Image.Image, np.ndarray]): The image to be displayed. It can be a PIL Image or a NumPy array.
+        image (Union[Image.Image, np.ndarray]): The image to be displayed. It can be a PIL Image, a NumPy array or a
+            pydicom Dataset. Grayscale DICOM datasets and 16-bit images are shown with client-side window/level:
+            their stored pixels are sent once, losslessly, and windowing, rescale slope/intercept and inversion are
+            applied in the browser. Right-click and drag to change the window; scroll to zoom, click and drag to
+            pan and double-click to reset. mode and keep_resolution are ignored for them.
+            Grayscale and 16-bit grayscale images are displayed without an RGB conversion. A JPEG opened with
+            Image.open and not loaded yet is decoded directly at the display size via Image.draft, which
+            changes that Image object in place; pass a freshly opened image on every call.
         mode (Optional[str]): The mode of interaction for zooming. Valid options are "default" (zoom on mousemove),
             "mousemove" (zoom on mousemove), "scroll" (zoom on scroll), "both" (zoom on both mousemove and scroll)
             or "dragmove" (drag and move zoom: Single-click to zoom in, click and drag to move the zoomed image,
@@ -127,9 +314,21 @@ def image_zoom(
             Default is 2.0.
         increment (Optional[float]): The increment value for adjusting the zoom level when scrolling.
             Should be between 0 and 1. Default is 0.2.
+        pyramid (Optional[bool]): Whether to display the image as a tiled multi-resolution pyramid (deep zoom).
+            Tiles are precomputed at power-of-two levels up to the resolution needed at zoom_factor, and only
+            the tiles intersecting the viewport at the current zoom level are loaded. Scroll to zoom, click and
+            drag to pan, double-click to reset; mode and keep_resolution are ignored. Default is False.
+        tile_size (Optional[int]): The tile width and height in pixels in pyramid mode. Default is 256.
+        window (Optional[Tuple[float, float]]): The initial (center, width) window in modality units for
+            window/level images. Default is the dataset's WindowCenter/WindowWidth, or the full pixel range.
+        invert (Optional[bool]): Whether to invert window/level images. Default is True for MONOCHROME1
+            datasets and False otherwise.
+        key (Optional[str]): The component key. Default is derived from the image content.
 
     Returns:
-        HTML: An HTML component displaying the image with interactive zoom functionality.
+        Optional[dict]: The last viewport the viewer reported: {"viewport": [x, y, width, height] as fractions of
+            the image, "zoom": float, "pixelRatio": float}, or None while the image isn't zoomed. Always None
+            in pyramid and window/level modes, which don't report back.
 
     Raises:
         AssertionError: If the specified mode is not one of "default", "mousemove", "scroll", or "both".
@@ -146,272 +345,213 @@ def image_zoom(
     zoom_factor = float(zoom_factor) if isinstance(zoom_factor, int) else zoom_factor
     assert increment <= 1.0 or increment > 0.0, "Increment should be between 0 and 1."
 
-    # Check and convert to PIL image.
-    image = check_image(image)
-    # Resize image and convert to base64.
-    if keep_resolution:
-        img_orig_base64, orig_size = prepare_image(image, image.size, keep_aspect_ratio)
-        img_resized_base64, resized_size = prepare_image(image, size, keep_aspect_ratio)
-        params_keep_res = f"""
-                                data-original-src="{img_orig_base64}" 
-                                data-original-width="{orig_size[0]}" 
-                                data-original-height="{orig_size[1]}"
-                        """
+    if not pyramid and is_windowable(image):
+        # The stored pixels go out once; every contrast change after that happens in the browser.
+        data, data_digest, params = encode_cache.get_or_create((windowing_digest(image), "windowing"),
+                                                               lambda: encode_windowing(image))
+        params = dict(params)
+        if window is not None:
+            params["center"], params["window"] = float(window[0]), max(float(window[1]), 1.0)
+        if invert is not None:
+            params["invert"] = bool(invert)
+        display_size = compute_size(image, size, keep_aspect_ratio)
+        html_code = windowing_html(register_media(data, "image/png", data_digest), params, display_size,
+                                   zoom_factor, increment)
+        return components.html(html_code, width=display_size[0], height=display_size[1])
+    if is_dicom_dataset(image):
+        # Color datasets are displayed like any other RGB array.
+        image = dataset_array(image)
+
+    # Encoded images are cached by pixel content, target size and encoder settings, so reruns that only change
+    # the mode or the zoom factors skip conversion, resizing and encoding altogether.
+    digest = image_digest(image)
+    full_size = image_size(image)
+    if pyramid:
+        display_size = compute_size(image, size, keep_aspect_ratio)
+        draft_size = pyramid_sizes(display_size, full_size, zoom_factor)[-1]
     else:
-        img_resized_base64, resized_size = prepare_image(image, size, keep_aspect_ratio)
-        params_keep_res = ""
-
-    css_code = """
-        <style>
-            #container {
-                position: relative;
-                overflow: hidden;
-                cursor: zoom-in;
-            }
-            #image {
-                position: absolute;
-                top: 0;
-                left: 0;
-                width: 100%;
-                height: 100%;
-            }
-        </style>
+        display_size = compute_size(image, size, keep_aspect_ratio)
+        key = key or f"image_zoom-{digest}"
+        # The region of interest for the viewport reported on the previous run, if the display image lacks detail.
+        request = None if keep_resolution else roi_request(st.session_state.get(key), full_size, display_size)
+        if keep_resolution:
+            draft_size = None
+        elif request is not None:
+            (left, _, right, _), out_size = request
+            scale = out_size[0] / (right - left)
+            draft_size = (math.ceil(full_size[0] * scale), math.ceil(full_size[1] * scale))
+        else:
+            draft_size = display_size
+    converted = []
+
+    def source():
+        # Check and convert to PIL image, only when something has to be encoded. JPEGs that haven't been
+        # decoded yet are decoded straight at (at least) the largest size that is going to be displayed.
+        if not converted:
+            if draft_size is not None and isinstance(image, Image.Image) and image.format == "JPEG" and image.tile:
+                image.draft(image.mode, draft_size)
+            converted.append(check_image(image))
+        return converted[0]
+
+    if pyramid:
+        tiles = encode_cache.get_or_create(
+            (digest, "pyramid", display_size, zoom_factor, tile_size, ENCODER_SETTINGS),
+            lambda: {**build_pyramid(source(), display_size, zoom_factor, encode_tile, tile_size),
+                     "mimetype": image_mimetype(source())},
+        )
+        sources = pyramid_sources(tiles, lambda tile: register_media(tile[0], tiles["mimetype"], tile[1]))
+        html_code = pyramid_html(sources, display_size, zoom_factor, increment)
+        return components.html(html_code, width=display_size[0], height=display_size[1])
+
+    def serve(new_size):
+        data, data_digest, mimetype = encode_cache.get_or_create(
+            (digest, new_size, keep_aspect_ratio, ENCODER_SETTINGS), lambda: encode_resized(source(), new_size)
+        )
+        return register_media(data, mimetype, data_digest)
+
+    def crop(box, out_size):
+        # The source may have been decoded at a reduced size (see draft_size).
+        image_pil = source()
+        sx, sy = image_pil.size[0] / full_size[0], image_pil.size[1] / full_size[1]
+        region = image_pil.crop((round(box[0] * sx), round(box[1] * sy), round(box[2] * sx), round(box[3] * sy)))
+        return encode_resized(region, out_size)
+
+    # Resize image and serve it by URL.
+    img_resized_src = serve(display_size)
+    original = None
+    if keep_resolution:
+        original = {"src": serve(full_size), "width": full_size[0], "height": full_size[1]}
+
+    roi = None
+    if request is not None:
+        box, out_size = request
+        data, data_digest, mimetype = encode_cache.get_or_create(
+            (digest, "roi", box, out_size, ENCODER_SETTINGS), lambda: crop(box, out_size)
+        )
+        roi = {
+            "src": register_media(data, mimetype, data_digest),
+            "region": [box[0] / full_size[0], box[1] / full_size[1],
+                       (box[2] - box[0]) / full_size[0], (box[3] - box[1]) / full_size[1]],
+            "viewport": st.session_state[key]["viewport"],
+        }
+
+    return _component_func(
+        src=img_resized_src,
+        width=display_size[0],
+        height=display_size[1],
+        mode=mode,
+        zoom_factor=zoom_factor,
+        increment=increment,
+        original=original,
+        roi=roi,
+        report_delay=REPORT_DELAY,
+        key=key,
+        default=None,
+    )
+
+
+def serve_slice(image, display_size: Tuple[int, int], keep_aspect_ratio: bool) -> Tuple[str, Optional[dict]]:
+    """
+    Encode (or take from the cache) and serve one slice of a stack.
+
+    Args:
+        image: The slice. Any image image_zoom accepts.
+        display_size (Tuple[int, int]): The (width, height) 8-bit slices are encoded at.
+        keep_aspect_ratio (bool): Part of the cache key, as in image_zoom.
+
+    Returns:
+        Tuple[str, Optional[dict]]: The URL of the slice, and its display parameters if it is a window/level
+            slice (None otherwise).
+
     """
-    js_code = """
-        <script>
-            function calculateTransformOrigin(offsetX, offsetY, image, boundingRect, keep_resolution) {
-                let originX, originY;
-                if (keep_resolution) {
-                    const original_width = parseInt(image.getAttribute('data-original-width'));
-                    const original_height = parseInt(image.getAttribute('data-original-height'));
-                    const originX_original = (offsetX / boundingRect.width) * original_width;
-                    const originY_original = (offsetY / boundingRect.height) * original_height;
-                    originX = (originX_original / original_width) * 100 + '%';
-                    originY = (originY_original / original_height) * 100 + '%';
-                } else {
-                    originX = (offsetX / boundingRect.width) * 100 + '%';
-                    originY = (offsetY / boundingRect.height) * 100 + '%';
-                }
-                return { originX, originY };
-            }
-
-            function ImageZoomMouseMove(selector, scale_factor, keep_resolution) {
-                const image = document.getElementById(selector);
-                image.addEventListener('mousemove', function(event) {
-                    const boundingRect = image.getBoundingClientRect();
-                    const offsetX = (event.clientX - boundingRect.left);
-                    const offsetY = (event.clientY - boundingRect.top);
-                    const { originX, originY } = calculateTransformOrigin(offsetX, offsetY, image, boundingRect, keep_resolution);
-                    if (keep_resolution) {
-                        image.src = image.getAttribute('data-original-src');
-                    }
-                    image.style.transformOrigin = `${originX} ${originY}`;
-                    image.style.transform = `scale(${scale_factor})`;
-                });
-                
-                image.addEventListener('mouseout', function(event) {
-                    if (keep_resolution) {
-                        image.src = image.getAttribute('src');
-                    }
-                    image.style.transformOrigin = 'center center';
-                    image.style.transform = 'scale(1)';
-                });
-            };
-
-            function ImageZoomScroll(selector, scale_factor, increment, keep_resolution) {
-                const image = document.getElementById(selector);
-                let scale = 1
-
-                image.addEventListener('wheel', function(event) {
-                    event.preventDefault();
-                    // Get the delta of the scroll event
-                    var delta = event.deltaY || -event.detail;
-                    if (delta === undefined) {
-                        //we are on firefox
-                        delta = event.originalEvent.detail;
-                    }
-                    const sign = Math.sign(delta);
-                    scale += sign > 0 ? -increment : increment;
-                    scale = Math.max(1, Math.min(scale_factor, scale));
-
-                    const boundingRect = image.getBoundingClientRect();
-                    const offsetX = event.clientX - boundingRect.left;
-                    const offsetY = event.clientY - boundingRect.top;
-                    const { originX, originY } = calculateTransformOrigin(offsetX, offsetY, image, boundingRect, keep_resolution);
-                    if (keep_resolution) {
-                        image.src = image.getAttribute('data-original-src');
-                    }
-                    image.style.transformOrigin = `${originX} ${originY}`;
-                    image.style.transform = `scale(${scale})`;
-                });
-
-                image.addEventListener('mouseout', function(event) {
-                    if (keep_resolution) {
-                        image.src = image.getAttribute('src');
-                    }
-                    image.style.transformOrigin = 'center center';
-                    image.style.transform = 'scale(1)';
-                    scale = 1
-                });
-            };
-
-            function ImageZoomBoth(selector, scale_factor, increment, keep_resolution) {
-                const image = document.getElementById(selector);
-                let scale = 1;
-
-                image.addEventListener('mousemove', function(event) {
-                    const boundingRect = image.getBoundingClientRect();
-                    const offsetX = event.clientX - boundingRect.left;
-                    const offsetY = event.clientY - boundingRect.top;
-                    const { originX, originY } = calculateTransformOrigin(offsetX, offsetY, image, boundingRect, keep_resolution);
-                    image.style.transformOrigin = `${originX} ${originY}`;
-                    image.style.transform = `scale(${scale})`;
-                });
-
-                image.addEventListener('wheel', function(event) {
-                    event.preventDefault();
-                    // Get the delta of the scroll event
-                    var delta = event.deltaY || -event.detail;
-                    if (delta === undefined) {
-                        //we are on firefox
-                        delta = event.originalEvent.detail;
-                    }
-                    const sign = Math.sign(delta);
-                    scale += sign > 0 ? -increment : increment;
-                    scale = Math.max(1, Math.min(scale_factor, scale));
-
-                    const boundingRect = image.getBoundingClientRect();
-                    const offsetX = event.clientX - boundingRect.left;
-                    const offsetY = event.clientY - boundingRect.top;
-                    const { originX, originY } = calculateTransformOrigin(offsetX, offsetY, boundingRect, keep_resolution);
-                    if (keep_resolution) {
-                        image.src = image.getAttribute('data-original-src');
-                    }
-                    image.style.transformOrigin = `${originX} ${originY}`;
-                    image.style.transform = `scale(${scale})`;
-                });
-
-                image.addEventListener('mouseout', function(event) {
-                    if (keep_resolution) {
-                        image.src = image.getAttribute('src');
-                    }
-                    image.style.transformOrigin = 'center center';
-                    image.style.transform = 'scale(1)';
-                    scale = 1;
-                });
-            };
-
-            function ImageDragMove(selector, scale_factor, keep_resolution) {
-                const image = document.getElementById(selector);
-                let scale = 1;
-                let startX, startY, clickX, clickY;
-                let initialX = 0, initialY = 0;
-                let isDragging = false;
-                let zoomed = false; 
-                
-                image.style.transition = 'transform 0.2s ease, left 0s, top 0s';
-
-                let originalSrc, resizedSrc;
-                if (keep_resolution) {
-                    originalSrc = image.getAttribute('data-original-src');
-                    resizedSrc = image.getAttribute('src');
-                    if (!originalSrc) {
-                        image.setAttribute('data-original-src', resizedSrc);
-                        originalSrc = resizedSrc;
-                    }
-                }
-
-                image.addEventListener('mousedown', (event) => {
-                    if (zoomed) {
-                        // Start dragging
-                        startX = event.clientX;
-                        startY = event.clientY;
-                        initialX = image.offsetLeft;
-                        initialY = image.offsetTop;
-                        image.style.cursor = 'grabbing';
-                        isDragging = true;
-                        event.preventDefault();
-                    } else {
-                        // Record click position for zooming in
-                        clickX = event.clientX;
-                        clickY = event.clientY;
-                    }
-                });
-
-                document.addEventListener('mouseup', (event) => {
-                    if (zoomed && isDragging) {
-                        // Stop dragging
-                        isDragging = false;
-                        image.style.cursor = 'grab';
-                    } else if (!zoomed && !isDragging && Math.abs(event.clientX - clickX) < 5 && Math.abs(event.clientY - clickY) < 5) {
-                        // Zoom in on click
-                        const rect = image.getBoundingClientRect();
-                        const offsetX = event.clientX - rect.left;
-                        const offsetY = event.clientY - rect.top;
-                        const originX = `${offsetX}px`;
-                        const originY = `${offsetY}px`;
-
-                        if (keep_resolution && originalSrc !== resizedSrc) {
-                            image.src = originalSrc;
-                        }
-
-                        scale = scale_factor;
-                        image.style.transformOrigin = `${originX} ${originY}`;
-                        image.style.transform = `scale(${scale})`;
-                        image.style.cursor = 'grab';
-                        zoomed = true;
-                    }
-                });
-
-                image.addEventListener('dblclick', (event) => {
-                    if (zoomed) {
-                        // Zoom out
-                        image.style.transform = `scale(1)`;
-                        image.style.left = '0';
-                        image.style.top = '0';
-                        image.style.cursor = 'zoom-in';
-                        zoomed = false;
-                        isDragging = false;
-                        scale = 1;
-
-                        if (keep_resolution && resizedSrc) {
-                            image.src = resizedSrc;
-                        }
-                    }
-                });
-
-                document.addEventListener('mousemove', (event) => {
-                    if (zoomed && isDragging) {
-                        // Move the zoomed image
-                        const dx = (event.clientX - startX);
-                        const dy = (event.clientY - startY);
-                        image.style.left = `${initialX + dx}px`;
-                        image.style.top = `${initialY + dy}px`;
-                    }
-                });
-            };
-        </script>
+    if is_windowable(image):
+        data, data_digest, params = encode_cache.get_or_create((windowing_digest(image), "windowing"),
+                                                               lambda: encode_windowing(image))
+        return register_media(data, "image/png", data_digest), params
+    if is_dicom_dataset(image):
+        image = dataset_array(image)
+    data, data_digest, mimetype = encode_cache.get_or_create(
+        (image_digest(image), display_size, keep_aspect_ratio, ENCODER_SETTINGS),
+        lambda: encode_resized(check_image(image), display_size),
+    )
+    return register_media(data, mimetype, data_digest), None
+
+
+def image_stack(
+    images: Sequence[Union[Image.Image, np.ndarray]],
+    index: Optional[int] = None,
+    size: Optional[Union[int, Tuple[int, int]]] = 512,
+    keep_aspect_ratio: Optional[bool] = True,
+    zoom_factor: Optional[Union[float, int]] = 2.0,
+    increment: Optional[float] = 0.2,
+    prefetch: Optional[int] = 8,
+    fps: Optional[float] = 10.0,
+    window: Optional[Tuple[float, float]] = None,
+    invert: Optional[bool] = None,
+    key: Optional[str] = None,
+) -> components.html:
     """
+    Display a stack of images (a series of slices or cine frames) with scroll-through, zoom and cine playback.
 
-    # Assemble the HTML code with CSS and JS.
-    html_code = f"""
-        {css_code}
-        <div id="container" style="width: {resized_size[0]}px; height: {resized_size[1]}px;">
-            <img id="image" src="{img_resized_base64}" {params_keep_res}>
-        </div>
-        {js_code}
-        <script>
-        var mode = "{mode}";
-        if (mode == "mousemove" || mode == "default") {{
-            ImageZoomMouseMove('image', {zoom_factor}, {str(keep_resolution).lower()});
-        }} else if (mode == "scroll") {{
-            ImageZoomScroll('image', {zoom_factor}, {increment},  {str(keep_resolution).lower()});
-        }} else if (mode == "both") {{
-            ImageZoomBoth('image', {zoom_factor}, {increment}, {str(keep_resolution).lower()});
-        }} else if (mode == "dragmove") {{
-            ImageDragMove('image', {zoom_factor}, {str(keep_resolution).lower()});
-        }}
-        </script>
+    Only a sliding window of slices around the current one is encoded, cached and sent to the browser, where
+    all of them are decoded ahead of time, so scrolling inside the window runs at frame rate and never goes back
+    to the server. A slider below the viewer moves the window through the rest of the stack; slices already
+    in the encode cache are not encoded again.
+
+    Args:
+        images (Sequence[Union[Image.Image, np.ndarray]]): The slices, in order: PIL Images, NumPy arrays, the
+            frames of a 3D array, or the pydicom Datasets of a DICOM series, which are sorted into slice order.
+            Grayscale DICOM and 16-bit slices are shown with client-side window/level as in image_zoom.
+        index (Optional[int]): The slice shown first. Default is the middle of the stack.
+        size (Optional[Union[int, Tuple[int, int]]]): The desired size of the viewer, as in image_zoom.
+            Default is 512.
+        keep_aspect_ratio (Optional[bool]): Whether to maintain the aspect ratio of the slices. Default is True.
+        zoom_factor (Optional[Union[float, int]]): The maximum zoom factor. Default is 2.0.
+        increment (Optional[float]): The zoom step per Ctrl+scroll event. Default is 0.2.
+        prefetch (Optional[int]): The number of slices sent before and after the current one. Default is 8.
+        fps (Optional[float]): The frame rate of the cine loop. Default is 10.
+        window (Optional[Tuple[float, float]]): The initial (center, width) window for window/level stacks.
+            Default is the window of the current slice.
+        invert (Optional[bool]): Whether to invert window/level stacks. Default is True for MONOCHROME1 series.
+        key (Optional[str]): The key of the slice slider, needed to show several stacks on one page.
+
+    Returns:
+        HTML: An HTML component displaying the stack.
+
+    Example:
+        image_stack([pydicom.dcmread(path) for path in paths])
+        image_stack(volume, size=768, prefetch=16)
     """
+    if isinstance(images, np.ndarray) and images.ndim == 2:
+        images = images[None]
+    elif not isinstance(images, np.ndarray):
+        images = list(images)
+        if images and all(is_dicom_dataset(image) for image in images):
+            images = sort_series(images)
+    count = len(images)
+    assert count > 0, "The stack is empty."
+    zoom_factor = float(zoom_factor) if isinstance(zoom_factor, int) else zoom_factor
 
-    return components.html(html_code, width=resized_size[0], height=resized_size[1])
+    index = count // 2 if index is None else min(max(int(index), 0), count - 1)
+    if count > 1:
+        index = st.slider("Slice", min_value=1, max_value=count, value=index + 1, key=key) - 1
+
+    display_size = compute_size(images[index], size, keep_aspect_ratio)
+    frames = []
+    for i in stack_window(index, count, prefetch):
+        src, slice_params = serve_slice(images[i], display_size, keep_aspect_ratio)
+        frames.append({"index": i, "src": src, "params": slice_params})
+
+    params = None
+    current = next(frame["params"] for frame in frames if frame["index"] == index)
+    if current is not None:
+        params = {name: current[name] for name in ("center", "window", "invert", "step")}
+        if window is not None:
+            params["center"], params["window"] = float(window[0]), max(float(window[1]), 1.0)
+        if invert is not None:
+            params["invert"] = bool(invert)
+        # A stack is windowed as a whole; slices that aren't window/level slices can't be mixed in.
+        assert all(frame["params"] is not None for frame in frames), "Window/level and 8-bit slices can't be mixed."
+
+    html_code = stack_html(frames, index, count, params, display_size, zoom_factor, increment, fps)
+    return components.html(html_code, width=display_size[0], height=display_size[1])
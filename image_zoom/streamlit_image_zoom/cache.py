@@ -0,0 +1,168 @@
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Union
+
+import numpy as np
+from PIL import Image
+
+
+# Digests of decoded images by object id: (weak reference, version token, digest).
+_digests = {}
+_digests_lock = threading.Lock()
+VERSION_SAMPLES = 64
+
+
+def image_digest(image: Union[Image.Image, np.ndarray]) -> str:
+    """
+    Hash the content of an image.
+
+    Images opened with Image.open that haven't been decoded yet are hashed by their encoded source (the bytes of an
+    in-memory file, or the path, size and modification time of a file on disk), so they are never decoded just to
+    be hashed. Decoded images and arrays are hashed in full the first time they are seen; after that the same
+    object is recognised by its identity and a cheap version token (see version_token), so an image kept across
+    reruns isn't rehashed on every rerun.
+
+    Args:
+        image (Union[Image.Image, np.ndarray]): The image to hash.
+
+    Returns:
+        str: A hex digest that changes whenever the pixels, mode/dtype or size change.
+
+    """
+    if not isinstance(image, np.ndarray):
+        fp = getattr(image, "fp", None)
+        if getattr(image, "tile", None) and (hasattr(fp, "getbuffer") or getattr(image, "filename", None)):
+            return _hash_image(image)
+    key, version = id(image), version_token(image)
+    with _digests_lock:
+        entry = _digests.get(key)
+    if entry is not None and entry[0]() is image and entry[1] == version:
+        return entry[2]
+    digest = _hash_image(image)
+    with _digests_lock:
+        _digests[key] = (weakref.ref(image, lambda _, key=key: _forget(key)), version, digest)
+    return digest
+
+
+def version_token(image: Union[Image.Image, np.ndarray]) -> tuple:
+    """
+    A cheap token that changes when a decoded image is replaced or resized, and usually when it is edited in place.
+
+    It holds the mode/dtype, the size, the pixel buffer and a sparse sample of pixels. Edits in place that miss
+    every sampled pixel go unnoticed, so pass a copy of an image that is drawn on between reruns.
+
+    Args:
+        image (Union[Image.Image, np.ndarray]): A decoded image.
+
+    Returns:
+        tuple: The token.
+
+    """
+    if isinstance(image, np.ndarray):
+        sample = image.flat[np.linspace(0, image.size - 1, VERSION_SAMPLES).astype(np.intp)] if image.size else ()
+        return (image.dtype.str, image.shape, image.strides, image.__array_interface__["data"][0],
+                bytes(np.ascontiguousarray(sample).data))
+    image.load()
+    width, height = image.size
+    points = np.linspace(0, width * height - 1, VERSION_SAMPLES).astype(np.intp) if width and height else ()
+    return (image.mode, image.size, id(image.im), tuple(image.getpixel((int(p % width), int(p // width)))
+                                                       for p in points))
+
+
+def _forget(key: int) -> None:
+    with _digests_lock:
+        _digests.pop(key, None)
+
+
+def _hash_image(image: Union[Image.Image, np.ndarray]) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(image, np.ndarray):
+        digest.update(f"{image.dtype.str}{image.shape}".encode())
+        digest.update(np.ascontiguousarray(image).data)
+    else:
+        digest.update(f"{image.mode}{image.size}".encode())
+        fp = getattr(image, "fp", None)
+        if getattr(image, "tile", None) and hasattr(fp, "getbuffer"):
+            digest.update(fp.getbuffer())
+        elif getattr(image, "tile", None) and getattr(image, "filename", None):
+            stat = os.stat(image.filename)
+            digest.update(f"{os.path.abspath(image.filename)}{stat.st_size}{stat.st_mtime_ns}".encode())
+        else:
+            digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def value_nbytes(value: Any) -> int:
+    """Count the bytes held by a cached value (bytes nested in tuples, lists and dicts)."""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(value_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(value_nbytes(v) for v in value)
+    return 0
+
+
+class EncodeCache:
+    """
+    A thread-safe LRU cache of encoded images, bounded by the total number of bytes held.
+
+    Args:
+        max_bytes (int): The byte budget. The least recently used entries are evicted past it.
+
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        nbytes = value_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def get_or_create(self, key: Hashable, create: Callable[[], Any]) -> Any:
+        """
+        Return the cached value for key, calling create() and caching its result on a miss.
+
+        Args:
+            key (Hashable): The cache key. It should include everything the value depends on.
+            create (Callable[[], Any]): Builds the value.
+
+        Returns:
+            Any: The cached or newly created value.
+
+        """
+        value = self.get(key)
+        if value is None:
+            value = create()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# Shared by every session of the process.
+encode_cache = EncodeCache()
@@ -0,0 +1,341 @@
+// Zoom viewer of streamlit_image_zoom.
+//
+// Talks to Streamlit with the component postMessage protocol directly (no streamlit-component-lib bundle):
+// announces itself with "streamlit:componentReady", gets its arguments in "streamlit:render" events and
+// reports the visible part of the image back with "streamlit:setComponentValue", so Python can send a
+// native resolution crop of just that region.
+
+// Zoom handlers
+//
+// Pointer events only record where the pointer is; all style writes happen once per frame in ZoomView.render.
+// The container's position is measured on resize and scroll, never while handling pointer events, and the
+// image is moved with a composited translate/scale transform rather than left/top.
+
+function ZoomView(selector, keep_resolution) {
+    const image = document.getElementById(selector);
+    const container = image.parentElement;
+    const resizedSrc = image.getAttribute('src');
+    const originalSrc = keep_resolution ? image.getAttribute('data-original-src') : null;
+    const view = {
+        image: image,
+        container: container,
+        scale: 1,
+        tx: 0,
+        ty: 0,
+        transition: false,
+        cursor: 'zoom-in',
+    };
+    let left = 0, top = 0, width = 0, height = 0;
+    let frame = null, swapped = false;
+
+    function measure() {
+        const rect = container.getBoundingClientRect();
+        left = rect.left;
+        top = rect.top;
+        width = rect.width;
+        height = rect.height;
+    }
+
+    function render() {
+        frame = null;
+        // The original is swapped in once when a zoom session starts and swapped out when it ends.
+        if (originalSrc && view.scale > 1 && !swapped) {
+            image.src = originalSrc;
+            swapped = true;
+        } else if (originalSrc && view.scale === 1 && swapped) {
+            image.src = resizedSrc;
+            swapped = false;
+        }
+        image.style.transition = view.transition ? 'transform 0.2s ease' : 'none';
+        image.style.transform = `translate3d(${view.tx}px, ${view.ty}px, 0) scale(${view.scale})`;
+        container.style.cursor = view.cursor;
+    }
+
+    view.schedule = function() {
+        if (frame === null) {
+            frame = requestAnimationFrame(render);
+        }
+    };
+
+    view.point = function(event) {
+        return { x: event.clientX - left, y: event.clientY - top };
+    };
+
+    view.zoomAt = function(scale, x, y) {
+        // Scale with the point (x, y) of the unzoomed image staying under (x, y).
+        view.scale = scale;
+        view.tx = x * (1 - scale);
+        view.ty = y * (1 - scale);
+    };
+
+    view.panTo = function(tx, ty) {
+        view.tx = Math.min(0, Math.max(width * (1 - view.scale), tx));
+        view.ty = Math.min(0, Math.max(height * (1 - view.scale), ty));
+    };
+
+    view.reset = function() {
+        view.scale = 1;
+        view.tx = 0;
+        view.ty = 0;
+    };
+
+    measure();
+    if (typeof ResizeObserver !== 'undefined') {
+        new ResizeObserver(measure).observe(container);
+    }
+    window.addEventListener('resize', measure);
+    window.addEventListener('scroll', measure, { passive: true, capture: true });
+    return view;
+}
+
+function ImageZoomMouseMove(selector, scale_factor, keep_resolution) {
+    const view = ZoomView(selector, keep_resolution);
+
+    view.container.addEventListener('mousemove', function(event) {
+        const p = view.point(event);
+        view.zoomAt(scale_factor, p.x, p.y);
+        view.schedule();
+    });
+
+    view.container.addEventListener('mouseleave', function() {
+        view.reset();
+        view.schedule();
+    });
+}
+
+function ImageZoomScroll(selector, scale_factor, increment, keep_resolution) {
+    const view = ZoomView(selector, keep_resolution);
+    let scale = 1;
+
+    view.container.addEventListener('wheel', function(event) {
+        event.preventDefault();
+        scale = Math.max(1, Math.min(scale_factor, scale + (event.deltaY > 0 ? -increment : increment)));
+        const p = view.point(event);
+        view.zoomAt(scale, p.x, p.y);
+        view.schedule();
+    }, { passive: false });
+
+    view.container.addEventListener('mouseleave', function() {
+        scale = 1;
+        view.reset();
+        view.schedule();
+    });
+}
+
+function ImageZoomBoth(selector, scale_factor, increment, keep_resolution) {
+    const view = ZoomView(selector, keep_resolution);
+    let scale = 1;
+    let point = { x: 0, y: 0 };
+
+    view.container.addEventListener('mousemove', function(event) {
+        point = view.point(event);
+        view.zoomAt(scale, point.x, point.y);
+        view.schedule();
+    });
+
+    view.container.addEventListener('wheel', function(event) {
+        event.preventDefault();
+        scale = Math.max(1, Math.min(scale_factor, scale + (event.deltaY > 0 ? -increment : increment)));
+        point = view.point(event);
+        view.zoomAt(scale, point.x, point.y);
+        view.schedule();
+    }, { passive: false });
+
+    view.container.addEventListener('mouseleave', function() {
+        scale = 1;
+        view.reset();
+        view.schedule();
+    });
+}
+
+function ImageDragMove(selector, scale_factor, keep_resolution) {
+    const view = ZoomView(selector, keep_resolution);
+    let drag = null, click = null;
+
+    view.container.addEventListener('mousedown', function(event) {
+        if (view.scale > 1) {
+            // Start dragging
+            drag = { x: event.clientX, y: event.clientY, tx: view.tx, ty: view.ty };
+            view.transition = false;
+            view.cursor = 'grabbing';
+            view.schedule();
+        } else {
+            // Record click position for zooming in
+            click = { x: event.clientX, y: event.clientY };
+        }
+        event.preventDefault();
+    });
+
+    document.addEventListener('mousemove', function(event) {
+        if (drag) {
+            view.panTo(drag.tx + event.clientX - drag.x, drag.ty + event.clientY - drag.y);
+            view.schedule();
+        }
+    });
+
+    document.addEventListener('mouseup', function(event) {
+        if (drag) {
+            drag = null;
+            view.cursor = 'grab';
+            view.schedule();
+        } else if (click && Math.abs(event.clientX - click.x) < 5 && Math.abs(event.clientY - click.y) < 5) {
+            // Zoom in on click
+            const p = view.point(event);
+            view.zoomAt(scale_factor, p.x, p.y);
+            view.transition = true;
+            view.cursor = 'grab';
+            view.schedule();
+        }
+        click = null;
+    });
+
+    view.container.addEventListener('dblclick', function() {
+        // Zoom out
+        drag = null;
+        view.reset();
+        view.transition = true;
+        view.cursor = 'zoom-in';
+        view.schedule();
+    });
+}
+
+// Streamlit component protocol
+
+function sendMessage(type, data) {
+    window.parent.postMessage(Object.assign({ isStreamlitMessage: true, type: type }, data), '*');
+}
+
+function setComponentValue(value) {
+    sendMessage('streamlit:setComponentValue', { value: value, dataType: 'json' });
+}
+
+function setFrameHeight(height) {
+    sendMessage('streamlit:setFrameHeight', { height: height });
+}
+
+// Viewport reporting
+
+function ViewportReporter(container, image, roi, delay) {
+    let timer = null;
+    let reported = 'null';
+
+    function measure() {
+        // The visible part of the image, from the transformed image and the container, whatever the handler
+        // moved it with.
+        const c = container.getBoundingClientRect();
+        const i = image.getBoundingClientRect();
+        const zoom = i.width / c.width;
+        if (zoom < 1.01) {
+            return null;
+        }
+        const x0 = Math.max(0, (c.left - i.left) / i.width), x1 = Math.min(1, (c.right - i.left) / i.width);
+        const y0 = Math.max(0, (c.top - i.top) / i.height), y1 = Math.min(1, (c.bottom - i.top) / i.height);
+        return {
+            viewport: [x0, y0, x1 - x0, y1 - y0].map((v) => Math.round(v * 10000) / 10000),
+            zoom: Math.round(zoom * 100) / 100,
+            pixelRatio: window.devicePixelRatio || 1,
+        };
+    }
+
+    function report() {
+        timer = null;
+        const value = measure();
+        const key = JSON.stringify(value && value.viewport);
+        if (key !== reported) {
+            reported = key;
+            setComponentValue(value);
+        }
+    }
+
+    // Any move hides the region of interest; it is reported once the view has been still for `delay` ms.
+    new MutationObserver(function() {
+        roi.style.display = 'none';
+        clearTimeout(timer);
+        timer = setTimeout(report, delay);
+    }).observe(image, { attributes: true, attributeFilter: ['style', 'src'] });
+
+    function place(value) {
+        // Only if the view hasn't moved since the region was requested.
+        if (timer !== null || JSON.stringify(value.viewport) !== reported) {
+            return;
+        }
+        const c = container.getBoundingClientRect();
+        const i = image.getBoundingClientRect();
+        const [rx, ry, rw, rh] = value.region;
+        roi.style.left = (i.left - c.left + rx * i.width) + 'px';
+        roi.style.top = (i.top - c.top + ry * i.height) + 'px';
+        roi.style.width = (rw * i.width) + 'px';
+        roi.style.height = (rh * i.height) + 'px';
+        roi.style.display = 'block';
+    }
+
+    return {
+        showRoi: function(value) {
+            if (!value) {
+                roi.style.display = 'none';
+                return;
+            }
+            if (roi.getAttribute('src') === value.src) {
+                place(value);
+            } else {
+                roi.onload = () => place(value);
+                roi.src = value.src;
+            }
+        },
+    };
+}
+
+function createViewer(args) {
+    const root = document.getElementById('root');
+    root.innerHTML = '';
+    const container = document.createElement('div');
+    container.id = 'container';
+    container.style.width = args.width + 'px';
+    container.style.height = args.height + 'px';
+    const image = document.createElement('img');
+    image.id = 'image';
+    image.src = args.src;
+    if (args.original) {
+        image.setAttribute('data-original-src', args.original.src);
+        image.setAttribute('data-original-width', args.original.width);
+        image.setAttribute('data-original-height', args.original.height);
+    }
+    const roi = document.createElement('img');
+    roi.id = 'roi';
+    container.appendChild(image);
+    container.appendChild(roi);
+    root.appendChild(container);
+
+    const keep_resolution = Boolean(args.original);
+    if (args.mode == "mousemove" || args.mode == "default") {
+        ImageZoomMouseMove('image', args.zoom_factor, keep_resolution);
+    } else if (args.mode == "scroll") {
+        ImageZoomScroll('image', args.zoom_factor, args.increment, keep_resolution);
+    } else if (args.mode == "both") {
+        ImageZoomBoth('image', args.zoom_factor, args.increment, keep_resolution);
+    } else if (args.mode == "dragmove") {
+        ImageDragMove('image', args.zoom_factor, keep_resolution);
+    }
+    return ViewportReporter(container, image, roi, args.report_delay);
+}
+
+let viewerKey = null;
+let viewer = null;
+
+window.addEventListener('message', function(event) {
+    if (!event.data || event.data.type !== 'streamlit:render') {
+        return;
+    }
+    const args = event.data.args;
+    // Reruns that only bring a new region of interest keep the viewer (and its zoom) as it is.
+    const key = JSON.stringify([args.src, args.width, args.height, args.mode, args.zoom_factor, args.increment,
+                                args.original]);
+    if (key !== viewerKey) {
+        viewerKey = key;
+        viewer = createViewer(args);
+        setFrameHeight(args.height);
+    }
+    viewer.showRoi(args.roi);
+});
+
+sendMessage('streamlit:componentReady', { apiVersion: 1 });
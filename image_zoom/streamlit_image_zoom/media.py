@@ -0,0 +1,44 @@
+import base64
+import hashlib
+from typing import Optional
+
+from streamlit import runtime
+
+
+def bytes_to_data_uri(data: bytes, mimetype: str) -> str:
+    """
+    Encode bytes as a base64 data URI.
+
+    Args:
+        data (bytes): The encoded image.
+        mimetype (str): The mime type of the image, e.g. "image/jpeg".
+
+    Returns:
+        str: The data URI.
+
+    """
+    return f"data:{mimetype};base64, {base64.b64encode(data).decode()}"
+
+
+def register_media(data: bytes, mimetype: str, digest: Optional[str] = None) -> str:
+    """
+    Serve encoded bytes through Streamlit's media file manager and return their URL.
+
+    The URL is derived from a hash of the content, so the same image keeps the same URL across reruns and the
+    browser only downloads it once. Outside a Streamlit runtime (bare mode) a data URI is returned instead.
+
+    Args:
+        data (bytes): The encoded image.
+        mimetype (str): The mime type of the image, e.g. "image/jpeg".
+        digest (Optional[str]): A precomputed content hash of data, to skip hashing it again.
+
+    Returns:
+        str: A URL (or data URI) the component can use as an image src.
+
+    """
+    if not runtime.exists():
+        return bytes_to_data_uri(data, mimetype)
+    # One coordinate per content hash: the file stays registered as long as a rerun keeps referencing it.
+    digest = digest or hashlib.blake2b(data, digest_size=16).hexdigest()
+    coordinates = f"streamlit_image_zoom.{digest}"
+    return runtime.get_instance().media_file_mgr.add(data, mimetype, coordinates)
@@ -0,0 +1,270 @@
+import json
+from typing import Any, Callable, Dict, Tuple
+
+from PIL import Image
+
+
+def pyramid_sizes(display_size: Tuple[int, int], full_size: Tuple[int, int], max_scale: float) -> list:
+    """
+    Compute the level sizes of a power-of-two image pyramid.
+
+    Args:
+        display_size (Tuple[int, int]): The (width, height) the image is displayed at. This is the coarsest level.
+        full_size (Tuple[int, int]): The (width, height) of the source image.
+        max_scale (float): The largest zoom factor the viewer allows.
+
+    Returns:
+        list: (width, height) of every level, coarsest first. Each level doubles the previous one until the
+            resolution needed at max_scale on a HiDPI display (or the source resolution) is reached.
+    """
+    width, height = display_size
+    target = min(full_size[0], int(width * max_scale * 2))
+    sizes = [(width, height)]
+    while sizes[-1][0] < target:
+        next_width = min(sizes[-1][0] * 2, full_size[0])
+        next_height = min(sizes[-1][1] * 2, full_size[1])
+        if next_width == full_size[0]:
+            next_height = full_size[1]
+        sizes.append((next_width, next_height))
+    return sizes
+
+
+def build_pyramid(
+    image: Image.Image,
+    display_size: Tuple[int, int],
+    max_scale: float,
+    encode: Callable[[Image.Image], Any],
+    tile_size: int = 256,
+) -> Dict:
+    """
+    Cut an image into tiles at every pyramid level.
+
+    Args:
+        image (Image.Image): The full-resolution source image.
+        display_size (Tuple[int, int]): The (width, height) the image is displayed at.
+        max_scale (float): The largest zoom factor the viewer allows. Levels finer than needed for it are skipped.
+        encode (Callable[[Image.Image], Any]): Encodes a tile. Its result is stored as the tile's data.
+        tile_size (int): Width and height of a tile in pixels. Default is 256.
+
+    Returns:
+        Dict: {"tileSize": int, "levels": [{"width", "height", "tiles": {"col_row": data}}]}, coarsest level first.
+    """
+    sizes = pyramid_sizes(display_size, image.size, max_scale)
+    levels = []
+    # Build from the finest level down so every resize starts from a smaller image.
+    level_image = image if sizes[-1] == image.size else image.resize(sizes[-1], reducing_gap=3.0)
+    for width, height in reversed(sizes):
+        if level_image.size != (width, height):
+            level_image = level_image.resize((width, height), reducing_gap=3.0)
+        tiles = {}
+        for top in range(0, height, tile_size):
+            for left in range(0, width, tile_size):
+                tile = level_image.crop((left, top, min(left + tile_size, width), min(top + tile_size, height)))
+                tiles[f"{left // tile_size}_{top // tile_size}"] = encode(tile)
+        levels.append({"width": width, "height": height, "tiles": tiles})
+    levels.reverse()
+    return {"tileSize": tile_size, "levels": levels}
+
+
+def pyramid_sources(pyramid: Dict, to_src: Callable[[Any], str]) -> Dict:
+    """
+    Replace the encoded tiles of a pyramid with the URLs they are served at.
+
+    Args:
+        pyramid (Dict): The output of build_pyramid.
+        to_src (Callable[[Any], str]): Serves a tile's data (as returned by encode) and returns its URL.
+
+    Returns:
+        Dict: A pyramid of the same shape with URLs in place of tile data.
+    """
+    return {
+        "tileSize": pyramid["tileSize"],
+        "levels": [
+            {"width": level["width"], "height": level["height"],
+             "tiles": {key: to_src(data) for key, data in level["tiles"].items()}}
+            for level in pyramid["levels"]
+        ],
+    }
+
+
+def pyramid_html(pyramid: Dict, display_size: Tuple[int, int], zoom_factor: float, increment: float) -> str:
+    """
+    Assemble the HTML of the pyramid viewer.
+
+    Scroll zooms around the cursor, click and drag pans and double-click resets the view. Only the tiles of the
+    level matching the current zoom that intersect the viewport are loaded, and they fade in over the coarser
+    levels as they arrive.
+
+    Args:
+        pyramid (Dict): The output of pyramid_sources.
+        display_size (Tuple[int, int]): The (width, height) of the viewer.
+        zoom_factor (float): The maximum zoom factor.
+        increment (float): The zoom step per scroll event.
+
+    Returns:
+        str: The HTML code of the viewer.
+    """
+    css_code = """
+        <style>
+            #container {
+                position: relative;
+                overflow: hidden;
+                cursor: zoom-in;
+            }
+            #stage {
+                position: absolute;
+                top: 0;
+                left: 0;
+                width: 100%;
+                height: 100%;
+                transform-origin: 0 0;
+                will-change: transform;
+            }
+            .pyramid-layer {
+                position: absolute;
+                inset: 0;
+            }
+            .pyramid-layer img {
+                position: absolute;
+                display: block;
+                opacity: 0;
+                transition: opacity 0.2s ease;
+                user-select: none;
+                -webkit-user-drag: none;
+            }
+        </style>
+    """
+    js_code = """
+        <script>
+            function ImagePyramid(containerId, stageId, pyramid, max_scale, increment) {
+                const container = document.getElementById(containerId);
+                const stage = document.getElementById(stageId);
+                const width = container.clientWidth;
+                const height = container.clientHeight;
+                const tileSize = pyramid.tileSize;
+                let scale = 1, tx = 0, ty = 0;
+                let frame = null, drag = null;
+
+                const layers = pyramid.levels.map((level, i) => {
+                    const layer = document.createElement('div');
+                    layer.className = 'pyramid-layer';
+                    layer.style.zIndex = i + 1;
+                    stage.appendChild(layer);
+                    return { level: level, layer: layer, loaded: new Set() };
+                });
+
+                function clamp() {
+                    tx = Math.min(0, Math.max(width - width * scale, tx));
+                    ty = Math.min(0, Math.max(height - height * scale, ty));
+                }
+
+                function pickLayer() {
+                    const needed = width * scale * (window.devicePixelRatio || 1);
+                    for (const layer of layers) {
+                        if (layer.level.width >= needed) {
+                            return layer;
+                        }
+                    }
+                    return layers[layers.length - 1];
+                }
+
+                function loadVisibleTiles() {
+                    const target = pickLayer();
+                    const level = target.level;
+                    // Visible part of the stage in display pixels, then in level pixels.
+                    const fx = level.width / width, fy = level.height / height;
+                    const x0 = (-tx / scale) * fx, x1 = ((width - tx) / scale) * fx;
+                    const y0 = (-ty / scale) * fy, y1 = ((height - ty) / scale) * fy;
+                    const cols = Math.ceil(level.width / tileSize), rows = Math.ceil(level.height / tileSize);
+                    const c0 = Math.max(0, Math.floor(x0 / tileSize)), c1 = Math.min(cols - 1, Math.floor((x1 - 1) / tileSize));
+                    const r0 = Math.max(0, Math.floor(y0 / tileSize)), r1 = Math.min(rows - 1, Math.floor((y1 - 1) / tileSize));
+                    for (let r = r0; r <= r1; r++) {
+                        for (let c = c0; c <= c1; c++) {
+                            const key = c + '_' + r;
+                            if (target.loaded.has(key)) {
+                                continue;
+                            }
+                            target.loaded.add(key);
+                            const tileWidth = Math.min(tileSize, level.width - c * tileSize);
+                            const tileHeight = Math.min(tileSize, level.height - r * tileSize);
+                            const img = new Image();
+                            img.style.left = (c * tileSize / level.width * 100) + '%';
+                            img.style.top = (r * tileSize / level.height * 100) + '%';
+                            img.style.width = (tileWidth / level.width * 100) + '%';
+                            img.style.height = (tileHeight / level.height * 100) + '%';
+                            img.onload = () => { img.style.opacity = 1; };
+                            img.src = level.tiles[key];
+                            target.layer.appendChild(img);
+                        }
+                    }
+                }
+
+                function render() {
+                    frame = null;
+                    stage.style.transform = `translate(${tx}px, ${ty}px) scale(${scale})`;
+                    container.style.cursor = scale > 1 ? (drag ? 'grabbing' : 'grab') : 'zoom-in';
+                    loadVisibleTiles();
+                }
+
+                function schedule() {
+                    if (frame === null) {
+                        frame = requestAnimationFrame(render);
+                    }
+                }
+
+                container.addEventListener('wheel', function(event) {
+                    event.preventDefault();
+                    const rect = container.getBoundingClientRect();
+                    const px = event.clientX - rect.left, py = event.clientY - rect.top;
+                    const next = Math.max(1, Math.min(max_scale, scale + (event.deltaY > 0 ? -increment : increment)));
+                    // Keep the point under the cursor fixed.
+                    tx = px - (px - tx) * (next / scale);
+                    ty = py - (py - ty) * (next / scale);
+                    scale = next;
+                    clamp();
+                    schedule();
+                }, { passive: false });
+
+                container.addEventListener('mousedown', function(event) {
+                    drag = { x: event.clientX, y: event.clientY, tx: tx, ty: ty };
+                    event.preventDefault();
+                    schedule();
+                });
+
+                document.addEventListener('mousemove', function(event) {
+                    if (drag) {
+                        tx = drag.tx + event.clientX - drag.x;
+                        ty = drag.ty + event.clientY - drag.y;
+                        clamp();
+                        schedule();
+                    }
+                });
+
+                document.addEventListener('mouseup', function() {
+                    if (drag) {
+                        drag = null;
+                        schedule();
+                    }
+                });
+
+                container.addEventListener('dblclick', function() {
+                    scale = 1;
+                    tx = 0;
+                    ty = 0;
+                    schedule();
+                });
+
+                render();
+            };
+        </script>
+    """
+    return f"""
+        {css_code}
+        <div id="container" style="width: {display_size[0]}px; height: {display_size[1]}px;">
+            <div id="stage"></div>
+        </div>
+        {js_code}
+        <script>
+        ImagePyramid('container', 'stage', {json.dumps(pyramid)}, {zoom_factor}, {increment});
+        </script>
+    """
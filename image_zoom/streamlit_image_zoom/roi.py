@@ -0,0 +1,47 @@
+import math
+from typing import Dict, Optional, Tuple
+
+# Regions are snapped outward to this grid (in source pixels), so small pans map to the same cached crop.
+ROI_GRID = 32
+
+
+def roi_request(
+    viewport: Optional[Dict], full_size: Tuple[int, int], display_size: Tuple[int, int], grid: int = ROI_GRID
+) -> Optional[Tuple[Tuple[int, int, int, int], Tuple[int, int]]]:
+    """
+    Work out which part of the source to crop for a viewport reported by the viewer, and at what size.
+
+    Args:
+        viewport (Optional[Dict]): The component value: {"viewport": [x, y, width, height] as fractions of the
+            image, "zoom": float, "pixelRatio": float}, or None when the image isn't zoomed.
+        full_size (Tuple[int, int]): The (width, height) of the source image.
+        display_size (Tuple[int, int]): The (width, height) the image is displayed at.
+        grid (int): The grid the region is snapped to, in source pixels.
+
+    Returns:
+        Optional[Tuple[Tuple[int, int, int, int], Tuple[int, int]]]: The (left, top, right, bottom) box in source
+            pixels and the (width, height) to encode it at, or None if the displayed image already has all the
+            detail the viewport can show. The output size follows the on-screen size of the region in device
+            pixels (rounded up to a power of sqrt(2) of the source resolution, capped at 1:1), so it doesn't
+            depend on how large the source is.
+    """
+    if not viewport:
+        return None
+    x, y, w, h = (float(v) for v in viewport["viewport"])
+    zoom = float(viewport.get("zoom") or 1)
+    ratio = min(max(float(viewport.get("pixelRatio") or 1), 1.0), 3.0)
+    full_width, full_height = full_size
+
+    needed = display_size[0] * zoom * ratio / full_width
+    if display_size[0] * ratio / full_width >= 1 or needed <= display_size[0] / full_width:
+        return None
+    scale = min(1.0, 2 ** (math.ceil(math.log2(needed) * 2) / 2))
+
+    left = max(0, int(x * full_width) // grid * grid)
+    top = max(0, int(y * full_height) // grid * grid)
+    right = min(full_width, -(-math.ceil((x + w) * full_width) // grid) * grid)
+    bottom = min(full_height, -(-math.ceil((y + h) * full_height) // grid) * grid)
+    if right <= left or bottom <= top:
+        return None
+    out_size = (max(1, round((right - left) * scale)), max(1, round((bottom - top) * scale)))
+    return (left, top, right, bottom), out_size
@@ -0,0 +1,342 @@
+import json
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+def sort_series(datasets: Sequence) -> list:
+    """
+    Sort the datasets of a DICOM series into slice order.
+
+    Args:
+        datasets (Sequence): pydicom Datasets of one series.
+
+    Returns:
+        list: The datasets ordered by their position along the slice normal (ImagePositionPatient projected on
+            the cross product of the ImageOrientationPatient vectors), or by InstanceNumber when the geometry
+            is missing.
+    """
+
+    def position(dataset):
+        ipp = getattr(dataset, "ImagePositionPatient", None)
+        iop = getattr(dataset, "ImageOrientationPatient", None)
+        if ipp is not None and iop is not None and len(ipp) == 3 and len(iop) == 6:
+            iop = [float(v) for v in iop]
+            return float(np.dot(np.cross(iop[:3], iop[3:]), [float(v) for v in ipp]))
+        return float(getattr(dataset, "InstanceNumber", 0) or 0)
+
+    return sorted(datasets, key=position)
+
+
+def stack_window(index: int, count: int, prefetch: int) -> range:
+    """
+    Compute the slices sent to the browser around the current one.
+
+    Args:
+        index (int): The current slice.
+        count (int): The number of slices in the stack.
+        prefetch (int): The number of slices before and after the current one to send.
+
+    Returns:
+        range: The slice indices of the window, shifted to stay within the stack when index is near either end.
+    """
+    size = min(count, 2 * prefetch + 1)
+    start = min(max(0, index - prefetch), count - size)
+    return range(start, start + size)
+
+
+def stack_html(
+    frames: List[Dict],
+    index: int,
+    total: int,
+    params: Optional[Dict],
+    display_size: Tuple[int, int],
+    zoom_factor: float,
+    increment: float,
+    fps: float,
+) -> str:
+    """
+    Assemble the HTML of the stack viewer.
+
+    Every slice of the window is fetched and decoded as soon as the viewer loads, the current one first, then
+    outwards, so scrolling through the window never waits on the network or an image decoder. Scroll moves
+    through the slices, Ctrl+scroll zooms around the cursor, click and drag pans, the play button loops through
+    the window at fps, and double-click resets the view. Window/level stacks are windowed like in windowing_html
+    (right-click and drag), with one window shared by all slices.
+
+    Args:
+        frames (List[Dict]): {"index", "src", "params"} of every slice in the window, in order. params holds the
+            rescale parameters of window/level slices and is None for 8-bit slices.
+        index (int): The slice shown first.
+        total (int): The number of slices in the whole stack.
+        params (Optional[Dict]): The initial {"center", "window", "invert", "step"} for window/level stacks,
+            None for 8-bit stacks.
+        display_size (Tuple[int, int]): The (width, height) of the viewer.
+        zoom_factor (float): The maximum zoom factor.
+        increment (float): The zoom step per Ctrl+scroll event.
+        fps (float): The frame rate of the cine loop.
+
+    Returns:
+        str: The HTML code of the viewer.
+    """
+    css_code = """
+        <style>
+            #container {
+                position: relative;
+                overflow: hidden;
+                background: black;
+            }
+            #canvas {
+                position: absolute;
+                top: 0;
+                left: 0;
+                width: 100%;
+                height: 100%;
+                transform-origin: 0 0;
+                will-change: transform;
+            }
+            #readout {
+                position: absolute;
+                left: 6px;
+                bottom: 4px;
+                color: #ddd;
+                font: 12px sans-serif;
+                text-shadow: 0 0 2px black;
+                pointer-events: none;
+            }
+            #play {
+                position: absolute;
+                right: 6px;
+                bottom: 4px;
+                border: none;
+                background: rgba(0, 0, 0, 0.5);
+                color: #ddd;
+                cursor: pointer;
+            }
+        </style>
+    """
+    js_code = """
+        <script>
+            function ImageStack(containerId, canvasId, readoutId, playId, frames, start, total, params, max_scale, increment, fps) {
+                const container = document.getElementById(containerId);
+                const canvas = document.getElementById(canvasId);
+                const readout = document.getElementById(readoutId);
+                const play = document.getElementById(playId);
+                const ctx = canvas.getContext('2d');
+                const width = container.clientWidth;
+                const height = container.clientHeight;
+                const windowed = params !== null;
+                const lut = windowed ? new Uint8ClampedArray(65536) : null;
+                const loaded = new Array(frames.length).fill(null);
+                let position = Math.max(0, frames.findIndex((f) => f.index === start));
+                let center = windowed ? params.center : 0, windowWidth = windowed ? params.window : 0;
+                let lutKey = null, output = null, shown = -1;
+                let scale = 1, tx = 0, ty = 0;
+                let frame = null, drag = null, windowDrag = null, timer = null;
+
+                function decode(i) {
+                    return fetch(frames[i].src)
+                        .then((response) => response.blob())
+                        .then((blob) => createImageBitmap(blob, { colorSpaceConversion: 'none', premultiplyAlpha: 'none' }))
+                        .then((bitmap) => {
+                            if (!windowed) {
+                                loaded[i] = { bitmap: bitmap, width: bitmap.width, height: bitmap.height };
+                            } else {
+                                // Unpack the high and low bytes (red and green) into stored pixel values.
+                                const scratch = document.createElement('canvas');
+                                scratch.width = bitmap.width;
+                                scratch.height = bitmap.height;
+                                const scratchCtx = scratch.getContext('2d');
+                                scratchCtx.drawImage(bitmap, 0, 0);
+                                const packed = scratchCtx.getImageData(0, 0, bitmap.width, bitmap.height).data;
+                                const raw = new Uint16Array(bitmap.width * bitmap.height);
+                                for (let p = 0, j = 0; p < raw.length; p++, j += 4) {
+                                    raw[p] = (packed[j] << 8) | packed[j + 1];
+                                }
+                                loaded[i] = { raw: raw, width: bitmap.width, height: bitmap.height, params: frames[i].params };
+                                bitmap.close();
+                            }
+                            if (i === position) {
+                                shown = -1;
+                                schedule();
+                            }
+                        });
+                }
+
+                function paint(slice) {
+                    if (canvas.width !== slice.width || canvas.height !== slice.height) {
+                        canvas.width = slice.width;
+                        canvas.height = slice.height;
+                        output = null;
+                    }
+                    if (!windowed) {
+                        ctx.drawImage(slice.bitmap, 0, 0);
+                        return;
+                    }
+                    const key = [slice.params.slope, slice.params.intercept, center, windowWidth, params.invert].join();
+                    if (key !== lutKey) {
+                        const low = center - 0.5 - (windowWidth - 1) / 2;
+                        const range = Math.max(windowWidth - 1, 1);
+                        for (let v = 0; v < 65536; v++) {
+                            const y = ((slice.params.slope * v + slice.params.intercept) - low) / range * 255;
+                            lut[v] = params.invert ? 255 - y : y;
+                        }
+                        lutKey = key;
+                    }
+                    if (output === null) {
+                        output = ctx.createImageData(slice.width, slice.height);
+                        for (let j = 3; j < output.data.length; j += 4) {
+                            output.data[j] = 255;
+                        }
+                    }
+                    const out = output.data, raw = slice.raw;
+                    for (let p = 0, j = 0; p < raw.length; p++, j += 4) {
+                        const g = lut[raw[p]];
+                        out[j] = g;
+                        out[j + 1] = g;
+                        out[j + 2] = g;
+                    }
+                    ctx.putImageData(output, 0, 0);
+                }
+
+                function clamp() {
+                    tx = Math.min(0, Math.max(width - width * scale, tx));
+                    ty = Math.min(0, Math.max(height - height * scale, ty));
+                }
+
+                function render() {
+                    frame = null;
+                    // Until a slice arrives, the last decoded one stays on screen.
+                    if (loaded[position] && shown !== position) {
+                        paint(loaded[position]);
+                        shown = position;
+                    }
+                    canvas.style.transform = `translate(${tx}px, ${ty}px) scale(${scale})`;
+                    container.style.cursor = windowDrag ? 'crosshair' : scale > 1 ? (drag ? 'grabbing' : 'grab') : 'default';
+                    let text = `${frames[position].index + 1} / ${total}`;
+                    if (windowed) {
+                        text += `  WC ${Math.round(center)}  WW ${Math.round(windowWidth)}`;
+                    }
+                    readout.textContent = text;
+                    play.textContent = timer === null ? '\\u25B6' : '\\u275A\\u275A';
+                }
+
+                function schedule() {
+                    if (frame === null) {
+                        frame = requestAnimationFrame(render);
+                    }
+                }
+
+                function move(step) {
+                    const next = Math.max(0, Math.min(frames.length - 1, position + step));
+                    if (next !== position) {
+                        position = next;
+                        schedule();
+                    }
+                }
+
+                // Current slice first, then outwards.
+                frames.map((f, i) => i)
+                    .sort((a, b) => Math.abs(a - position) - Math.abs(b - position))
+                    .forEach(decode);
+
+                container.addEventListener('wheel', function(event) {
+                    event.preventDefault();
+                    if (!(event.ctrlKey || event.metaKey)) {
+                        move(event.deltaY > 0 ? 1 : -1);
+                        return;
+                    }
+                    const rect = container.getBoundingClientRect();
+                    const px = event.clientX - rect.left, py = event.clientY - rect.top;
+                    const next = Math.max(1, Math.min(max_scale, scale + (event.deltaY > 0 ? -increment : increment)));
+                    // Keep the point under the cursor fixed.
+                    tx = px - (px - tx) * (next / scale);
+                    ty = py - (py - ty) * (next / scale);
+                    scale = next;
+                    clamp();
+                    schedule();
+                }, { passive: false });
+
+                container.addEventListener('contextmenu', function(event) {
+                    event.preventDefault();
+                });
+
+                container.addEventListener('mousedown', function(event) {
+                    if (event.target === play) {
+                        return;
+                    }
+                    if (event.button === 2 && windowed) {
+                        windowDrag = { x: event.clientX, y: event.clientY, center: center, window: windowWidth };
+                    } else if (event.button === 0) {
+                        drag = { x: event.clientX, y: event.clientY, tx: tx, ty: ty };
+                    }
+                    event.preventDefault();
+                    schedule();
+                });
+
+                document.addEventListener('mousemove', function(event) {
+                    if (windowDrag) {
+                        windowWidth = Math.max(1, windowDrag.window + (event.clientX - windowDrag.x) * params.step);
+                        center = windowDrag.center + (event.clientY - windowDrag.y) * params.step;
+                        shown = -1;
+                        schedule();
+                    } else if (drag) {
+                        tx = drag.tx + event.clientX - drag.x;
+                        ty = drag.ty + event.clientY - drag.y;
+                        clamp();
+                        schedule();
+                    }
+                });
+
+                document.addEventListener('mouseup', function() {
+                    if (drag || windowDrag) {
+                        drag = null;
+                        windowDrag = null;
+                        schedule();
+                    }
+                });
+
+                container.addEventListener('dblclick', function(event) {
+                    if (event.target === play) {
+                        return;
+                    }
+                    scale = 1;
+                    tx = 0;
+                    ty = 0;
+                    if (windowed) {
+                        center = params.center;
+                        windowWidth = params.window;
+                        shown = -1;
+                    }
+                    schedule();
+                });
+
+                play.addEventListener('click', function() {
+                    if (timer === null) {
+                        timer = setInterval(function() {
+                            position = (position + 1) % frames.length;
+                            schedule();
+                        }, 1000 / fps);
+                    } else {
+                        clearInterval(timer);
+                        timer = null;
+                    }
+                    schedule();
+                });
+
+                render();
+            };
+        </script>
+    """
+    return f"""
+        {css_code}
+        <div id="container" style="width: {display_size[0]}px; height: {display_size[1]}px;">
+            <canvas id="canvas"></canvas>
+            <div id="readout"></div>
+            <button id="play" type="button"></button>
+        </div>
+        {js_code}
+        <script>
+        ImageStack('container', 'canvas', 'readout', 'play', {json.dumps(frames)}, {index}, {total}, {json.dumps(params)}, {zoom_factor}, {increment}, {fps});
+        </script>
+    """
@@ -0,0 +1,365 @@
+import hashlib
+import io
+import json
+import sys
+from typing import Dict, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def is_dicom_dataset(image) -> bool:
+    """
+    Check whether an object is a pydicom Dataset, without importing pydicom.
+
+    Args:
+        image: Any object.
+
+    Returns:
+        bool: True if image is a pydicom Dataset. Always False if pydicom has not been imported, since nothing
+            can be a Dataset then.
+    """
+    if "pydicom" not in sys.modules:
+        return False
+    from pydicom.dataset import Dataset
+
+    return isinstance(image, Dataset)
+
+
+def dataset_array(dataset) -> np.ndarray:
+    """
+    Get the pixel array of a DICOM dataset, the first frame only for multi-frame datasets.
+
+    Args:
+        dataset: A pydicom Dataset with pixel data.
+
+    Returns:
+        np.ndarray: The stored pixel values of a single frame.
+    """
+    pixels = dataset.pixel_array
+    if int(getattr(dataset, "NumberOfFrames", 1) or 1) > 1:
+        pixels = pixels[0]
+    return pixels
+
+
+def is_windowable(image) -> bool:
+    """
+    Check whether an image is displayed with client-side window/level.
+
+    Args:
+        image: The image passed to image_zoom.
+
+    Returns:
+        bool: True for grayscale DICOM datasets, 2D 16-bit integer NumPy arrays and 16-bit PIL Images.
+    """
+    if is_dicom_dataset(image):
+        return int(getattr(image, "SamplesPerPixel", 1)) == 1
+    if isinstance(image, np.ndarray):
+        return image.ndim == 2 and image.dtype.kind in "iu" and image.dtype.itemsize == 2
+    if isinstance(image, Image.Image):
+        return image.mode.startswith("I;16")
+    return False
+
+
+def windowing_digest(image) -> str:
+    """
+    Hash a windowable image. DICOM datasets are hashed by their raw pixel data and display attributes, so
+    compressed datasets are not decoded just to be hashed.
+
+    Args:
+        image: A windowable image (see is_windowable).
+
+    Returns:
+        str: A hex digest.
+    """
+    from .cache import image_digest
+
+    if not is_dicom_dataset(image):
+        return image_digest(image)
+    digest = hashlib.blake2b(digest_size=16)
+    for keyword in ("Rows", "Columns", "BitsAllocated", "PixelRepresentation", "PhotometricInterpretation",
+                    "RescaleSlope", "RescaleIntercept", "WindowCenter", "WindowWidth"):
+        digest.update(f"{keyword}={getattr(image, keyword, None)};".encode())
+    digest.update(image.PixelData)
+    return digest.hexdigest()
+
+
+def _first(value):
+    # Window attributes may hold several alternative windows; the first one is the default.
+    if isinstance(value, (list, tuple)) or type(value).__name__ == "MultiValue":
+        value = value[0] if len(value) else None
+    return None if value is None else float(value)
+
+
+def windowing_pixels(image) -> Tuple[np.ndarray, Dict]:
+    """
+    Get the stored pixel values of a windowable image and the parameters to display them.
+
+    Signed pixels are shifted into the unsigned 16-bit range, with the rescale intercept adjusted so modality
+    values are unchanged.
+
+    Args:
+        image: A windowable image (see is_windowable).
+
+    Returns:
+        Tuple[np.ndarray, Dict]: A 2D uint16 array, and {"width", "height", "slope", "intercept", "center",
+            "window", "invert", "step"} where center/window is the default window in modality units and step
+            is the change of center or width per pixel of mouse drag.
+    """
+    slope, intercept, center, window, invert = 1.0, 0.0, None, None, False
+    if is_dicom_dataset(image):
+        pixels = dataset_array(image)
+        slope = float(getattr(image, "RescaleSlope", 1) or 1)
+        intercept = float(getattr(image, "RescaleIntercept", 0) or 0)
+        center = _first(getattr(image, "WindowCenter", None))
+        window = _first(getattr(image, "WindowWidth", None))
+        invert = getattr(image, "PhotometricInterpretation", "") == "MONOCHROME1"
+    else:
+        pixels = np.asarray(image)
+
+    if pixels.dtype.kind == "i":
+        pixels = (pixels.astype(np.int32) + 32768).astype(np.uint16)
+        intercept -= slope * 32768
+    else:
+        pixels = pixels.astype(np.uint16, copy=False)
+
+    low, high = (slope * float(v) + intercept for v in (pixels.min(), pixels.max()))
+    low, high = min(low, high), max(low, high)
+    if center is None or window is None or window <= 0:
+        center, window = (low + high) / 2, max(high - low, 1.0)
+
+    return pixels, {
+        "width": pixels.shape[1],
+        "height": pixels.shape[0],
+        "slope": slope,
+        "intercept": intercept,
+        "center": center,
+        "window": window,
+        "invert": bool(invert),
+        "step": max((high - low) / 512, 0.01),
+    }
+
+
+def pack_pixels(pixels: np.ndarray) -> bytes:
+    """
+    Losslessly encode 16-bit pixels for the browser.
+
+    Browsers reduce 16-bit PNGs to 8 bits when drawing them on a canvas, so the high and low bytes of every
+    pixel go into the red and green channels of an 8-bit RGB PNG instead.
+
+    Args:
+        pixels (np.ndarray): A 2D uint16 array.
+
+    Returns:
+        bytes: The PNG-encoded image.
+    """
+    packed = np.zeros(pixels.shape + (3,), dtype=np.uint8)
+    packed[..., 0] = pixels >> 8
+    packed[..., 1] = pixels & 0xFF
+    in_mem_file = io.BytesIO()
+    Image.fromarray(packed, "RGB").save(in_mem_file, format="PNG")
+    return in_mem_file.getvalue()
+
+
+def windowing_html(
+    src: str, params: Dict, display_size: Tuple[int, int], zoom_factor: float, increment: float
+) -> str:
+    """
+    Assemble the HTML of the window/level viewer.
+
+    The packed pixels are unpacked once into a 16-bit buffer. Window center/width, rescale slope/intercept and
+    inversion are applied on a canvas through a 65536-entry lookup table, so contrast changes never go back to
+    the server. Right-click and drag changes the window (horizontal: width, vertical: center), scroll zooms
+    around the cursor, click and drag pans and double-click resets zoom and window.
+
+    Args:
+        src (str): URL of the packed pixels (see pack_pixels).
+        params (Dict): The display parameters returned by windowing_pixels.
+        display_size (Tuple[int, int]): The (width, height) of the viewer.
+        zoom_factor (float): The maximum zoom factor.
+        increment (float): The zoom step per scroll event.
+
+    Returns:
+        str: The HTML code of the viewer.
+    """
+    css_code = """
+        <style>
+            #container {
+                position: relative;
+                overflow: hidden;
+                cursor: zoom-in;
+                background: black;
+            }
+            #canvas {
+                position: absolute;
+                top: 0;
+                left: 0;
+                width: 100%;
+                height: 100%;
+                transform-origin: 0 0;
+                will-change: transform;
+            }
+            #readout {
+                position: absolute;
+                left: 6px;
+                bottom: 4px;
+                color: #ddd;
+                font: 12px sans-serif;
+                text-shadow: 0 0 2px black;
+                pointer-events: none;
+            }
+        </style>
+    """
+    js_code = """
+        <script>
+            function ImageWindowing(containerId, canvasId, readoutId, src, params, max_scale, increment) {
+                const container = document.getElementById(containerId);
+                const canvas = document.getElementById(canvasId);
+                const readout = document.getElementById(readoutId);
+                const ctx = canvas.getContext('2d');
+                const width = container.clientWidth;
+                const height = container.clientHeight;
+                const lut = new Uint8ClampedArray(65536);
+                let raw = null, output = null;
+                let center = params.center, windowWidth = params.window;
+                let scale = 1, tx = 0, ty = 0;
+                let frame = null, drag = null, windowDrag = null, dirty = true;
+
+                function updateLut() {
+                    // DICOM linear VOI function, on modality values (slope * stored + intercept).
+                    const low = center - 0.5 - (windowWidth - 1) / 2;
+                    const range = Math.max(windowWidth - 1, 1);
+                    for (let v = 0; v < 65536; v++) {
+                        const y = ((params.slope * v + params.intercept) - low) / range * 255;
+                        lut[v] = params.invert ? 255 - y : y;
+                    }
+                }
+
+                function paint() {
+                    updateLut();
+                    const out = output.data;
+                    for (let i = 0, j = 0; i < raw.length; i++, j += 4) {
+                        const g = lut[raw[i]];
+                        out[j] = g;
+                        out[j + 1] = g;
+                        out[j + 2] = g;
+                    }
+                    ctx.putImageData(output, 0, 0);
+                }
+
+                function clamp() {
+                    tx = Math.min(0, Math.max(width - width * scale, tx));
+                    ty = Math.min(0, Math.max(height - height * scale, ty));
+                }
+
+                function render() {
+                    frame = null;
+                    if (dirty && raw) {
+                        paint();
+                        dirty = false;
+                    }
+                    canvas.style.transform = `translate(${tx}px, ${ty}px) scale(${scale})`;
+                    container.style.cursor = windowDrag ? 'crosshair' : scale > 1 ? (drag ? 'grabbing' : 'grab') : 'zoom-in';
+                    readout.textContent = `WC ${Math.round(center)}  WW ${Math.round(windowWidth)}`;
+                }
+
+                function schedule() {
+                    if (frame === null) {
+                        frame = requestAnimationFrame(render);
+                    }
+                }
+
+                fetch(src)
+                    .then((response) => response.blob())
+                    .then((blob) => createImageBitmap(blob, { colorSpaceConversion: 'none', premultiplyAlpha: 'none' }))
+                    .then((bitmap) => {
+                        canvas.width = params.width;
+                        canvas.height = params.height;
+                        ctx.drawImage(bitmap, 0, 0);
+                        const packed = ctx.getImageData(0, 0, params.width, params.height).data;
+                        raw = new Uint16Array(params.width * params.height);
+                        for (let i = 0, j = 0; i < raw.length; i++, j += 4) {
+                            raw[i] = (packed[j] << 8) | packed[j + 1];
+                        }
+                        output = ctx.createImageData(params.width, params.height);
+                        for (let j = 3; j < output.data.length; j += 4) {
+                            output.data[j] = 255;
+                        }
+                        dirty = true;
+                        schedule();
+                    });
+
+                container.addEventListener('wheel', function(event) {
+                    event.preventDefault();
+                    const rect = container.getBoundingClientRect();
+                    const px = event.clientX - rect.left, py = event.clientY - rect.top;
+                    const next = Math.max(1, Math.min(max_scale, scale + (event.deltaY > 0 ? -increment : increment)));
+                    // Keep the point under the cursor fixed.
+                    tx = px - (px - tx) * (next / scale);
+                    ty = py - (py - ty) * (next / scale);
+                    scale = next;
+                    clamp();
+                    schedule();
+                }, { passive: false });
+
+                container.addEventListener('contextmenu', function(event) {
+                    event.preventDefault();
+                });
+
+                container.addEventListener('mousedown', function(event) {
+                    if (event.button === 2) {
+                        windowDrag = { x: event.clientX, y: event.clientY, center: center, window: windowWidth };
+                    } else {
+                        drag = { x: event.clientX, y: event.clientY, tx: tx, ty: ty };
+                    }
+                    event.preventDefault();
+                    schedule();
+                });
+
+                document.addEventListener('mousemove', function(event) {
+                    if (windowDrag) {
+                        windowWidth = Math.max(1, windowDrag.window + (event.clientX - windowDrag.x) * params.step);
+                        center = windowDrag.center + (event.clientY - windowDrag.y) * params.step;
+                        dirty = true;
+                        schedule();
+                    } else if (drag) {
+                        tx = drag.tx + event.clientX - drag.x;
+                        ty = drag.ty + event.clientY - drag.y;
+                        clamp();
+                        schedule();
+                    }
+                });
+
+                document.addEventListener('mouseup', function() {
+                    if (drag || windowDrag) {
+                        drag = null;
+                        windowDrag = null;
+                        schedule();
+                    }
+                });
+
+                container.addEventListener('dblclick', function() {
+                    scale = 1;
+                    tx = 0;
+                    ty = 0;
+                    center = params.center;
+                    windowWidth = params.window;
+                    dirty = true;
+                    schedule();
+                });
+
+                render();
+            };
+        </script>
+    """
+    return f"""
+        {css_code}
+        <div id="container" style="width: {display_size[0]}px; height: {display_size[1]}px;">
+            <canvas id="canvas"></canvas>
+            <div id="readout"></div>
+        </div>
+        {js_code}
+        <script>
+        ImageWindowing('container', 'canvas', 'readout', {json.dumps(src)}, {json.dumps(params)}, {zoom_factor}, {increment});
+        </script>
+    """
@@ -0,0 +1,298 @@
+"""Opt-in profiling of the Streamlit app.
+
+Enable it with DICOM_PIXEL_PROFILE=1. Every rerun of app2.py is then timed by
+page, along with named sections inside the pages (see section()). It also
+counts the bytes sent to the browser per element type, and estimates how much
+memory each session holds in session_state. Reruns slower than
+DICOM_PIXEL_SLOW_RERUN seconds are logged; a sample of reruns
+(DICOM_PIXEL_PROFILE_SAMPLE) runs under cProfile, so slow ones are logged with
+their call profile.
+
+Aggregates (count, sum, p50/p90/p99) are shown on the hidden admin view
+(?admin=1) and served as Prometheus text on
+http://127.0.0.1:DICOM_PIXEL_METRICS_PORT/metrics (0 turns the endpoint off).
+"""
+import cProfile
+import io
+import logging
+import math
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import streamlit as st
+
+ENABLED = os.environ.get('DICOM_PIXEL_PROFILE', '') not in ('', '0')
+SLOW_RERUN_SECONDS = float(os.environ.get('DICOM_PIXEL_SLOW_RERUN', 1.0))
+PROFILE_SAMPLE_RATE = float(os.environ.get('DICOM_PIXEL_PROFILE_SAMPLE', 0.1))
+METRICS_PORT = int(os.environ.get('DICOM_PIXEL_METRICS_PORT', 9464))
+
+# Observations kept per series for the percentiles, and how long an idle session's memory is reported
+WINDOW = 1000
+SESSION_GAUGE_TTL = 60 * 60
+QUANTILES = (0.5, 0.9, 0.99)
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+# Only one profiler can be active per process (Python 3.12+ raises otherwise), so concurrent reruns take turns
+_profiler_lock = threading.Lock()
+
+
+class Metrics:
+    """Process-wide aggregates: timing windows, byte counters and per-session memory."""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._observations = {}
+        self._counters = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self._observations.setdefault((name, labels), deque(maxlen=self.window)).append(value)
+
+    def count(self, name, labels, amount):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + amount
+
+    def session_memory(self, session_id, nbytes):
+        now = time.time()
+        with self._lock:
+            self._sessions[session_id] = (nbytes, now)
+            for stale in [s for s, (_, seen) in self._sessions.items() if now - seen > SESSION_GAUGE_TTL]:
+                del self._sessions[stale]
+
+    def summaries(self):
+        """[(name, labels, count, sum, {quantile: value})] over the recent window of each series."""
+        with self._lock:
+            items = [(name, labels, list(values)) for (name, labels), values in self._observations.items()]
+        return [(name, labels, len(values), sum(values), _quantiles(values, QUANTILES))
+                for name, labels, values in sorted(items)]
+
+    def counters(self):
+        with self._lock:
+            return sorted((name, labels, value) for (name, labels), value in self._counters.items())
+
+    def sessions(self):
+        with self._lock:
+            return {session_id: nbytes for session_id, (nbytes, _) in self._sessions.items()}
+
+    def prometheus_text(self):
+        lines = []
+        for name, labels, count, total, quantiles in self.summaries():
+            metric = f'dicom_pixel_{name}'
+            for q, value in quantiles.items():
+                lines.append(f'{metric}{_labels(labels, quantile=q)} {value:.6f}')
+            lines.append(f'{metric}_count{_labels(labels)} {count}')
+            lines.append(f'{metric}_sum{_labels(labels)} {total:.6f}')
+        for name, labels, value in self.counters():
+            lines.append(f'dicom_pixel_{name}_total{_labels(labels)} {value}')
+        for session_id, nbytes in self.sessions().items():
+            lines.append(f'dicom_pixel_session_memory_bytes{_labels((("session", session_id),))} {nbytes}')
+        return '\n'.join(lines) + '\n'
+
+
+def _quantiles(values, quantiles):
+    # Linear interpolation between the closest ranks, as numpy.quantile does by default
+    values = sorted(values)
+    result = {}
+    for q in quantiles:
+        position = q * (len(values) - 1)
+        low = math.floor(position)
+        high = min(low + 1, len(values) - 1)
+        result[q] = values[low] + (values[high] - values[low]) * (position - low)
+    return result
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + [(key, str(value)) for key, value in extra.items()]
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in pairs) + '}'
+
+
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = get_metrics().prometheus_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@st.cache_resource
+def start_metrics_server(port=METRICS_PORT):
+    """Serve /metrics on localhost from a background thread, once per process."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    except OSError as e:
+        logger.warning('Metrics endpoint not started on port %s: %s', port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def estimate_size(value, depth=0):
+    """Rough size in bytes of a session_state value: buffers, arrays and images in full, containers a few levels deep."""
+    if hasattr(value, 'memory') and callable(value.memory):
+        # Stores that keep their own accounting (the artifact store)
+        return value.memory()
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, memoryview):
+        return value.nbytes
+    # numpy isn't imported just for this: if nothing loaded it, there are no arrays to measure
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, 'getbands') and hasattr(value, 'size'):
+        return value.size[0] * value.size[1] * len(value.getbands())
+    size = sys.getsizeof(value, 0)
+    if depth >= 3:
+        return size
+    if isinstance(value, dict):
+        return size + sum(estimate_size(k, depth + 1) + estimate_size(v, depth + 1) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset, deque)):
+        return size + sum(estimate_size(v, depth + 1) for v in value)
+    if hasattr(value, '__dict__') and not isinstance(value, type):
+        return size + estimate_size(vars(value), depth + 1)
+    return size
+
+
+def _element_type(msg):
+    if not msg.HasField('delta'):
+        return msg.WhichOneof('type') or 'other'
+    delta = msg.delta
+    if delta.WhichOneof('type') != 'new_element':
+        return delta.WhichOneof('type') or 'other'
+    element = delta.new_element
+    kind = element.WhichOneof('type') or 'other'
+    if kind == 'component_instance':
+        return f'component:{element.component_instance.component_name}'
+    return kind
+
+
+@contextmanager
+def rerun():
+    """Profile one rerun of the app; the page is read from st.session_state.page when it ends."""
+    if not ENABLED:
+        yield
+        return
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    start_metrics_server()
+    metrics = get_metrics()
+    ctx = get_script_run_ctx()
+    run = {'sections': [], 'bytes': {}}
+    _local.run = run
+
+    # Count what actually goes out: _enqueue gets the messages after cached ones became references
+    original_enqueue = ctx._enqueue if ctx is not None else None
+    if ctx is not None:
+        def counting_enqueue(msg):
+            kind = _element_type(msg)
+            run['bytes'][kind] = run['bytes'].get(kind, 0) + msg.ByteSize()
+            original_enqueue(msg)
+        ctx._enqueue = counting_enqueue
+
+    # A sampled rerun is skipped, not delayed, while another session's rerun holds the profiler
+    profiler = None
+    if random.random() < PROFILE_SAMPLE_RATE and _profiler_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+    start = time.perf_counter()
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:
+            # Something outside this module is profiling the process already
+            profiler = None
+            _profiler_lock.release()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _profiler_lock.release()
+        elapsed = time.perf_counter() - start
+        _local.run = None
+        if ctx is not None:
+            ctx._enqueue = original_enqueue
+        page = str(st.session_state.get('page', 'home'))
+        metrics.observe('rerun_seconds', (('page', page),), elapsed)
+        for kind, nbytes in run['bytes'].items():
+            metrics.count('sent_bytes', (('page', page), ('element', kind)), nbytes)
+        if ctx is not None:
+            metrics.session_memory(ctx.session_id, sum(
+                estimate_size(st.session_state[key]) for key in list(st.session_state.keys())))
+        if elapsed > SLOW_RERUN_SECONDS:
+            _log_slow_rerun(page, elapsed, run, profiler)
+
+
+@contextmanager
+def section(name):
+    """Time a named part of a rerun (a no-op unless profiling is on)."""
+    run = getattr(_local, 'run', None)
+    if run is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        run['sections'].append((name, elapsed))
+        get_metrics().observe('section_seconds', (('section', name),), elapsed)
+
+
+def _log_slow_rerun(page, elapsed, run, profiler):
+    sections = ', '.join(f'{name} {seconds:.3f}s' for name, seconds in run['sections']) or 'none'
+    sent = sum(run['bytes'].values())
+    message = f'Slow rerun on {page}: {elapsed:.3f}s, {sent} bytes sent; sections: {sections}'
+    if profiler is not None:
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(25)
+        message += '\n' + out.getvalue()
+    logger.warning(message)
+
+
+def admin_view():
+    """Aggregated timings, bytes sent and session memory, for ?admin=1."""
+    metrics = get_metrics()
+    st.subheader('Profiling')
+    st.caption(f'Last {metrics.window} observations per series. Prometheus text: '
+               f'http://127.0.0.1:{METRICS_PORT}/metrics')
+    rows = [{'metric': name, **dict(labels), 'count': count,
+             **{f'p{int(q * 100)} ms': round(value * 1000, 1) for q, value in quantiles.items()}}
+            for name, labels, count, _, quantiles in metrics.summaries()]
+    if rows:
+        st.dataframe(rows)
+    counters = [{**dict(labels), 'bytes': value} for _, labels, value in metrics.counters()]
+    if counters:
+        st.write('Bytes sent to the browser')
+        st.dataframe(counters)
+    sessions = metrics.sessions()
+    if sessions:
+        st.write('Session memory (estimated)')
+        st.dataframe([{'session': session_id, 'MB': round(nbytes / 1024 ** 2, 2)}
+                      for session_id, nbytes in sessions.items()])
@@ -0,0 +1,363 @@
+"""Headless HTTP API for the DICOM converter and the annotation renderer.
+
+Runs next to the Streamlit app for PACS routers and pipelines:
+
+    python service.py --port 8502
+
+Endpoints (request bodies are the raw file, or a ZIP of files):
+
+    POST /convert/dicom-to-png, /convert/dicom-to-jpeg, /convert/png-to-dicom, /convert/jpeg-to-dicom
+        One file, or a ZIP for a batch. ?name= gives the file name of a single upload.
+        Returns the converted file, or a ZIP of them.
+    POST /annotate?format=same|png|jpeg&mask_alpha=0.4
+        One image with its annotations as JSON in ?annotations= or the X-Annotations header
+        (a list of {"bbox", "category_name", "segmentation"}), returned annotated.
+        Or a ZIP of images plus annotations.json (COCO or extracted layout), returned as a ZIP.
+    GET /health
+
+Request bodies are streamed to a spooled temporary file. Work runs on a fixed pool
+of worker threads; when every worker is busy and the queue is full, requests get
+429 with Retry-After. Responses are streamed with chunked transfer encoding, and
+connections are kept alive between requests.
+"""
+import argparse
+import json
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+from pydicom.errors import InvalidDicomError
+
+from annotation.render import OUTPUT_FORMATS, open_font, render_annotated
+from annotation.archive import AnnotatedArchive
+from annotation.sources import ZipImageSource, decode_image, normalize_member_name
+from annotation.store import AnnotationStore
+from converter.scriptt import DICOMConverter
+
+CHUNK_SIZE = 1024 * 1024
+SPOOL_MAX_BYTES = 32 * 1024 * 1024
+MAX_BODY_BYTES = 2 * 1024 ** 3
+# What a ZIP upload may unpack to, so a small, highly compressed body can't fill the disk
+MAX_EXTRACTED_BYTES = 4 * 1024 ** 3
+RETRY_AFTER = 1
+KEEP_ALIVE_TIMEOUT = 60
+
+# Endpoint -> (DICOMConverter method, extension a single upload needs)
+CONVERSIONS = {
+    'dicom-to-png': ('dicom_to_png', '.dcm'),
+    'dicom-to-jpeg': ('dicom_to_jpeg', '.dcm'),
+    'png-to-dicom': ('png_to_dicom', '.png'),
+    'jpeg-to-dicom': ('jpg_to_dicom', '.jpg'),
+}
+ANNOTATION_FORMATS = {'same': OUTPUT_FORMATS[0], 'png': 'PNG', 'jpeg': 'JPEG'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class WorkerPool:
+    """A fixed pool of worker threads that admits at most workers + queue_size requests at a time."""
+
+    def __init__(self, workers, queue_size):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='service-worker')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def try_acquire(self):
+        return self._slots.acquire(blocking=False)
+
+    def release(self):
+        self._slots.release()
+
+    def run(self, fn, *args):
+        return self.executor.submit(fn, *args).result()
+
+
+class Result:
+    """A response body: a file object streamed in chunks, plus whatever has to be cleaned up afterwards."""
+
+    def __init__(self, fileobj, file_name, cleanup=None):
+        self.fileobj = fileobj
+        self.file_name = file_name
+        self.cleanup = cleanup
+
+    def iter_chunks(self):
+        self.fileobj.seek(0)
+        while True:
+            chunk = self.fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.fileobj.close()
+        if self.cleanup is not None:
+            self.cleanup()
+
+
+def content_disposition(file_name):
+    """An attachment header for a client-supplied file name (RFC 6266).
+
+    The plain filename is an ASCII fallback without control characters, quotes or
+    backslashes; the exact name goes in filename* percent-encoded.
+    """
+    fallback = ''.join(c if ' ' <= c < '\x7f' and c not in '"\\' else '_' for c in file_name)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(file_name, safe='')}"
+
+
+def extract_zip(body, directory):
+    """Extract the files of an uploaded ZIP flat into directory, skipping unsafe names.
+
+    The whole archive is checked before anything is written: files that would land
+    on the same name, or more than MAX_EXTRACTED_BYTES in all, reject it.
+    """
+    with zipfile.ZipFile(body) as archive:
+        members, total = {}, 0
+        for info in archive.infolist():
+            name = normalize_member_name(info.filename)
+            if info.is_dir() or name is None:
+                continue
+            base_name = os.path.basename(name)
+            if base_name in members:
+                raise HTTPError(400, f'The ZIP has more than one file named {base_name}')
+            members[base_name] = info
+            # Reading a member stops at its declared size, so the headers can be trusted here
+            total += info.file_size
+        if total > MAX_EXTRACTED_BYTES:
+            raise HTTPError(413, 'The ZIP unpacks to more than the service accepts')
+        for base_name, info in members.items():
+            with archive.open(info) as src, open(os.path.join(directory, base_name), 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def convert(converter, conversion, body, name):
+    """Run one conversion on a single file or a ZIP of files."""
+    method, extension = CONVERSIONS[conversion]
+    workdir = tempfile.mkdtemp(prefix='dicom-pixel-service-')
+    cleanup = lambda: shutil.rmtree(workdir, ignore_errors=True)
+    try:
+        input_dir = os.path.join(workdir, 'input')
+        os.makedirs(input_dir)
+        if zipfile.is_zipfile(body):
+            extract_zip(body, input_dir)
+            path = input_dir
+        else:
+            base_name = os.path.basename(name or '') or 'upload'
+            if os.path.splitext(base_name)[1] == '':
+                base_name += extension
+            path = os.path.join(input_dir, base_name)
+            body.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(body, f, CHUNK_SIZE)
+        output_path = getattr(converter, method)(path, os.path.join(workdir, 'output'))
+        return Result(open(output_path, 'rb'), os.path.basename(output_path), cleanup)
+    except Exception:
+        cleanup()
+        raise
+
+
+def annotate(converter, font, body, params, headers):
+    """Render bbox (and segmentation) annotations onto one image, or onto every image of a ZIP."""
+    output_format = ANNOTATION_FORMATS.get(params.get('format', 'same'))
+    if output_format is None:
+        raise HTTPError(400, f"format must be one of {', '.join(ANNOTATION_FORMATS)}")
+    mask_alpha = float(params.get('mask_alpha', 0.4))
+
+    if zipfile.is_zipfile(body):
+        # Images come from the uploaded archive only, never from the server's disk
+        source = ZipImageSource(body)
+        if not source.has('annotations.json'):
+            raise HTTPError(400, 'The ZIP has no annotations.json')
+        store = AnnotationStore.from_data(json.loads(source.read_bytes('annotations.json')))
+        if store is None:
+            raise HTTPError(400, 'annotations.json is neither COCO nor extracted annotations')
+        missing = [name for name in store.names if name and not source.has(name)]
+        if missing:
+            raise HTTPError(400, f"Images missing from the ZIP: {', '.join(map(str, missing[:10]))}")
+        items = {name: store.image_annotations(i) for i, name in enumerate(store.names) if name}
+        archive = AnnotatedArchive()
+        try:
+            for image_name, annotations in items.items():
+                image, dataset = decode_image(image_name, source.read_bytes(image_name), converter)
+                archive.add(*render_annotated(image_name, image, dataset, annotations, font,
+                                              output_format, converter, mask_alpha))
+            archive.close()
+        except Exception:
+            archive.discard()
+            raise
+        return Result(archive.file, 'annotated_images.zip')
+
+    name = params.get('name') or 'image.png'
+    raw = params.get('annotations') or headers.get('X-Annotations')
+    if not raw:
+        raise HTTPError(400, 'Pass the annotations as JSON in ?annotations= or the X-Annotations header')
+    # Normalise through the store so missing labels and category names are filled in as the UI does
+    store = AnnotationStore.from_extracted([{'name': name, 'annotations': json.loads(raw)}])
+    body.seek(0)
+    image, dataset = decode_image(name, body.read(), converter)
+    output_name, data = render_annotated(name, image, dataset, store.image_annotations(0), font,
+                                         output_format, converter, mask_alpha)
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    output.write(data)
+    return Result(output, output_name)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+        if parts[0] == 'convert' and len(parts) == 2 and parts[1] in CONVERSIONS:
+            job = lambda body: convert(self.server.converter, parts[1], body, params.get('name'))
+        elif parts == ['annotate']:
+            job = lambda body: annotate(self.server.converter, self.server.font, body, params, self.headers)
+        else:
+            self.close_connection = True
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        pool = self.server.pool
+        if not pool.try_acquire():
+            # The body is left unread, so this connection can't be reused
+            self.close_connection = True
+            self.send_json(429, {'error': 'Too many requests'}, {'Retry-After': str(RETRY_AFTER)})
+            return
+        try:
+            body = self.read_body()
+            try:
+                result = pool.run(job, body)
+            finally:
+                body.close()
+        except HTTPError as e:
+            self.send_json(e.status, {'error': e.message})
+            return
+        except (ValueError, KeyError, zipfile.BadZipFile, OSError, InvalidDicomError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.log_error('%s failed: %r', url.path, e)
+            self.send_json(500, {'error': 'Internal error'})
+            return
+        finally:
+            pool.release()
+
+        try:
+            self.send_stream(result)
+        finally:
+            result.close()
+
+    def read_body(self):
+        """Stream the request body (Content-Length or chunked) into a spooled temporary file."""
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        try:
+            if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+                while True:
+                    size = int(self.rfile.readline(65537).split(b';')[0].strip(), 16)
+                    if size == 0:
+                        # Skip trailers up to the blank line
+                        while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+                            pass
+                        break
+                    self._copy(body, size)
+                    self.rfile.readline()
+            else:
+                self._copy(body, int(self.headers.get('Content-Length') or 0))
+        except Exception:
+            self.close_connection = True
+            body.close()
+            raise
+        body.seek(0)
+        return body
+
+    def _copy(self, body, size):
+        if body.tell() + size > MAX_BODY_BYTES:
+            raise HTTPError(413, 'Request body too large')
+        while size:
+            chunk = self.rfile.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise HTTPError(400, 'Incomplete request body')
+            body.write(chunk)
+            size -= len(chunk)
+
+    def send_stream(self, result):
+        chunked = self.request_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-Type', mimetypes.guess_type(result.file_name)[0] or 'application/octet-stream')
+        self.send_header('Content-Disposition', content_disposition(result.file_name))
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            # HTTP/1.0 clients read to the end of the connection instead
+            self.close_connection = True
+        self.end_headers()
+        for chunk in result.iter_chunks():
+            if chunked:
+                self.wfile.write(b'%x\r\n' % len(chunk))
+                self.wfile.write(chunk)
+                self.wfile.write(b'\r\n')
+            else:
+                self.wfile.write(chunk)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Service(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, workers, queue_size):
+        super().__init__(address, ServiceHandler)
+        self.pool = WorkerPool(workers, queue_size)
+        self.converter = DICOMConverter(output_dir=os.path.join(tempfile.gettempdir(), 'dicom-pixel-service'))
+        self.font = open_font()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless DICOM conversion and annotation service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8502)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker threads (default: CPUs)')
+    parser.add_argument('--queue', type=int, default=None, help='requests allowed to wait (default: 2 x workers)')
+    args = parser.parse_args()
+    queue_size = 2 * args.workers if args.queue is None else args.queue
+
+    server = Service((args.host, args.port), args.workers, queue_size)
+    print(f'Serving on http://{args.host}:{args.port} with {args.workers} workers')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import streamlit as st
+
+# Every session gets its own scratch directory under this root, with these subdirectories
+WORKSPACE_ROOT = os.environ.get('DICOM_PIXEL_WORKSPACE', os.path.join(tempfile.gettempdir(), 'dicom-pixel'))
+SUBDIRS = ('temp', 'output', 'data', 'annotated', 'artifacts')
+
+SESSION_QUOTA = int(os.environ.get('DICOM_PIXEL_SESSION_QUOTA', 2 * 1024 ** 3))
+TOTAL_QUOTA = int(os.environ.get('DICOM_PIXEL_TOTAL_QUOTA', 20 * 1024 ** 3))
+SESSION_TTL = int(os.environ.get('DICOM_PIXEL_SESSION_TTL', 6 * 60 * 60))
+SWEEP_INTERVAL = 60
+
+
+class QuotaExceeded(Exception):
+    """Raised when a write would take a session over its byte quota."""
+
+
+class Workspace:
+    """The scratch area of one session: temp/, output/, data/, annotated/ and artifacts/ under its own directory.
+
+    Usage is counted per subdirectory rather than measured on disk: every write
+    is charged with reserve() first, and clear() zeroes what it deletes.
+    """
+
+    def __init__(self, manager, session_id, root):
+        self.manager = manager
+        self.session_id = session_id
+        self.root = root
+        self.last_used = time.time()
+        self.used = dict.fromkeys(SUBDIRS, 0)
+        self._lock = threading.Lock()
+
+    def path(self, kind, *parts):
+        """Path of a subdirectory (created if needed), or of a file in it."""
+        if kind not in SUBDIRS:
+            raise ValueError(f'Unknown workspace directory: {kind}')
+        directory = os.path.join(self.root, kind)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, *parts)
+
+    def usage(self):
+        return sum(self.used.values())
+
+    def reserve(self, nbytes, kind):
+        """Charge nbytes about to be written under kind to the session quota, evicting idle sessions if the disk budget is short."""
+        used = self.usage()
+        if used + nbytes > self.manager.session_quota:
+            raise QuotaExceeded(
+                f'This needs {nbytes / 1024 ** 2:.1f} MB but only '
+                f'{max(self.manager.session_quota - used, 0) / 1024 ** 2:.1f} MB of the session quota are left. '
+                'Clean up earlier files and try again.')
+        # Not under our lock: making room clears other workspaces, which take theirs
+        self.manager.make_room(nbytes, keep=self.session_id)
+        with self._lock:
+            self.used[kind] += nbytes
+
+    def refund(self, nbytes, kind):
+        """Give back bytes charged under kind whose file was deleted."""
+        with self._lock:
+            self.used[kind] = max(self.used[kind] - nbytes, 0)
+
+    def remove(self, path, kind):
+        """Delete a file written under kind and give its bytes back."""
+        nbytes = os.path.getsize(path)
+        os.remove(path)
+        self.refund(nbytes, kind)
+
+    def transfer(self, nbytes, source, target):
+        """Move the charge of a file moved from one subdirectory to another."""
+        with self._lock:
+            self.used[source] = max(self.used[source] - nbytes, 0)
+            self.used[target] += nbytes
+
+    def clear(self, kind=None):
+        """Delete one subdirectory, or the whole workspace."""
+        path = self.root if kind is None else os.path.join(self.root, kind)
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            for cleared in (SUBDIRS if kind is None else (kind,)):
+                self.used[cleared] = 0
+
+
+class WorkspaceManager:
+    """Process-wide registry of session workspaces.
+
+    Workspaces of sessions that have ended, or have been idle for longer than
+    ttl, are removed on a periodic sweep. When all workspaces together would
+    exceed total_quota, the least recently used ones are evicted first.
+    Each process keeps its workspaces in its own directory under root, and
+    directories left by processes that no longer run are removed on start.
+    """
+
+    def __init__(self, root=WORKSPACE_ROOT, session_quota=SESSION_QUOTA, total_quota=TOTAL_QUOTA, ttl=SESSION_TTL):
+        self.root = os.path.join(root, f'proc-{os.getpid()}')
+        self.session_quota = session_quota
+        self.total_quota = total_quota
+        self.ttl = ttl
+        self._workspaces = {}
+        self._lock = threading.Lock()
+        self._last_sweep = 0
+        os.makedirs(self.root, exist_ok=True)
+        self._remove_orphans(root)
+
+    def get(self, session_id):
+        with self._lock:
+            workspace = self._workspaces.get(session_id)
+            if workspace is None:
+                workspace = Workspace(self, session_id, os.path.join(self.root, session_id))
+                self._workspaces[session_id] = workspace
+            workspace.last_used = time.time()
+        if time.time() - self._last_sweep > SWEEP_INTERVAL:
+            self.sweep()
+        return workspace
+
+    def release(self, session_id):
+        with self._lock:
+            workspace = self._workspaces.pop(session_id, None)
+        if workspace is not None:
+            workspace.clear()
+
+    def sweep(self):
+        """Remove the workspaces of ended and expired sessions."""
+        self._last_sweep = time.time()
+        now = time.time()
+        with self._lock:
+            stale = [session_id for session_id, workspace in self._workspaces.items()
+                     if now - workspace.last_used > self.ttl or not _is_active_session(session_id)]
+        for session_id in stale:
+            self.release(session_id)
+
+    def usage(self):
+        """Bytes charged to all workspaces together."""
+        with self._lock:
+            workspaces = list(self._workspaces.values())
+        return sum(workspace.usage() for workspace in workspaces)
+
+    def make_room(self, nbytes, keep=None):
+        """Evict least recently used workspaces (other than keep) until nbytes more fit in total_quota."""
+        if self.usage() + nbytes <= self.total_quota:
+            return
+        self.sweep()
+        with self._lock:
+            candidates = sorted((w for w in self._workspaces.values() if w.session_id != keep),
+                                key=lambda w: w.last_used)
+        total = self.usage()
+        for workspace in candidates:
+            if total + nbytes <= self.total_quota:
+                break
+            total -= workspace.usage()
+            self.release(workspace.session_id)
+        if total + nbytes > self.total_quota:
+            raise QuotaExceeded('The server is out of scratch space. Please try again later.')
+
+    def _remove_orphans(self, root):
+        for name in os.listdir(root):
+            if not name.startswith('proc-'):
+                continue
+            try:
+                pid = int(name[len('proc-'):])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not _pid_alive(pid):
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _is_active_session(session_id):
+    from streamlit import runtime
+    if not runtime.exists():
+        return True
+    return runtime.get_instance().is_active_session(session_id)
+
+
+def current_session_id():
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else 'local'
+
+
+@st.cache_resource
+def get_workspace_manager():
+    return WorkspaceManager()
+
+
+def current_workspace():
+    """The workspace of the session running this script."""
+    return get_workspace_manager().get(current_session_id())